@@ -28,6 +28,8 @@ from libgutenberg.GutenbergFiles import FILES
 from libgutenberg.Logger import debug, info, error
 from libgutenberg.Models import Book, File
 
+from ebookconverter import Metrics
+
 OB = GutenbergDatabase.Objectbase(False)
 
 PRIVATE = os.getenv('PRIVATE') or ''
@@ -65,6 +67,7 @@ def check_book(ebook):
     session.commit()
 
 
+@Metrics.instrument('autodelete')
 def main():
     goback = 1
 
@@ -106,6 +109,7 @@ def main():
             Logger.ebook = ebook
             debug("Checking ebook")
             check_book(ebook)
+            Metrics.inc('books_processed_total')
 
     Logger.ebook = 0
     debug("Done AutoDelete.py")
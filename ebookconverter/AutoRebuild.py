@@ -8,20 +8,41 @@ Copyright 2025 by Project Gutenberg
 
 Distributable under the GNU General Public License Version 3 or newer.
 
-Looks for any ebooks with significant changed metadata in the last X hours and then
-rebuilds the book.
+Looks for any ebooks with significant changed metadata since the last run and then
+rebuilds the book.  By default (--build=metadata) the new title and
+authors are patched into the outputs that are up to date; only the
+outputs whose source changed are converted again.
+
+Reads public.changelog from a watermark kept in WATERMARK_FILE (on the
+first run: the last --goback hours, default 1), puts the ebooks changed
+into the rebuild WorkQueue and converts what is in the queue.  Ebooks
+queued but not converted, eg. because of a crash, are converted by the
+next run.
+
+With --listen, keeps running and wakes up when the changelog gets new
+rows (see TRIGGER_SQL, installed with --install-trigger), or every
+--poll seconds.
+
 """
 
+import argparse
+import configparser
+import datetime
+import hashlib
+import json
 import os
 import re
-import subprocess
+import select
+import signal
+import sys
 
-from libgutenberg.Logger import debug, info
+from libgutenberg.Logger import debug, error, exception, info
 from libgutenberg import Logger
 from libgutenberg import GutenbergDatabase
 
 from ebookmaker.CommonCode import Options
 
+from ebookconverter import BookIndex, ConversionLog, EbookConverter, Metrics, WorkQueue
 from ebookconverter.EbookConverter import config
 
 PRIVATE = os.getenv('PRIVATE') or ''
@@ -29,49 +50,223 @@ PUBLIC = os.getenv('PUBLIC') or ''
 
 DIRS = PUBLIC + '/dirs'
 
+WATERMARK_FILE = os.path.join(PRIVATE, 'logs', 'autorebuild.watermark')
+# rows may show up late with an earlier time: look back this far past the watermark
+OVERLAP = datetime.timedelta(minutes=10)
+
+QUEUE = WorkQueue.REBUILD_QUEUE
+# before bulk rebuilds, after postings
+PRIORITY = 10
+
+CHANNEL = 'changelog'
+TRIGGER_SQL = """
+create or replace function public.changelog_notify() returns trigger as $$
+begin
+  perform pg_notify('%(channel)s', '');
+  return null;
+end
+$$ language plpgsql;
+drop trigger if exists changelog_notify on public.changelog;
+create trigger changelog_notify after insert on public.changelog
+  for each statement execute procedure public.changelog_notify();
+""" % {'channel': CHANNEL}
+
+# check for signals this often while listening
+SLICE = 5
+
 options = Options()
 
 RE_AUTHOR_BOOK = re.compile(r'fk_books = (\d\d+)')
 RE_BOOK_ADD_AUTHOR = re.compile(r'values \((\d\d+),')
 RE_TITLE_ATTRIBS = re.compile(r'where pk = (\d\d+)')
 
-def get_book_for_attrib(attrib):
-    c = GutenbergDatabase.DB.get_cursor()
+def books_for_attribs(c, attribs):
+    """ The ebooks of many attributes, in one query. """
 
-    c.execute("select fk_books from public.attributes where pk = %(attrib)s",
-               {'attrib': attrib})
-
-    for row in c.fetchall():
-        row = GutenbergDatabase.xl(c, row)
-        return row.fk_books
+    if not attribs:
+        return set()
+    c.execute("select distinct fk_books from public.attributes where pk = any(%(attribs)s)",
+              {'attribs': sorted(attribs)})
+    Metrics.inc('db_queries_total')
+    return {row[0] for row in c.fetchall()}
 
 def check_sql(sql):
-    """ return an ebook number needing rebuild """
+    """ Return what a changelog statement changed: ('book', ebook), ('attrib', pk) or None """
     if sql.startswith('update mn_books_authors ') \
             or sql.startswith('delete from mn_books_authors '):
         # change or delete in author
         match = RE_AUTHOR_BOOK.search(sql)
         if match:
-            return match.group(1)
+            return 'book', int(match.group(1))
 
     elif sql.startswith('insert into mn_books_authors (fk_books,'):
         # add author
         match = RE_BOOK_ADD_AUTHOR.search(sql)
         if match:
-            return match.group(1)
-    
+            return 'book', int(match.group(1))
+
     elif sql.startswith('update attributes set  "fk_attriblist" = 245'):
         # change in title
         match = RE_TITLE_ATTRIBS.search(sql)
-        attrib = match.group(1)
-        return get_book_for_attrib(attrib)
+        if match:
+            return 'attrib', int(match.group(1))
     return None
-        
-        
+
+
+def read_watermark(path=WATERMARK_FILE):
+    """ Return the time of the last changelog row handled (or None) and
+    the keys of the rows handled in the OVERLAP before it. """
+
+    try:
+        with open(path, 'r') as fp:
+            watermark = json.load(fp)
+        return (datetime.datetime.fromisoformat(watermark['time']),
+                set(watermark.get('seen', [])))
+    except (OSError, ValueError, KeyError):
+        return None, set()
+
+
+def write_watermark(time, seen, path=WATERMARK_FILE):
+    """ Remember how far the changelog has been handled. """
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.tmp', 'w') as fp:
+        json.dump({'time': time.isoformat(), 'seen': sorted(seen)}, fp)
+    os.replace(path + '.tmp', path)
+
+
+def row_key(time, sql):
+    """ Tell changelog rows apart (the table has no key). """
+
+    return hashlib.sha1(('%s %s' % (time.isoformat(), sql)).encode('utf-8')).hexdigest()
+
+
+def scan_changelog(c, since, seen, goback):
+    """ Find the ebooks changed since the watermark.
+
+    Returns the set of ebooks and the new watermark (time, seen).
+
+    """
+
+    if since is None:
+        c.execute("select time, sql from public.changelog "
+                  "where time >= now () - interval '%(goback)s hours' order by time",
+                  {'goback': goback})
+    else:
+        c.execute("select time, sql from public.changelog "
+                  "where time >= %(since)s order by time",
+                  {'since': since - OVERLAP})
+    Metrics.inc('db_queries_total')
+
+    books = set()
+    attribs = set()
+    rows = []
+    for time, sql in c.fetchall():
+        key = row_key(time, sql)
+        rows.append((time, key))
+        if key in seen:
+            continue
+        change = check_sql(sql or '')
+        if change is None:
+            continue
+        kind, number = change
+        if kind == 'book':
+            books.add(number)
+        else:
+            attribs.add(number)
+    books |= books_for_attribs(c, attribs)
+
+    if not rows:
+        return books, (since, seen)
+    latest = max(since, rows[-1][0]) if since else rows[-1][0]
+    return books, (latest, {key for time, key in rows if time >= latest - OVERLAP})
+
+
+def convert_queue(work_queue, book_index):
+    """ Convert the ebooks in the queue. """
+
+    if not work_queue.pending():
+        return
+    book_index.refresh()
+    EbookConverter.conversion_log = ConversionLog.ConversionLog(
+        options.records or ConversionLog.default_path(
+            datetime.date.today().strftime('autorebuild-%Y%m%d')))
+    try:
+        EbookConverter.run_work_queue(work_queue, book_index)
+    finally:
+        EbookConverter.conversion_log.close()
+        EbookConverter.conversion_log = None
+
+
+@Metrics.instrument('autorebuild')
+def rebuild(c, work_queue, book_index):
+    """ Queue the ebooks changed since the last call and convert the queue. """
+
+    since, seen = read_watermark()
+    to_rebuild, watermark = scan_changelog(c, since, seen, options.goback or 1)
+    to_rebuild = sorted(to_rebuild)
+    if to_rebuild:
+        info('rebuilding %s' % EbookConverter.pretty_print_list(to_rebuild))
+        work_queue.enqueue(to_rebuild, PRIORITY, options.build, 'autorebuild')
+    # only now: a crash before the enqueue must see these rows again
+    if watermark[0] is not None:
+        write_watermark(*watermark)
+    Metrics.inc('books_processed_total', len(to_rebuild))
+    convert_queue(work_queue, book_index)
+    return 0
+
+
+def listen():
+    """ Return a connection listening on CHANNEL. """
+
+    db = GutenbergDatabase.Database()
+    db.connect()
+    db.conn.set_session(autocommit=True)
+    db.conn.cursor().execute('listen %s' % CHANNEL)
+    return db.conn
+
+
+def wait_for_changes(conn, poll):
+    """ Return when the changelog may have new rows or a stop was requested. """
+
+    deadline = datetime.datetime.now() + datetime.timedelta(seconds=poll)
+    while not EbookConverter.stop_requested.is_set():
+        remaining = (deadline - datetime.datetime.now()).total_seconds()
+        if remaining <= 0:
+            return
+        if select.select([conn], [], [], min(SLICE, remaining)) != ([], [], []):
+            conn.poll()
+            if conn.notifies:
+                del conn.notifies[:]
+                return
 
 
 def main():
-    goback = 1
+    """ Main program. """
+
+    ap = argparse.ArgumentParser(add_help=False)
+    ap.add_argument(
+        "--listen",
+        dest    = "listen",
+        action  = "store_true",
+        help    = "keep running and rebuild as soon as the changelog changes")
+
+    ap.add_argument(
+        "--poll",
+        metavar = "SECONDS",
+        dest    = "poll",
+        type    = int,
+        default = 300,
+        action  = "store",
+        help    = "with --listen, look at the changelog at least every SECONDS seconds")
+
+    ap.add_argument(
+        "--install-trigger",
+        dest    = "install_trigger",
+        action  = "store_true",
+        help    = "create the trigger that wakes up --listen, and exit")
+    args, sys.argv[1:] = ap.parse_known_args()
+
     try:
         config()
     except configparser.Error as what:
@@ -87,23 +282,56 @@ def main():
     GutenbergDatabase.DB.connect()
     c  = GutenbergDatabase.DB.get_cursor()
 
-    c.execute("select sql from public.changelog "
-               "where time >= now () - interval '%(goback)s hours' ", {'goback': goback})
-
-    to_rebuild = set()
-    for row in c.fetchall():
-        row = GutenbergDatabase.xl(c, row)
-        to_rebuild.add(check_sql(row.sql))
-    buildlist = ''
-    for ebook in to_rebuild:
-        buildlist = f'{buildlist}{ebook},' if ebook else buildlist
-    buildlist = buildlist.strip(',')
-    if buildlist:
-        info(f'rebuilding {buildlist}')
-        subprocess.call(["ebookconverter", "-v", "--build=all", "--range=%s" % buildlist])        
+    if args.install_trigger:
+        c.execute(TRIGGER_SQL)
+        GutenbergDatabase.DB.conn.commit()
+        info("Installed trigger on public.changelog")
+        return 0
+
+    if not options.build and not options.make:
+        # a changed title or author: refresh the outputs, convert only
+        # the ones whose source changed too
+        options.build = ['metadata']
+    options.persistent_worker = args.listen
+    EbookConverter.resolve_types()
+
+    signal.signal(signal.SIGTERM, EbookConverter.request_stop)
+    signal.signal(signal.SIGINT, EbookConverter.request_stop)
+
+    work_queue = WorkQueue.WorkQueue(QUEUE)
+    book_index = BookIndex.BookIndex()
+    conn = listen() if args.listen else None
+    try:
+        while not EbookConverter.stop_requested.is_set():
+            try:
+                rebuild(c, work_queue, book_index)
+                # don't keep a snapshot open while waiting
+                GutenbergDatabase.DB.conn.commit()
+            except EbookConverter.StopConversion:
+                pass
+            except Exception as what:
+                if conn is None:
+                    raise
+                # keep serving
+                exception(what)
+                GutenbergDatabase.DB.conn.rollback()
+            if conn is None:
+                break
+            wait_for_changes(conn, args.poll)
+
+    except KeyboardInterrupt:
+        error("User interrupt")
+
+    finally:
+        for worker in EbookConverter.persistent_workers:
+            worker.close()
+        if conn is not None:
+            conn.close()
+
     Logger.ebook = 0
     debug("Done AutoRebuild.py")
+    return 0
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
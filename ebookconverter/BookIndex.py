@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: UTF8 -*-
+
+"""
+BookIndex.py
+
+Copyright 2026 by Project Gutenberg
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+Per-run facts about all ebooks, loaded from the PG database in two
+queries and kept as bitmaps indexed by ebook number.
+
+"""
+
+from sqlalchemy import select
+
+from libgutenberg import DBUtils
+from libgutenberg.Logger import debug
+from libgutenberg.Models import Book, t_mn_books_categories
+
+
+class Bitmap():
+    """ A set of non-negative integers, one bit per integer. """
+
+    def __init__(self, members=()):
+        self.bits = bytearray()
+        for n in members:
+            self.add(n)
+
+    def add(self, n):
+        """ Add n to the set. """
+        byte = n >> 3
+        if byte >= len(self.bits):
+            self.bits.extend(bytes(byte + 1 - len(self.bits)))
+        self.bits[byte] |= 1 << (n & 7)
+
+    def __contains__(self, n):
+        byte = n >> 3
+        return 0 <= byte < len(self.bits) and bool(self.bits[byte] & (1 << (n & 7)))
+
+    def __len__(self):
+        return sum(bin(byte).count('1') for byte in self.bits)
+
+
+class BookIndex():
+    """ Which ebooks exist and which are not text books.
+
+    Loaded on first use; call refresh() to pick up books added since.
+
+    """
+
+    def __init__(self):
+        self._existing = None
+        self._not_text = None
+
+    def refresh(self, session=None):
+        """ (Re)load the bitmaps from the database. """
+
+        session = DBUtils.check_session(session)
+        self._existing = Bitmap(session.execute(select(Book.pk)).scalars())
+        self._not_text = Bitmap(session.execute(
+            select(t_mn_books_categories.c.fk_books).distinct()).scalars())
+        debug("Book index: %d ebooks, %d not text" % (len(self._existing), len(self._not_text)))
+
+    @property
+    def existing(self):
+        """ Bitmap of ebooks in the database. """
+        if self._existing is None:
+            self.refresh()
+        return self._existing
+
+    @property
+    def not_text(self):
+        """ Bitmap of ebooks with a category, ie. not text books. """
+        if self._not_text is None:
+            self.refresh()
+        return self._not_text
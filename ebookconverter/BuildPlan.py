@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: UTF8 -*-
+
+"""
+BuildPlan.py
+
+Copyright 2026 by Project Gutenberg
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+The jobs a conversion run would do, one JSON record per (ebook, type),
+as written by ebookconverter --plan-out and run by --plan-in.  Plan a
+big range once, look at what it would cost, then run it, or parts of
+it (--range, --shard), on other hosts or at other times.
+
+A record has:
+
+  ebook, type
+  status       planned or skipped
+  reason       why the type is built or skipped
+  group        the job group the ebook was planned in
+  candidate    the file the job is built from
+  size         size of that file
+  memory       predicted peak memory of the worker, in bytes
+  seconds      estimated wall time, from the records of earlier runs
+  job          the job itself (planned records only)
+
+"""
+
+import collections
+import json
+
+from ebookmaker import CommonCode
+
+from ebookconverter import ConversionLog, ConversionReport
+
+# the attributes of a CommonCode.Job that EbookConverter sets
+JOB_FIELDS = ('url', 'outputdir', 'outputfile', 'logfile', 'include', 'max_depth',
+              'source', 'opf_identifier', 'build_inputs', 'old_mtime', 'memory', 'cost',
+              'derived_url')
+
+
+def timings(paths):
+    """ Learn how long each type takes from conversion records.
+
+    Returns a dict type -> (seconds per input byte, median seconds).
+
+    """
+
+    seconds = collections.defaultdict(list)
+    sizes = collections.Counter()
+    sized_seconds = collections.Counter()
+    for record in ConversionLog.read_records(paths):
+        if record.get('status') != 'done' or record.get('seconds') is None:
+            continue
+        type_ = record.get('type')
+        seconds[type_].append(record['seconds'])
+        if record.get('input_size'):
+            sizes[type_] += record['input_size']
+            sized_seconds[type_] += record['seconds']
+
+    result = {}
+    for type_, values in seconds.items():
+        values.sort()
+        rate = sized_seconds[type_] / sizes[type_] if sizes[type_] else 0.0
+        result[type_] = (rate, ConversionReport.percentile(values, 50))
+    return result
+
+
+def estimate_seconds(timing, type_, size):
+    """ Guess the wall time of a job of type_ built from a file of size bytes. """
+
+    rate, median = timing.get(type_, (0.0, 0.0))
+    if rate and size:
+        return rate * size
+    return median
+
+
+class PlanWriter():
+    """ Write a plan to a file. """
+
+    def __init__(self, path, timing=None):
+        self.path = path
+        self.timing = timing or {}
+        self.fp = open(path, 'w')
+        self.groups = 0
+        self.jobs = 0
+        self.seconds = 0.0
+
+
+    def write(self, record):
+        """ Write one record. """
+
+        self.fp.write(json.dumps(record) + '\n')
+
+
+    def skipped(self, ebook, type_, reason='', **fields):
+        """ Record a type that would not be built. """
+
+        record = {'ebook': ebook, 'type': type_, 'status': 'skipped', 'reason': reason}
+        record.update(fields)
+        self.write(record)
+
+
+    def group(self, group):
+        """ Record the jobs of a group. """
+
+        self.groups += 1
+        for job in group.job_queue:
+            size = getattr(job, 'input_size', None)
+            seconds = round(estimate_seconds(self.timing, job.type, size), 1)
+            self.jobs += 1
+            self.seconds += seconds
+            self.write({
+                'ebook': job.ebook,
+                'type': job.type,
+                'status': 'planned',
+                'reason': getattr(job, 'build_reason', None),
+                'group': self.groups,
+                'candidate': getattr(job, 'candidate', None),
+                'size': size,
+                'memory': getattr(job, 'memory', None),
+                'seconds': seconds,
+                'job': {name: getattr(job, name, None) for name in JOB_FIELDS},
+            })
+
+
+    def close(self):
+        """ Close the file. """
+
+        self.fp.close()
+
+
+def job_from_record(record):
+    """ Make the job of a planned record. """
+
+    job = CommonCode.Job(record['type'])
+    job.ebook = record['ebook']
+    for name, value in record['job'].items():
+        if value is not None:
+            setattr(job, name, value)
+    return job
+
+
+def read_plan(path):
+    """ Read a plan.  Returns a list of (group, job) in plan order. """
+
+    plan = []
+    with open(path, 'r') as fp:
+        for line in fp:
+            record = json.loads(line)
+            if record.get('status') == 'planned':
+                plan.append((record['group'], job_from_record(record)))
+    return plan
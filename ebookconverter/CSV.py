@@ -10,6 +10,8 @@ from libgutenberg import GutenbergDatabase
 from libgutenberg.DublinCoreMapping import DublinCoreObject
 from libgutenberg.Models import Book
 
+from ebookconverter import Metrics
+
 
 FEEDS = os.getenv ('FEEDS') or ''
 CSV_FN = 'pg_catalog.csv'
@@ -35,9 +37,11 @@ def books():
                '; '.join([locc.id for locc in dc.loccs]),
                '; '.join([shelf.bookshelf for shelf in dc.bookshelves]),
               ]
+        Metrics.inc('books_processed_total')
         yield row
 
 
+@Metrics.instrument('make_csv')
 def main():
     fn = os.path.join(FEEDS, CSV_FN)
     with open(fn, 'w', newline='') as csvfile:
@@ -13,8 +13,12 @@ Utility class to find candidate files for conversion operations.
 
 """
 
-import os.path
 import fnmatch
+import functools
+import os.path
+import re
+
+from sqlalchemy import not_, select
 
 from libgutenberg import GutenbergDatabase
 from libgutenberg import GutenbergGlobals as gg
@@ -31,16 +35,31 @@ class Candidates(object):
     def read_from_database(self, ebook):
         """ Read candidates from PG database. """
 
-        candidates = []
+        return self.read_many([ebook]).get(ebook, [])
+
+
+    def read_many(self, ebooks):
+        """ Read candidates for many ebooks in one query.
+
+        Returns a dict ebook -> list of candidates.
+
+        """
+
+        result = {ebook: [] for ebook in ebooks}
+        if not result:
+            return result
+
         session = ob.get_session()
         files = session.query(File).filter(
-            File.fk_books == ebook,
+            File.fk_books.in_(list(result)),
             File.compression == 'none',
             File.diskstatus == 0,
             File.obsoleted == 0
-        ).order_by(File.fk_filetypes, File.fk_encodings, File.modified.desc())
+        ).order_by(File.fk_books, File.fk_filetypes, File.fk_encodings, File.modified.desc())
 
+        adirs = {}
         for file_ in files:
+            ebook = file_.fk_books
             if (ebook > 10000 and file_.file_type == 'html'
                 and not os.path.basename(file_.archive_path).startswith(str(ebook))):
                 # must have the form 12345-h.htm (not eg. glossary.htm)
@@ -48,16 +67,50 @@ class Candidates(object):
             if file_.file_type is None:
                 continue
 
-            adir = gg.archive_dir(ebook)
-            if file_.archive_path.startswith(adir):
-                file_.archive_path = file_.archive_path.replace(adir, 'files/%d' % ebook)
-            elif file_.archive_path.startswith('etext'):
-                file_.archive_path = 'dirs/' + file_.archive_path
+            if ebook not in adirs:
+                adirs[ebook] = gg.archive_dir(ebook)
+            file_.archive_path = local_path(ebook, file_.archive_path, adirs[ebook])
 
             file_.format = "%s/%s" % (file_.fk_filetypes, file_.encoding or 'unknown')
-            candidates.append(file_)
+            result[ebook].append(file_)
+
+        return result
+
 
-        return candidates
+    def newest_sources(self, ebooks):
+        """ Find the newest posted file of each format of many ebooks, in one query.
+
+        Returns a dict ebook -> format -> (modified time, archive path)
+        of the newest file of that format, the one read_many puts first.
+
+        """
+
+        ebooks = set(ebooks)
+        if not ebooks:
+            return {}
+
+        session = ob.get_session()
+        rows = session.execute(select(
+            File.fk_books, File.fk_filetypes, File.fk_encodings, File.modified, File.archive_path
+        ).where(
+            File.fk_books.between(min(ebooks), max(ebooks)),
+            File.fk_filetypes.isnot(None),
+            File.compression == 'none',
+            File.diskstatus == 0,
+            File.obsoleted == 0,
+            not_(File.archive_path.regexp_match('^cache/')),
+        ).distinct(
+            File.fk_books, File.fk_filetypes, File.fk_encodings
+        ).order_by(
+            File.fk_books, File.fk_filetypes, File.fk_encodings, File.modified.desc()
+        ))
+
+        result = {}
+        for ebook, filetype, encoding, modified, path in rows:
+            if ebook in ebooks:
+                result.setdefault(ebook, {})["%s/%s" % (filetype, encoding or 'unknown')] = (
+                    modified, local_path(ebook, path, gg.archive_dir(ebook)))
+        return result
 
 
     @staticmethod
@@ -74,12 +127,79 @@ class Candidates(object):
 
         """
 
-        result = []
+        return CandidateIndex(candidates, f).filter_sort(typeglob_list)
 
-        for typeglob in typeglob_list:
-            for candidate in candidates:
-                if fnmatch.fnmatch(f(candidate), typeglob):
-                    if candidate not in result:
-                        result.append(candidate)
 
-        return result
+def local_path(ebook, archive_path, adir):
+    """ The path of a posted file as the converter finds it, see Maker.build_inputs. """
+
+    if archive_path.startswith(adir):
+        return archive_path.replace(adir, 'files/%d' % ebook)
+    if archive_path.startswith('etext'):
+        return 'dirs/' + archive_path
+    return archive_path
+
+
+@functools.lru_cache(maxsize=None)
+def compile_typeglobs(typeglob_list):
+    """ Compile a tuple of typeglobs into match functions. """
+
+    return tuple(re.compile(fnmatch.translate(typeglob)).match for typeglob in typeglob_list)
+
+
+class CandidateIndex(object):
+    """ One ebook's candidates, bucketed by format.
+
+    Answers repeated filter_sort queries without rescanning the list;
+    results are memoized per typeglob tuple until a candidate of a
+    matching format is added.
+
+    """
+
+    def __init__(self, candidates, f):
+        self.f = f
+        self.candidates = {} # position -> candidate
+        self.buckets = {}    # format -> positions
+        self.memo = {}
+        self.first = 0
+        for position, candidate in enumerate(candidates):
+            self._add(position, candidate)
+
+
+    def _add(self, position, candidate):
+        format_ = self.f(candidate)
+        self.candidates[position] = candidate
+        self.buckets.setdefault(format_, []).append(position)
+        # only the results the new candidate belongs in are out of date
+        for typeglob_list in [typeglob_list for typeglob_list in self.memo
+                              if any(match(format_)
+                                     for match in compile_typeglobs(typeglob_list))]:
+            del self.memo[typeglob_list]
+
+
+    def insert(self, candidate):
+        """ Insert a candidate in front of all others. """
+
+        self.first -= 1
+        self._add(self.first, candidate)
+
+
+    def filter_sort(self, typeglob_list):
+        """ Return the candidates matching typeglob_list in preference order. """
+
+        typeglob_list = tuple(typeglob_list)
+        if typeglob_list not in self.memo:
+            result = []
+            seen = set()
+            for match in compile_typeglobs(typeglob_list):
+                positions = sorted(position
+                                   for format_, positions in self.buckets.items()
+                                   if match(format_)
+                                   for position in positions)
+                for position in positions:
+                    if position not in seen:
+                        seen.add(position)
+                        result.append(self.candidates[position])
+            self.memo[typeglob_list] = result
+
+        return list(self.memo[typeglob_list])
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: UTF8 -*-
+
+"""
+ConversionLog.py
+
+Copyright 2026 by Project Gutenberg
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+One JSON record per (ebook, type) that a conversion run made or
+skipped, one file per run.  A record has:
+
+  time         when the record was written
+  ebook, type
+  status       done, failed, timeout, crashed or skipped
+  reason       why a type was skipped
+  seconds      wall time of the job
+  cpu          cpu time of the job, converters included
+  peak_rss     peak memory of the worker during the job, in bytes
+  input_size   size of the file the job was built from
+  output_size  size of the file built
+
+Use ConversionReport to sum them up.
+
+"""
+
+import datetime
+import glob
+import json
+import os
+
+PRIVATE = os.getenv('PRIVATE') or ''
+LOG_DIR = os.path.join(PRIVATE, 'logs', 'conversions')
+
+
+def default_path(run_id=None):
+    """ The file for a run: named after the run id or the start time. """
+
+    name = run_id or datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+    return os.path.join(LOG_DIR, name + '.jsonl')
+
+
+def latest_path():
+    """ The file of the latest run, or None. """
+
+    paths = glob.glob(os.path.join(LOG_DIR, '*.jsonl'))
+    return max(paths, key=os.path.getmtime) if paths else None
+
+
+def recent_paths(n=10):
+    """ The files of the latest n runs, newest first. """
+
+    paths = glob.glob(os.path.join(LOG_DIR, '*.jsonl'))
+    return sorted(paths, key=os.path.getmtime, reverse=True)[:n]
+
+
+class ConversionLog():
+    """ Append records to a file. """
+
+    def __init__(self, path):
+        self.path = path
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.fp = open(path, 'a', buffering=1)
+
+
+    def record(self, ebook, type_, status, **fields):
+        """ Write one record. """
+
+        record = {
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'ebook': ebook,
+            'type': type_,
+            'status': status,
+        }
+        record.update(fields)
+        self.fp.write(json.dumps(record) + '\n')
+
+
+    def close(self):
+        """ Close the file. """
+
+        self.fp.close()
+
+
+def read_records(paths):
+    """ Yield the records in the files. Lines that don't parse are skipped. """
+
+    for path in paths:
+        with open(path, 'r') as fp:
+            for line in fp:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    pass
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: UTF8 -*-
+
+"""
+ConversionReport.py
+
+Copyright 2026 by Project Gutenberg
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+Sums up the records written by ConversionLog: wall and cpu time per
+type, the slowest ebooks, failures and why types were skipped.
+
+"""
+
+import argparse
+import collections
+import math
+import sys
+
+from ebookconverter import ConversionLog
+
+
+def percentile(values, p):
+    """ Nearest-rank percentile of a sorted list. """
+
+    if not values:
+        return 0.0
+    return values[max(math.ceil(p / 100.0 * len(values)) - 1, 0)]
+
+
+def summarize(records):
+    """ Collect the numbers the report shows. """
+
+    summary = {
+        'types': collections.defaultdict(lambda: collections.defaultdict(list)),
+        'status': collections.Counter(),         # (type, status) -> n
+        'skipped': collections.Counter(),        # (type, reason) -> n
+        'ebook_seconds': collections.Counter(),  # ebook -> seconds
+        'failures': [],
+    }
+    for record in records:
+        type_ = record.get('type')
+        status = record.get('status')
+        summary['status'][type_, status] += 1
+        if status == 'skipped':
+            summary['skipped'][type_, record.get('reason', '')] += 1
+            continue
+        if status == 'dropped':
+            # not run, see EbookConverter.run_ebookmaker
+            continue
+        if status in ('failed', 'timeout', 'crashed'):
+            summary['failures'].append(record)
+        stats = summary['types'][type_]
+        for key in ('seconds', 'cpu', 'peak_rss'):
+            if record.get(key) is not None:
+                stats[key].append(record[key])
+        summary['ebook_seconds'][record.get('ebook')] += record.get('seconds') or 0.0
+
+    for stats in summary['types'].values():
+        for values in stats.values():
+            values.sort()
+    return summary
+
+
+def report(summary, top=20, fp=sys.stdout):
+    """ Print the report. """
+
+    statuses = sorted({status for dummy_type, status in summary['status']})
+
+    fp.write('%-16s %6s %8s %8s %8s %8s %8s%s\n' % (
+        'type', 'jobs', 'p50', 'p95', 'max', 'cpu p95', 'MB p95',
+        ''.join(' %8s' % status for status in statuses)))
+    for type_ in sorted({type_ for type_, dummy_status in summary['status']}):
+        stats = summary['types'].get(type_, {})
+        seconds = stats.get('seconds', [])
+        fp.write('%-16s %6d %8.1f %8.1f %8.1f %8.1f %8d%s\n' % (
+            type_,
+            len(seconds),
+            percentile(seconds, 50),
+            percentile(seconds, 95),
+            seconds[-1] if seconds else 0.0,
+            percentile(stats.get('cpu', []), 95),
+            percentile(stats.get('peak_rss', []), 95) // (1024 * 1024),
+            ''.join(' %8d' % summary['status'][type_, status] for status in statuses)))
+
+    fp.write('\nSlowest ebooks (seconds, all types):\n')
+    for ebook, seconds in summary['ebook_seconds'].most_common(top):
+        fp.write('%8d %10.1f\n' % (ebook, seconds))
+
+    if summary['skipped']:
+        fp.write('\nSkipped:\n')
+        for (type_, reason), n in sorted(summary['skipped'].items()):
+            fp.write('%-16s %6d  %s\n' % (type_, n, reason))
+
+    if summary['failures']:
+        fp.write('\nFailures:\n')
+        for record in summary['failures']:
+            fp.write('%8d %-16s %s\n' % (record['ebook'], record['type'], record['status']))
+
+
+def main():
+    """ Main program. """
+
+    ap = argparse.ArgumentParser(description='Sum up ebookconverter conversion records.')
+    ap.add_argument(
+        "files",
+        nargs   = "*",
+        metavar = "FILE",
+        help    = "conversion record files (default: the latest in %s)" % ConversionLog.LOG_DIR)
+
+    ap.add_argument(
+        "--top",
+        metavar = "N",
+        dest    = "top",
+        type    = int,
+        default = 20,
+        action  = "store",
+        help    = "list the N slowest ebooks (default: 20)")
+
+    args = ap.parse_args()
+    paths = args.files
+    if not paths:
+        latest = ConversionLog.latest_path()
+        if latest is None:
+            sys.stderr.write('No conversion records in %s\n' % ConversionLog.LOG_DIR)
+            return 1
+        paths = [latest]
+
+    report(summarize(ConversionLog.read_records(paths)), args.top)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
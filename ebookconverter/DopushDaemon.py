@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: UTF8 -*-
+
+"""
+DopushDaemon.py
+
+Copyright 2026 by Project Gutenberg
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+Does what cron-dopush.sh does, as soon as a posting arrives: watches
+FileInfo.DOPUSH_LOG_DIR for .trig files, scans the files of each new
+ebook into the database and converts it, all in one long-running
+process that keeps its database connections and its EbookWorker.
+
+Takes the options of ebookconverter (--build defaults to all) and
+--poll.  Uses inotify if the inotify_simple package is installed, else
+looks at the directory every --poll seconds.
+
+The .trig files are gone once an ebook is scanned: ebooks not converted
+when stopped or on an error are put in the rebuild queue (see
+WorkQueue), for AutoRebuild or the next ebookconverter run to build.
+
+"""
+
+import argparse
+import configparser
+import datetime
+import os
+import signal
+import sys
+import time
+
+import setproctitle
+import sqlalchemy
+
+from libgutenberg.Logger import debug, error, exception, info
+
+from ebookconverter import BookIndex, ConversionLog, EbookConverter, FileInfo, Metrics
+from ebookconverter import WorkQueue
+from ebookconverter.EbookConverter import options
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+# look at the directory at least this often, even with inotify
+HEARTBEAT = 300
+# wait for more postings for this long after the first one
+SETTLE = 2
+# check for signals this often
+SLICE = 5
+# of the rebuild requests for ebooks not converted, like AutoRebuild's
+PRIORITY = 10
+
+
+def wait_for_postings(inotify, poll):
+    """ Return when a tag file may have arrived or a stop was requested. """
+
+    timeout = HEARTBEAT if inotify else poll
+    deadline = time.monotonic() + timeout
+    while not EbookConverter.stop_requested.is_set():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        if inotify is None:
+            EbookConverter.stop_requested.wait(min(SLICE, remaining))
+            continue
+        if inotify.read(timeout=int(min(SLICE, remaining) * 1000)):
+            # a posting usually comes with more
+            while inotify.read(timeout=SETTLE * 1000):
+                pass
+            return
+
+
+def requeue(ebooks):
+    """ Ask for a rebuild of the posted ebooks we did not convert. """
+
+    error("Not converted, queued for rebuilding: %s" %
+          EbookConverter.pretty_print_list(ebooks))
+    try:
+        WorkQueue.WorkQueue(WorkQueue.REBUILD_QUEUE).enqueue(
+            ebooks, PRIORITY, options.build, 'dopush')
+    except (WorkQueue.NoDatabase, sqlalchemy.exc.DBAPIError) as what:
+        exception(what)
+
+
+@Metrics.instrument('dopushd')
+def dopush(book_index):
+    """ Scan and convert the ebooks posted since the last call. """
+
+    ebooks = []
+    FileInfo.scan_dopush_log(ebooks)
+    if not ebooks:
+        return 0
+
+    info("Posted: %s" % EbookConverter.pretty_print_list(ebooks))
+    done = None
+    try:
+        book_index.refresh()
+        options.range = ebooks
+        EbookConverter.conversion_log = ConversionLog.ConversionLog(
+            options.records or ConversionLog.default_path(
+                datetime.date.today().strftime('dopushd-%Y%m%d')))
+        done = EbookConverter.convert(book_index)
+    finally:
+        # like EbookConverter.convert_claimed
+        if done is None:
+            left = ebooks
+        elif EbookConverter.out_of_time():
+            left = sorted(set(ebooks) - set(done))
+        else:
+            left = []
+        if left:
+            requeue(left)
+        if EbookConverter.conversion_log:
+            EbookConverter.conversion_log.close()
+            EbookConverter.conversion_log = None
+    return 0
+
+
+def main():
+    """ Main program. """
+
+    ap = argparse.ArgumentParser(add_help=False)
+    ap.add_argument(
+        "--poll",
+        metavar = "SECONDS",
+        dest    = "poll",
+        type    = int,
+        default = 60,
+        action  = "store",
+        help    = "without inotify, look for postings every SECONDS seconds")
+    args, sys.argv[1:] = ap.parse_known_args()
+
+    # an ebookconverter run with the default pid file must not stop us
+    sys.argv[1:1] = ['--pidfile=/tmp/dopushd.pid']
+    try:
+        EbookConverter.config()
+    except configparser.Error as what:
+        error("Error in configuration file: %s", str(what))
+        return 1
+
+    EbookConverter.setup_logging()
+
+    if not EbookConverter.write_pidfile():
+        info("Not running: pidfile exists.")
+        return 2
+
+    if not options.build and not options.make:
+        options.build = ['all']
+    options.persistent_worker = True
+    EbookConverter.resolve_types()
+
+    signal.signal(signal.SIGTERM, EbookConverter.request_stop)
+    signal.signal(signal.SIGINT, EbookConverter.request_stop)
+
+    inotify = None
+    if INotify is not None:
+        inotify = INotify()
+        inotify.add_watch(FileInfo.DOPUSH_LOG_DIR,
+                          flags.CREATE | flags.CLOSE_WRITE | flags.MOVED_TO)
+        info("Watching %s" % FileInfo.DOPUSH_LOG_DIR)
+    else:
+        info("inotify_simple not installed: looking at %s every %d seconds" %
+             (FileInfo.DOPUSH_LOG_DIR, args.poll))
+
+    book_index = BookIndex.BookIndex()
+    try:
+        while not EbookConverter.stop_requested.is_set():
+            setproctitle.setproctitle("dopushd: converting")
+            try:
+                dopush(book_index)
+            except EbookConverter.StopConversion:
+                pass
+            except Exception as what:
+                # keep serving
+                exception(what)
+            setproctitle.setproctitle("dopushd: waiting")
+            debug("Waiting for postings")
+            wait_for_postings(inotify, args.poll)
+
+    except KeyboardInterrupt:
+        error("User interrupt")
+
+    finally:
+        for worker in EbookConverter.persistent_workers:
+            worker.close()
+        if inotify is not None:
+            inotify.close()
+        os.remove(options.pidfile)
+
+    info("Program end")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
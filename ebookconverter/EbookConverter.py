@@ -15,29 +15,38 @@ out which files to convert, then passes them to Ebookmaker.
 
 import argparse
 import collections
+import concurrent.futures
 import configparser
 import datetime
+import hashlib
 import itertools
+import json
 import logging
 import os
-import subprocess
+import queue
+import signal
 import sys
+import threading
+import time
 
-from six.moves import urllib, cPickle
+from six.moves import urllib
 import setproctitle
 
 import sqlalchemy
 
 from libgutenberg import DBUtils, Logger
-from libgutenberg.GutenbergFiles import remove_file_from_database, store_file_in_database
+from libgutenberg.GutenbergFiles import remove_file_from_database
 from libgutenberg.GutenbergGlobals import Struct
 from libgutenberg.Logger import critical, info, debug, warning, error, exception
 
 
 from ebookmaker import CommonCode
 from ebookmaker.CommonCode import Options
+from ebookmaker.Version import VERSION as EBOOKMAKER_VERSION
 
-from ebookconverter import Candidates, Notifier
+from ebookconverter import BookIndex, BuildPlan, Candidates, ConversionLog, EbookWorker, Notifier
+from ebookconverter import EbookLocks, FileRegistry, MetadataRefresh, Metrics, RunJournal
+from ebookconverter import WorkQueue
 from ebookconverter.Version import VERSION
 
 options = Options()
@@ -119,6 +128,7 @@ FILENAMES = {
     'qrcode':           'pg{id}.qrcode.png',
     'zip':              'pg{id}-h.zip',
     'logfile':          'pg{id}.converter.log',      # .converter because of latex log conflicts
+    'manifest':         'pg{id}.manifest.json',      # source of each output, see Maker.build_inputs
 }
 GENERIC_FILENAME = 'pg{id}.generic'
 
@@ -126,6 +136,8 @@ DEPENDENCIES = collections.OrderedDict((
     ('everything',      ('all', 'kindle.noimages','facebook', 'bluesky', 'mastodon', 'update', 'summary')),
     ('all',             ('html', 'epub', 'kindle', 'epub3', 'kf8', 'pdf', 'txt', 'rst',
                          'cover', 'qrcode', 'rdf', 'readability')),
+    # outputs up to date get the new title and authors, see Maker.refresh
+    ('metadata',        ('rdf', 'cover')),
     ('html',            ('html.images',)),
     ('epub',            ('epub.images',    'epub.noimages')),
     ('epub3',           ('epub3.images',)),
@@ -144,6 +156,7 @@ DEPENDENCIES = collections.OrderedDict((
 ))
 
 BUILD_ORDER = """
+metadata
 picsdir.images picsdir.noimages
 rst.gen
 txt.utf-8
@@ -158,19 +171,137 @@ update summary readability
 null
 """.split()
 
+# type -> types whose output it is built from: the edges of the per-ebook build DAG
+PREREQUISITES = collections.defaultdict(set)
+for _type, _deps in DEPENDENCIES.items():
+    if _type in BUILD_ORDER:
+        PREREQUISITES[_type].update(_deps)
+for _type, _dep in EbookWorker.DERIVED_FROM.items():
+    PREREQUISITES[_type].add(_dep)
+
 MAX_CANDIDATE_SIZE = {'epub': 16, 'epub3': 16, 'kindle': 16, 'kf8': 16}
 
+# rough peak memory of a job as a multiple of the size of its input
+COST_FACTOR = {'txt': 2, 'html': 3, 'epub': 4, 'epub3': 4, 'kindle': 4, 'kf8': 4, 'pdf': 6}
+JOB_COST = 256 * 1024   # a job with no sizable input
+IMAGE_COST = 64 * 1024  # per image, on top of its size
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.svg')
+WORKER_RSS = 200 * 1024 * 1024 # an idle EbookWorker
+
 def make_output_filename(type_, ebook = 0):
     """ Make a suitable filename for output type. """
 
     return FILENAMES.get(type_, GENERIC_FILENAME).format(id = ebook)
 
 
+def file_digest(path):
+    """ Return (size, sha256 hexdigest) of a file. """
+
+    sha = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            sha.update(chunk)
+            size += len(chunk)
+    return size, sha.hexdigest()
+
+
+def image_stats(path, max_depth=3):
+    """ Return (count, total size) of the image files below path. """
+
+    count = size = 0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if max_depth > 1:
+                        sub_count, sub_size = image_stats(entry.path, max_depth - 1)
+                        count += sub_count
+                        size += sub_size
+                elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    count += 1
+                    size += entry.stat().st_size
+    except OSError:
+        pass
+    return count, size
+
+
+def scan_dir(path):
+    """ Return the entries of a directory as a dict name -> os.DirEntry.
+
+    Empty if the directory cannot be read.
+
+    """
+
+    try:
+        with os.scandir(path) as entries:
+            return {entry.name: entry for entry in entries}
+    except OSError:
+        return {}
+
+
+# the build inputs that tell which file, in which state, an output was built from
+SOURCE_INPUTS = ('source', 'size', 'sha256')
+# the build inputs that tell which programs built it (compared only with --upgrade)
+VERSION_INPUTS = ('ebookmaker', 'ebookconverter')
+
+def same_inputs(built_from, build_inputs):
+    """ True if an output built from built_from need not be built again
+    from build_inputs. """
+
+    if not build_inputs:
+        return False
+    names = SOURCE_INPUTS + (VERSION_INPUTS if options.upgrade else ())
+    return all(built_from.get(name) == build_inputs.get(name) for name in names)
+
+
+def read_manifest(outputdir, ebook):
+    """ Read the build manifest of an ebook.
+
+    A dict type -> build inputs, and 'peak_rss': a dict type -> peak
+    RSS of the last build in bytes.
+
+    """
+
+    fn = os.path.join(outputdir, make_output_filename('manifest', ebook))
+    try:
+        with open(fn, 'r') as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+
+def update_manifest(job, rebuilt=True, peak_rss=0):
+    """ Record the inputs a job was just built from and the memory it needed. """
+
+    fn = os.path.join(job.outputdir, make_output_filename('manifest', job.ebook))
+    if options.shadow:
+        debug('if not in shadow, would have updated %s.', fn)
+        return
+    manifest = read_manifest(job.outputdir, job.ebook)
+    if rebuilt:
+        manifest[job.type] = job.build_inputs
+    if peak_rss:
+        manifest.setdefault('peak_rss', {})[job.type] = peak_rss
+    with open(fn + '.tmp', 'w') as fp:
+        json.dump(manifest, fp, indent=1, sort_keys=True)
+    os.replace(fn + '.tmp', fn)
+
+
 class Maker():
     """ Helper class """
 
-    def __init__(self, ebook):
+    def __init__(self, ebook, book_index=None):
         self.ebook = ebook
+        self.book_index = book_index
+        self.manifest = None
+        self.digests = {} # path -> (size, sha256)
+        self.images = {}  # dir -> (count, size)
+        self.dirs = {}    # dir -> name -> os.DirEntry
+        self.dc = None
+        self.patched = set() # types whose output got the new metadata
+        self.source_size = 0
+        self.cost = 0
 
 
     def get_cache_dir(self):
@@ -181,17 +312,108 @@ class Maker():
         """ return the cache loc for this ebook """
         return os.path.join(options.config.CACHELOC, "%d" % self.ebook)
 
+    def lookup(self, path):
+        """ The os.DirEntry of path, or None if there is no such file.
+
+        Each directory is read once per book, so asking about many
+        files in the cache and the source directories costs one
+        scandir each instead of a stat per question.
+
+        """
+
+        dirname, name = os.path.split(path)
+        if dirname not in self.dirs:
+            self.dirs[dirname] = scan_dir(dirname)
+        return self.dirs[dirname].get(name)
+
+    def build_inputs(self, candidate):
+        """ Describe what an output built from candidate depends on.
+
+        Two builds with equal build inputs produce the same output, so
+        should_do_job can skip a type whose inputs are unchanged (see
+        same_inputs).  Hashes the source, once per file.
+
+        """
+
+        if candidate is None or candidate.generated:
+            return None
+
+        path = os.path.join(options.config.FILESDIR, candidate.archive_path)[7:]
+        if path not in self.digests:
+            try:
+                self.digests[path] = file_digest(path)
+            except OSError:
+                return None
+        size, sha256 = self.digests[path]
+
+        return {
+            'source': candidate.archive_path,
+            'size': size,
+            'sha256': sha256,
+            'ebookmaker': EBOOKMAKER_VERSION,
+            'ebookconverter': VERSION,
+        }
+
+    def estimate_cost(self, job, candidate):
+        """ Guess how much memory job will need, in bytes. """
+
+        if candidate is None:
+            return JOB_COST
+        if candidate.generated:
+            # built from the output of another job: assume it is the size of the source
+            size = self.source_size
+        else:
+            size = candidate.extent or 0
+            self.source_size = max(self.source_size, size)
+            if job.subtype == '.images':
+                path = os.path.join(options.config.FILESDIR,
+                                    os.path.dirname(candidate.archive_path))[7:]
+                if path not in self.images:
+                    self.images[path] = image_stats(path)
+                count, image_size = self.images[path]
+                size += image_size + count * IMAGE_COST
+        return JOB_COST + size * COST_FACTOR.get(job.maintype, 1)
+
+
+    def predict_memory(self, job, cost):
+        """ Predict the peak RSS of the worker running job, in bytes.
+
+        Use what the last build of this type needed, else the estimated
+        cost.
+
+        """
+
+        recorded = self.get_manifest().get('peak_rss', {}).get(job.type)
+        return recorded or WORKER_RSS + cost
+
+
+    def is_not_text(self):
+        """ True if the ebook is not a text book. """
+
+        if self.book_index is None:
+            return DBUtils.is_not_text(self.ebook)
+        return self.ebook in self.book_index.not_text
+
+    def get_manifest(self):
+        """ The build manifest of this ebook. """
+
+        if self.manifest is None:
+            self.manifest = read_manifest(self.get_cache_dir(), self.ebook)
+        return self.manifest
+
     def should_do_job(self, job, candidate):
         """ 
-        Return True if outputfile newer than candidate exists
-        and the candidate exists or if no candidate needed
+        Return True if the job's output is missing or was built from
+        other inputs, and the candidate exists or if no candidate needed
         """
         if len(PREFERRED_INPUT_FORMATS.get(job.type, {})) == 0:
             # doesn't need a source file
+            job.build_reason = 'no source needed'
             return True
  
         if not candidate:
             # happens if the candidates are too large
+            job.skip_reason = 'no candidate'
             return False
 
         if candidate.generated:
@@ -199,47 +421,117 @@ class Maker():
         else:
             candidate_path = os.path.join(options.config.FILESDIR, candidate.archive_path)
                    
-        if not candidate.generated and not os.path.exists(candidate_path[7:]):
+        if not candidate.generated and self.lookup(candidate_path[7:]) is None:
             warning('expected file %s not found. job skipped.', candidate_path[7:])
+            job.skip_reason = 'source file not found'
             return False
 
-        path = os.path.join(job.outputdir, job.outputfile)
+        entry = self.lookup(os.path.join(job.outputdir, job.outputfile))
+
+        if entry is not None and entry.is_file():
+            job.old_mtime = entry.stat().st_mtime
+            built_from = self.get_manifest().get(job.type)
 
-        if os.path.isfile(path):
-            mtime_cand = candidate.modified
-            mtime_epub = datetime.datetime.fromtimestamp(os.path.getmtime(path))
+            if built_from is None:
+                # built before we kept a manifest
+                mtime_cand = candidate.modified
+                mtime_epub = datetime.datetime.fromtimestamp(job.old_mtime)
 
-            debug('mtime cand:  %s' % mtime_cand)
-            debug('mtime dest:  %s' % mtime_epub)
+                debug('mtime cand:  %s' % mtime_cand)
+                debug('mtime dest:  %s' % mtime_epub)
+
+                up_to_date = mtime_cand < mtime_epub
+                reason = 'target newer than candidate'
+            else:
+                up_to_date = same_inputs(built_from, self.build_inputs(candidate))
+                reason = 'built from unchanged source'
 
-            if mtime_cand < mtime_epub:
+            if up_to_date:
                 if job.type in options.build:
                     info('Making   %s: user requested build.' % job.outputfile)
+                    job.build_reason = 'user requested build'
                     return True
-                info('Skipping %s: target newer than candidate.' % job.outputfile)
+                info('Skipping %s: %s.' % (job.outputfile, reason))
+                job.skip_reason = reason
                 return False
 
             info('Making   %s: target out of date.' % job.outputfile)
+            job.build_reason = 'target out of date'
             return True
 
         info('Making   %s: does not exist.' % job.outputfile)
+        job.build_reason = 'does not exist'
         return True
 
 
+    def refresh(self, job):
+        """ Put the new title and authors into the up-to-date output of job.
+
+        The outputs of MetadataRefresh.PATCHABLE are patched in place.
+        The types of MetadataRefresh.REBUILT are built again, from the
+        patched output if they are built from the output of another
+        type (see EbookWorker.DERIVED_FROM).  Returns True if the job
+        has to run after all.
+
+        """
+
+        if not hasattr(job, 'old_mtime'):
+            # skipped for want of a source, not because it is up to date
+            return False
+
+        if job.type in MetadataRefresh.REBUILT:
+            derived_from = EbookWorker.DERIVED_FROM.get(job.type)
+            if derived_from in self.patched:
+                job.derived_url = os.path.join(
+                    job.outputdir, make_output_filename(derived_from, self.ebook))
+            info('Making   %s: metadata changed.' % job.outputfile)
+            job.build_reason = 'metadata changed'
+            return True
+
+        if job.type not in MetadataRefresh.PATCHABLE:
+            return False
+        if options.dry_run:
+            info('Would patch %s: metadata changed.' % job.outputfile)
+            return False
+
+        start = time.time()
+        path = os.path.join(job.outputdir, job.outputfile)
+        try:
+            if self.dc is None:
+                self.dc = MetadataRefresh.load_dc(self.ebook)
+            if job.type == 'html.images':
+                data = MetadataRefresh.patch_html(path, self.dc)
+                zipfilename = os.path.join(job.outputdir, make_output_filename('zip', self.ebook))
+                if self.lookup(zipfilename) is not None:
+                    MetadataRefresh.rewrite_members(zipfilename, {job.outputfile: data})
+                    add_file_to_db(zipfilename, None, self.ebook)
+            else:
+                MetadataRefresh.patch_epub(path, self.dc)
+        except Exception as what:
+            exception(what)
+            info('Making   %s: cannot patch metadata.' % job.outputfile)
+            job.build_reason = 'metadata patch failed'
+            return True
+
+        info('Patched  %s: metadata changed.' % job.outputfile)
+        add_file_to_db(path, job.type, self.ebook)
+        self.patched.add(job.type)
+        log_conversion(self.ebook, job.type, 'patched', seconds=round(time.time() - start, 2))
+        return False
+
+
     def remove_type(self, type_):
         """ Remove file for type. """
 
         fn = os.path.join(self.get_cache_dir(), make_output_filename(type_, self.ebook))
-        try:
-            os.remove(fn)
-            debug("Removed file from disk: %s" % fn)
-        except OSError:
-            pass
-        try:
-            os.remove(fn + '.gz')
-            debug("Removed file from disk: %s.gz" % fn)
-        except OSError:
-            pass
+        for path in (fn, fn + '.gz'):
+            if self.lookup(path) is None:
+                continue
+            try:
+                os.remove(path)
+                debug("Removed file from disk: %s" % path)
+            except OSError:
+                pass
 
         fn = os.path.join(self.get_cache_loc(), make_output_filename(type_, self.ebook))
 
@@ -250,16 +542,30 @@ class Maker():
             debug("Removed file from database: %s" % fn)
 
 
-    def mk_job_queue(self):
-        """ Make job queue for one ebook. """
+    def mk_job_queue(self, all_candidates=None):
+        """ Make job queue for one ebook.
+
+        all_candidates: the ebook's candidates if already read from the
+        database (see Candidates.read_many)
+
+        """
 
         cf = Candidates.Candidates()
-        all_candidates = cf.read_from_database(self.ebook)
+        if all_candidates is None:
+            all_candidates = cf.read_from_database(self.ebook)
         job_queue = []
         f = lambda x: x.format
         debug("All Candidates: %s" % ' '.join(map(f, all_candidates)))
 
+        # the same typeglob tuples are asked for by many types
+        index = Candidates.CandidateIndex(all_candidates, f)
+        posted = Candidates.CandidateIndex([c for c in all_candidates if not c.generated], f)
+
+        refresh = 'metadata' in options.build
         for type_ in options.make:
+            if type_ == 'metadata':
+                # not a job of its own
+                continue
             debug("Trying: %s ..." % type_)
 
             candidate_types = PREFERRED_INPUT_FORMATS.get(type_, {})
@@ -269,25 +575,25 @@ class Maker():
             job.outputfile = make_output_filename(type_, self.ebook)
             job.logfile = make_output_filename('logfile', self.ebook)
 
-            candidates = all_candidates[:]
-
-            if type_ in EXCLUSIONS and cf.filter_sort(
-                    EXCLUSIONS[type_], [c for c in candidates if not c.generated], f):
+            if type_ in EXCLUSIONS and posted.filter_sort(EXCLUSIONS[type_]):
                 info('%s is already posted.' % type_)
+                log_conversion(self.ebook, type_, 'skipped', reason='already posted')
                 if not options.dry_run:
                     self.remove_type(type_)
                 continue
 
             candidate = None
             if len(candidate_types) > 0:
-                if DBUtils.is_not_text(self.ebook) and job.maintype != 'cover':
+                if self.is_not_text() and job.maintype != 'cover':
                     info("Book is not a text book. Skipping %s ..." % type_)
+                    log_conversion(self.ebook, type_, 'skipped', reason='not a text book')
                     continue
 
-                candidates = cf.filter_sort(candidate_types, candidates, f)
+                candidates = index.filter_sort(candidate_types)
 
                 if not candidates:
                     info('No input file found for type: %s' % type_)
+                    log_conversion(self.ebook, type_, 'skipped', reason='no input file')
                     if not options.dry_run:
                         self.remove_type(type_) # clean leftovers
                     continue
@@ -295,8 +601,13 @@ class Maker():
                 candidate = candidates[0]
                 # oom-killer safeguard
                 if candidate.extent > MAX_CANDIDATE_SIZE.get(job.maintype, 32) * 1024 * 1024:
-                    warning(f'Skipping {candidate.archive_path} for {type_}: file too big' )
-                    continue
+                    # only a memory budget keeps it from running with other big books
+                    if not (options.memory_limit and options.workers > 1):
+                        warning(f'Skipping {candidate.archive_path} for {type_}: file too big' )
+                        log_conversion(self.ebook, type_, 'skipped', reason='source too big',
+                                       input_size=candidate.extent)
+                        continue
+                    info(f'{candidate.archive_path} is big: {type_} will run with less company')
 
                 job.url = os.path.join(options.config.FILESDIR, candidate.archive_path)
                 info(f'type: {type_}; job.url: {job.url}' )
@@ -307,9 +618,18 @@ class Maker():
                 job.source = urllib.parse.urljoin(options.config.PGURL, candidate.archive_path)
                 job.opf_identifier = (urllib.parse.urljoin(
                     options.config.BIBREC + '/', str(self.ebook)))
+                job.candidate = candidate.archive_path
+                job.input_size = candidate.extent
 
-            if self.should_do_job(job, candidate):
+            if self.should_do_job(job, candidate) or (
+                    refresh and self.refresh(job)):
                 job_queue.append(job)
+                # not before: skipped types need no hash
+                job.build_inputs = self.build_inputs(candidate)
+                cost = self.estimate_cost(job, candidate)
+                self.cost += cost
+                job.cost = cost
+                job.memory = self.predict_memory(job, cost)
 
                 new_candidate = Struct()
                 new_candidate.archive_path = os.path.join(job.outputdir, job.outputfile)
@@ -317,30 +637,273 @@ class Maker():
                 new_candidate.modified = datetime.datetime.now()
                 new_candidate.extent = 0
                 new_candidate.generated = True
-                all_candidates.insert(0, new_candidate)
+                index.insert(new_candidate)
+            elif type_ not in self.patched:
+                log_conversion(self.ebook, type_, 'skipped',
+                               reason=getattr(job, 'skip_reason', 'up to date'))
 
         return job_queue
 
 
-def run_job_queue(job_queue):
-    def add_file_to_db(filename, filetype, ebook_no):
-        if os.access(filename, os.R_OK):
-            if options.shadow:
-                debug('if not in shadow, would have stored %s in database.', filename)
+def find_stale(ebooks, book_index, sources=None):
+    """ Find the outputs of options.make that should_do_job would build again.
+
+    Reads the newest posted file of each format of all ebooks in one
+    query (unless given as sources, see Candidates.newest_sources), and
+    the cache directory and build manifest of each ebook.  Types are
+    skipped as mk_job_queue would skip them; types without a known
+    output file are not checked.
+
+    Like should_do_job, an output is judged by the build inputs in the
+    manifest: it is stale if it was built from another file, or from a
+    file whose contents changed since, or with --upgrade by another
+    ebookmaker or ebookconverter version.  Sources are hashed only when their
+    modification time is newer than the output.  Outputs built before
+    we kept a manifest are judged by modification time.
+
+    Returns a dict ebook -> type -> 'missing', 'new version',
+    'other source', 'source changed' or 'source newer'.
+
+    """
+
+    types = [type_ for type_ in CommonCode.add_dependencies(
+        options.make + options.build, DEPENDENCIES, BUILD_ORDER) if type_ in FILENAMES]
+    if sources is None:
+        sources = Candidates.Candidates().newest_sources(ebooks)
+    versions = {'ebookmaker': EBOOKMAKER_VERSION, 'ebookconverter': VERSION}
+
+    stale = {}
+    for ebook in ebooks:
+        if ebook not in book_index.existing:
+            continue
+        candidates = []
+        for format_, (modified, archive_path) in sources.get(ebook, {}).items():
+            candidate = Struct()
+            candidate.format = format_
+            candidate.modified = modified
+            candidate.archive_path = archive_path
+            candidates.append(candidate)
+        index = Candidates.CandidateIndex(candidates, lambda x: x.format)
+        cachedir = os.path.join(options.config.CACHEDIR, str(ebook))
+        entries = scan_dir(cachedir)
+        manifest = None
+        digests = {} # path -> (size, sha256)
+
+        for type_ in types:
+            if type_ in EXCLUSIONS and index.filter_sort(EXCLUSIONS[type_]):
+                continue
+            source = None
+            if PREFERRED_INPUT_FORMATS.get(type_):
+                if ebook in book_index.not_text and not type_.startswith('cover.'):
+                    continue
+                found = index.filter_sort(PREFERRED_INPUT_FORMATS[type_])
+                if not found:
+                    continue
+                source = found[0]
+
+            entry = entries.get(make_output_filename(type_, ebook))
+            if entry is None:
+                stale.setdefault(ebook, {})[type_] = 'missing'
+                continue
+            if source is None:
+                continue
+
+            if manifest is None:
+                manifest = read_manifest(cachedir, ebook)
+            built_from = manifest.get(type_)
+            source_newer = source.modified and (
+                datetime.datetime.fromtimestamp(entry.stat().st_mtime) < source.modified)
+
+            if built_from is None:
+                # built before we kept a manifest
+                reason = 'source newer' if source_newer else None
+            elif options.upgrade and any(
+                    built_from.get(name) != version for name, version in versions.items()):
+                reason = 'new version'
+            elif built_from.get('source') != source.archive_path:
+                reason = 'other source'
+            elif source_newer:
+                # touched, but maybe not changed
+                path = os.path.join(options.config.FILESDIR, source.archive_path)[7:]
+                if path not in digests:
+                    try:
+                        digests[path] = file_digest(path)
+                    except OSError:
+                        # should_do_job skips it too
+                        digests[path] = None
+                digest = digests[path]
+                reason = 'source changed' if digest and digest != (
+                    built_from.get('size'), built_from.get('sha256')) else None
             else:
-                debug('adding %s to database.', filename)
-                store_file_in_database(ebook_no, filename, filetype)
-            mod_timestamp = datetime.datetime.fromtimestamp(os.path.getmtime(filename))
-            if datetime.date.today() - mod_timestamp.date() > datetime.timedelta(1):
-                critical('Failed to build new file: %s', filename)
-            for ext in ['.gz', '.gzip', '.utf8']:
-                if os.access(filename + ext, os.W_OK):
-                    os.remove(filename + ext)
-        elif '.generic' not in filename:
-            critical('Failed to build file: %s', filename)
+                reason = None
+
+            if reason:
+                stale.setdefault(ebook, {})[type_] = reason
+
+    return stale
+
+
+conversion_log = None
+plan_writer = None
+
+def log_conversion(ebook, type_, status, **fields):
+    """ Write a record to the run's ConversionLog, if any. """
+
+    if conversion_log:
+        conversion_log.record(ebook, type_, status, **fields)
+    if plan_writer and status == 'skipped':
+        plan_writer.skipped(ebook, type_, **fields)
+    Metrics.inc('jobs_total', type=type_, outcome=status)
+    if fields.get('seconds'):
+        Metrics.inc('job_seconds_total', fields['seconds'], type=type_)
+
+
+def local_size(url):
+    """ Size of a local file given as a path or file: url, or None. """
+
+    if not url:
+        return None
+    path = url[7:] if url.startswith('file://') else url
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+def finish_job(job, status):
+    """ Called in the main thread when a job is done. """
+
+    register_job(job, status)
+    log_conversion(
+        job.ebook, job.type, status['status'],
+        seconds=round(status['seconds'], 2),
+        cpu=round(status.get('cpu', 0.0), 2),
+        peak_rss=status.get('peak_rss'),
+        input_size=local_size(job.url),
+        output_size=local_size(os.path.join(job.outputdir, job.outputfile)))
+
+
+registry = FileRegistry.FileRegistry()
 
+def add_file_to_db(filename, filetype, ebook_no):
+    """ Register a freshly built file in the database.
 
-    """ Run EbookMaker for all jobs in the queue. """
+    The file is stored with the other files of its group when the
+    group is done (see finish_group).  Returns True if the file exists.
+
+    """
+
+    if os.access(filename, os.R_OK):
+        if options.shadow:
+            debug('if not in shadow, would have stored %s in database.', filename)
+        else:
+            debug('adding %s to database.', filename)
+            registry.add(ebook_no, filename, filetype)
+        mod_timestamp = datetime.datetime.fromtimestamp(os.path.getmtime(filename))
+        if datetime.date.today() - mod_timestamp.date() > datetime.timedelta(1):
+            critical('Failed to build new file: %s', filename)
+        for ext in ['.gz', '.gzip', '.utf8']:
+            if os.access(filename + ext, os.W_OK):
+                os.remove(filename + ext)
+        return True
+    elif '.generic' not in filename:
+        critical('Failed to build file: %s', filename)
+    return False
+
+
+def ebookmaker_params():
+    """ Ebookmaker command line options for a job queue run. """
+
+    verbosity = ''
+    if options.verbose:
+        verbosity = '-' + 'v' * options.verbose
+
+    ebm_params = [
+        verbosity,
+        "--extension-package", "ebookconverter.writers",
+        "--validate" if options.validate else None,
+        "--notify" if options.notify else None,
+        "--jobs", "no_such_url",
+    ]
+    return [prm for prm in ebm_params if prm]
+
+
+worker_local = threading.local()
+persistent_workers = []
+
+def get_worker():
+    """ Return the persistent EbookWorker of the calling thread. """
+
+    worker = getattr(worker_local, 'worker', None)
+    if worker is None:
+        worker = EbookWorker.WorkerProcess(ebookmaker_params(), options.worker_max_jobs)
+        worker_local.worker = worker
+        persistent_workers.append(worker)
+    return worker
+
+
+def requires(type_, other):
+    """ True if type_ is built, directly or not, from the output of other. """
+
+    todo = list(PREREQUISITES[type_])
+    seen = set()
+    while todo:
+        prerequisite = todo.pop()
+        if prerequisite == other:
+            return True
+        if prerequisite not in seen:
+            seen.add(prerequisite)
+            todo.extend(PREREQUISITES[prerequisite])
+    return False
+
+
+def group_deadline():
+    """ The time.monotonic() by which a group started now must be done. """
+
+    if options.group_timeout:
+        return time.monotonic() + options.group_timeout * 60
+    return None
+
+
+def keep_derived(done, jobs):
+    """ Have jobs built from the output of a job in done use that output. """
+
+    outputs = {(job.ebook, job.type): job for job in done}
+    for job in jobs:
+        built = outputs.get((job.ebook, EbookWorker.DERIVED_FROM.get(job.type)))
+        if built is not None and built.outputfile:
+            job.derived_url = os.path.join(os.path.abspath(built.outputdir), built.outputfile)
+
+
+def run_ebookmaker(job_queue, on_result, persistent=False, deadline=None):
+    """ Stream all jobs in the queue to an EbookWorker.
+
+    on_result(job, status) is called as each job is done.  Returns
+    False if any job was lost.  Does not touch the database, so it may
+    be called from a worker thread.
+
+    The worker's statuses tell which job it was on when it died or was
+    killed, so the rest of the queue goes to a new worker, less the
+    jobs that need the output of the bad job.  The jobs built from the
+    output of a job done by the old worker are pointed at that output
+    (see EbookWorker.run_job):
+
+    - a job that runs longer than --job-timeout is given up.
+    - a job that kills the worker is tried once more on its own, in
+      case the worker died of what earlier jobs left behind.  If it
+      kills that worker too, it gets status 'crashed'.
+
+    Past the deadline the rest of the queue is dropped.  The jobs not
+    run for want of time (dropped, or needing the output of a job that
+    timed out) get status 'dropped', so that they are retried with the
+    jobs that timed out (see RunJournal.read_timeouts).
+
+    persistent: use the calling thread's long-lived worker
+
+    """
+
+    if not job_queue:
+        return True
 
     for job in job_queue:
         try:
@@ -348,48 +911,290 @@ def run_job_queue(job_queue):
         except OSError: # directory exists
             pass
 
-    verbosity = ''
-    if options.verbose:
-        verbosity = '-' + 'v' * options.verbose
+    persistent = persistent or options.persistent_worker
+    if persistent:
+        worker = get_worker()
+    else:
+        worker = EbookWorker.WorkerProcess(ebookmaker_params())
+
+    def run(job_queue):
+        return worker.run(job_queue, on_result, options.job_timeout * 60, deadline)
+
+    def drop(jobs):
+        for job in jobs:
+            on_result(job, EbookWorker.job_status(job, 'dropped'))
 
+    debug("Calling EbookWorker ...")
+    complete = True
     try:
-        ebm_params = [
-            options.config.EBOOKMAKER, verbosity,
-            "--extension-package", "ebookconverter.writers",
-            "--validate" if options.validate else None,
-            "--notify" if options.notify else None,
-            "--jobs", "no_such_url",
-        ]
-        ebm_params = [prm for prm in ebm_params if prm]
-        ebm = subprocess.Popen(
-            ebm_params,
-            stdin  = subprocess.PIPE,
-            stdout = subprocess.PIPE,
-            stderr = subprocess.PIPE
-        )
-    except OSError as what:
-        error("%s %s" % (options.config.EBOOKMAKER, what))
-        raise
+        while job_queue:
+            if deadline is not None and time.monotonic() >= deadline:
+                critical('Group timeout: dropping %d jobs' % len(job_queue))
+                drop(job_queue)
+                return False
+            statuses = run(job_queue)
+            if len(statuses) == len(job_queue):
+                break
+            keep_derived([job for job, status in zip(job_queue, statuses)
+                          if status['status'] == 'done'], job_queue[len(statuses):])
+
+            timed_out = statuses and statuses[-1]['status'] == 'timeout'
+            if timed_out:
+                bad = job_queue[len(statuses) - 1]
+                rest = job_queue[len(statuses):]
+            else:
+                bad = job_queue[len(statuses)]
+                rest = job_queue[len(statuses) + 1:]
+                critical('returncode was %s on %s of #%d; trying it alone' %
+                         (worker.returncode, bad.type, bad.ebook))
+                retry = run([bad])
+                if retry and retry[0]['status'] != 'timeout':
+                    bad = None
+                elif not retry:
+                    on_result(bad, EbookWorker.job_status(bad, 'crashed'))
+                else:
+                    timed_out = True
+
+            if bad is None:
+                job_queue = rest
+            else:
+                complete = False
+                job_queue = [job for job in rest
+                             if job.ebook != bad.ebook or not requires(job.type, bad.type)]
+                if timed_out:
+                    drop([job for job in rest if job not in job_queue])
+    finally:
+        if not persistent:
+            worker.close()
+
+    return complete
+
+
+def register_job(job, status=None):
+    """ Add the files built for one job to the database.
+
+    status: the job's EbookWorker status, if any
+
+    """
+
+    if job.type == 'qrcode':
+        return
+    Logger.ebook = job.ebook
+    if status and status['status'] == 'timeout':
+        critical('Job timed out after %ds: %s' % (status['seconds'], job.type))
+        RunJournal.record_timeout(job, status['seconds'])
+        return
+    if status and status['status'] == 'dropped':
+        critical('Job dropped for want of time: %s' % job.type)
+        RunJournal.record_timeout(job, 0)
+        return
+    if status and status['status'] == 'crashed':
+        critical('Job crashed ebookmaker twice: %s' % job.type)
+        return
+    filename = os.path.join(job.outputdir, job.outputfile)
+    rebuilt = False
+    if add_file_to_db(filename, job.type, job.ebook) and getattr(job, 'build_inputs', None):
+        rebuilt = os.path.getmtime(filename) != getattr(job, 'old_mtime', None)
+    peak_rss = status.get('peak_rss', 0) if status and status['status'] == 'done' else 0
+    if rebuilt or peak_rss:
+        update_manifest(job, rebuilt, peak_rss)
+    if job.type == 'html.images':
+        zipfilename = os.path.join(job.outputdir, make_output_filename('zip', job.ebook))
+        # also add the zip
+        add_file_to_db(zipfilename, None, job.ebook)
 
-    debug("Calling Ebookmaker ...")
-    stdout, stderr = ebm.communicate(cPickle.dumps(job_queue))
-    info("Ebookmaker returned code: %d." % ebm.returncode)
-    debug(stdout.decode(sys.stdout.encoding))
-    debug(stderr.decode(sys.stderr.encoding))
-    if ebm.returncode == 0:
-        for job in job_queue:
-            if job.type == 'qrcode':
+
+def run_job_queue(job_queue, deadline=None):
+    """ Run EbookMaker for all jobs in the queue.
+
+    Each job's files are registered as soon as the job is done.
+
+    """
+
+    def on_result(job, status):
+        debug("%s %s in %.1fs" % (job.type, status['status'], status['seconds']))
+        finish_job(job, status)
+
+    run_ebookmaker(job_queue, on_result, deadline=deadline)
+
+
+def split_job_queue(job_queue):
+    """ Split a job queue into batches along the per-ebook build DAG.
+
+    Jobs of one ebook that are connected through PREREQUISITES stay in
+    one batch, in build order, so they run one after the other in the
+    same worker.  Unconnected jobs (eg. qrcode, rdf, cover.*) get batches
+    of their own that can run alongside the heavy format chains.
+
+    """
+
+    batches = []
+    for dummy_ebook, jobs in itertools.groupby(job_queue, key=lambda job: job.ebook):
+        jobs = list(jobs)
+        position = {job.type: i for i, job in enumerate(jobs)}
+        parent = list(range(len(jobs)))
+
+        def find(i):
+            while parent[i] != i:
+                i = parent[i]
+            return i
+
+        for i, job in enumerate(jobs):
+            for prerequisite in PREREQUISITES.get(job.type, ()):
+                if prerequisite in position:
+                    parent[find(i)] = find(position[prerequisite])
+
+        lanes = collections.OrderedDict()
+        for i, job in enumerate(jobs):
+            lanes.setdefault(find(i), []).append(job)
+        batches.extend(lanes.values())
+
+    return batches
+
+
+class MemoryBudget():
+    """ Admit batches first come first served while their predicted
+    memory use fits into limit bytes.
+
+    A persistent worker keeps idle bytes when it has no batch to run;
+    these count too.  A batch's amount includes its worker's idle
+    bytes, so a batch run by a resident worker needs only the rest.
+
+    A batch is always admitted when no other batch is running, so a big
+    book runs alone instead of not at all.
+
+    """
+
+    def __init__(self, limit, idle=WORKER_RSS, resident=0):
+        self.limit = limit
+        self.idle = idle
+        self.in_use = idle * resident # workers left running by an earlier call
+        self.running = 0
+        self.waiting = collections.deque()
+        self.cond = threading.Condition()
+
+
+    def extra(self, amount, resident):
+        """ What a batch of amount bytes adds to a worker. """
+
+        return max(amount - self.idle, 0) if resident else amount
+
+
+    def acquire(self, amount, resident=False):
+        """ Wait until amount bytes can be used.
+
+        resident: the batch runs in a worker that is already running
+
+        """
+
+        extra = self.extra(amount, resident)
+        with self.cond:
+            ticket = object()
+            self.waiting.append(ticket)
+            while self.waiting[0] is not ticket or (
+                    self.limit and self.running and self.in_use + extra > self.limit):
+                self.cond.wait()
+            self.waiting.popleft()
+            self.in_use += extra
+            self.running += 1
+            self.cond.notify_all()
+
+
+    def release(self, amount, resident=False):
+        """ Give back what acquire took.
+
+        resident: the worker stays running, and keeps its idle bytes
+
+        """
+
+        with self.cond:
+            self.in_use -= self.extra(amount, resident)
+            self.running -= 1
+            self.cond.notify_all()
+
+
+def batch_memory(batch):
+    """ Predicted peak RSS of a worker running batch: its jobs run one after the other. """
+
+    return max(getattr(job, 'memory', WORKER_RSS) for job in batch)
+
+
+def run_job_queues_parallel(groups):
+    """ Keep options.workers Ebookmaker children busy.
+
+    groups yields the groups made by plan_groups.  Job
+    queues are planned ahead in this thread while the children run.
+    Each queue is split along the build DAG (see split_job_queue) and
+    the batches are spread over long-lived workers.  A batch starts
+    only when its predicted memory fits into --memory-limit (see
+    MemoryBudget).  Each job's files are registered in this thread as
+    soon as the job is done.
+
+    """
+
+    results = queue.Queue()
+    budget = MemoryBudget(options.memory_limit * 1024 * 1024, resident=sum(
+        worker.alive() for worker in persistent_workers))
+
+    def run(group, batch):
+        memory = batch_memory(batch)
+        budget.acquire(memory, get_worker().alive())
+        try:
+            if group.deadline is None:
+                group.deadline = group_deadline()
+            run_ebookmaker(batch, lambda job, status: results.put((job, status)),
+                           persistent=True, deadline=group.deadline)
+        except Exception as what:
+            exception(what)
+        finally:
+            budget.release(memory, get_worker().alive())
+            results.put((None, group))
+
+    running = 0
+    unfinished = collections.Counter() # group -> batches running
+
+    def collect(block):
+        """ Register one result; return False if there was none. """
+        nonlocal running
+        try:
+            job, status = results.get(block)
+        except queue.Empty:
+            return False
+        if job is None:
+            running -= 1
+            unfinished[status] -= 1
+            if not unfinished[status]:
+                del unfinished[status]
+                info("Ebookmaker finished #%d - #%d" % (status.first, status.last))
+                finish_group(status)
+        else:
+            finish_job(job, status)
+        return True
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=options.workers) as executor:
+        for group in groups:
+            if not group.job_queue:
+                finish_group(group)
                 continue
-            Logger.ebook = job.ebook
-            filename = os.path.join(job.outputdir, job.outputfile)
-            add_file_to_db(filename, job.type, job.ebook)
-            if job.type == 'html.images':
-                zipfilename = os.path.join(job.outputdir, make_output_filename('zip', job.ebook))
-                # also add the zip
-                add_file_to_db(zipfilename, None, job.ebook)
-                
-    else:
-        critical('returncode was %s', ebm.returncode)
+            info("Calling ebookmaker for #%d - #%d (%d jobs, estimated cost %d MB)" %
+                 (group.first, group.last, len(group.job_queue), group.cost >> 20))
+            setproctitle.setproctitle(
+                "Converting Project Gutenberg #%d - #%d (%d%%)" %
+                (group.first, group.last, group.progress))
+            group.deadline = None # set when the first batch starts
+            for batch in split_job_queue(group.job_queue):
+                executor.submit(run, group, batch)
+                running += 1
+                unfinished[group] += 1
+
+            # plan ahead, but don't hold the whole range in memory
+            while running >= 2 * options.workers:
+                collect(True)
+            while collect(False):
+                pass
+
+        while running:
+            collect(True)
 
 
 def add_local_options(ap):
@@ -409,11 +1214,20 @@ def add_local_options(ap):
         default  = "/tmp/ebookconverter.pid",
         help     = "use pid file (default: /tmp/ebookconverter.pid)")
 
+    ap.add_argument(
+        "--metrics-job",
+        metavar  = "NAME",
+        dest     = "metrics_job",
+        action   = "store",
+        default  = None,
+        help     = "write the metrics of this run as job ebookconverter_NAME, "
+                   "one per cron job (default: ebookconverter)")
+
     ap.add_argument(
         "--make",
         metavar = "TYPES",
         dest    = "make",
-        choices = CommonCode.add_dependencies(['everything'], DEPENDENCIES),
+        choices = CommonCode.add_dependencies(['everything', 'metadata'], DEPENDENCIES),
         default = [],
         action  = "append",
         help    = "types to make if source newer than target")
@@ -422,7 +1236,7 @@ def add_local_options(ap):
         "--build",
         metavar = "TYPES",
         dest    = "build",
-        choices = CommonCode.add_dependencies(['everything'], DEPENDENCIES),
+        choices = CommonCode.add_dependencies(['everything', 'metadata'], DEPENDENCIES),
         default = [],
         action  = "append",
         help    = "types to make unconditionally")
@@ -458,7 +1272,198 @@ def add_local_options(ap):
         type    = int,
         default = 1,
         action  = "store",
-        help    = "send N ebooks per job to ebookmaker(default: 1)")
+        help    = "send up to N ebooks per job to ebookmaker, fewer if over --group-budget (default: 1)")
+
+    ap.add_argument(
+        "--workers",
+        metavar = "N",
+        dest    = "workers",
+        type    = int,
+        default = 1,
+        action  = "store",
+        help    = "run N long-lived ebookmaker processes at the same time (default: 1)")
+
+    ap.add_argument(
+        "--persistent-worker",
+        dest    = "persistent_worker",
+        action  = "store_true",
+        help    = "keep ebookmaker running between job groups")
+
+    ap.add_argument(
+        "--worker-max-jobs",
+        metavar = "N",
+        dest    = "worker_max_jobs",
+        type    = int,
+        default = 500,
+        action  = "store",
+        help    = "restart a persistent ebookmaker after N jobs (default: 500, 0: never)")
+
+    ap.add_argument(
+        "--group-budget",
+        metavar = "MB",
+        dest    = "group_budget",
+        type    = int,
+        default = 512,
+        action  = "store",
+        help    = "pack ebooks into groups of at most --jobs ebooks whose estimated "
+                  "memory cost stays below MB (0: no limit) (default: 512)")
+
+    ap.add_argument(
+        "--memory-limit",
+        metavar = "MB",
+        dest    = "memory_limit",
+        type    = int,
+        default = 0,
+        action  = "store",
+        help    = "with --workers: start jobs only while the memory they are predicted "
+                  "to need stays below MB, and build big books instead of skipping them "
+                  "(default: 0, no limit)")
+
+    ap.add_argument(
+        "--job-timeout",
+        metavar = "MINUTES",
+        dest    = "job_timeout",
+        type    = int,
+        default = 0,
+        action  = "store",
+        help    = "kill an ebookmaker job after MINUTES minutes (default: 0, no limit)")
+
+    ap.add_argument(
+        "--group-timeout",
+        metavar = "MINUTES",
+        dest    = "group_timeout",
+        type    = int,
+        default = 0,
+        action  = "store",
+        help    = "kill the jobs of a group still running after MINUTES minutes "
+                  "(default: 0, no limit)")
+
+    ap.add_argument(
+        "--retry-timeouts",
+        dest    = "retry_timeouts",
+        action  = "store_true",
+        help    = "build again, one ebook at a time, the jobs that timed out before")
+
+    ap.add_argument(
+        "--records",
+        metavar = "FILE",
+        dest    = "records",
+        default = None,
+        action  = "store",
+        help    = "write a JSON record per ebook and type made or skipped to FILE "
+                  "(default: a new file in $PRIVATE/logs/conversions)")
+
+    ap.add_argument(
+        "--lock-wait",
+        metavar = "SECONDS",
+        dest    = "lock_wait",
+        type    = int,
+        default = 0,
+        action  = "store",
+        help    = "wait up to SECONDS seconds for another process building the "
+                  "same ebook, else skip it (default: 0)")
+
+    ap.add_argument(
+        "--run-id",
+        metavar = "ID",
+        dest    = "run_id",
+        default = None,
+        action  = "store",
+        help    = "record the ebooks this run has finished in a journal")
+
+    ap.add_argument(
+        "--resume",
+        dest    = "resume",
+        action  = "store_true",
+        help    = "skip ebooks already finished by this --run-id")
+
+    ap.add_argument(
+        "--time-budget",
+        metavar = "MINUTES",
+        dest    = "time_budget",
+        type    = int,
+        default = 0,
+        action  = "store",
+        help    = "don't start new job groups after MINUTES minutes")
+
+    ap.add_argument(
+        "--stale",
+        dest    = "stale",
+        action  = "store_true",
+        help    = "convert only the selected ebooks with an output missing or "
+                  "older than its source (use with --make, not --build)")
+
+    ap.add_argument(
+        "--upgrade",
+        dest    = "upgrade",
+        action  = "store_true",
+        help    = "with --make or --stale, also convert again the outputs built "
+                  "by another ebookmaker or ebookconverter version")
+
+    ap.add_argument(
+        "--plan-out",
+        metavar = "FILE",
+        dest    = "plan_out",
+        default = None,
+        action  = "store",
+        help    = "don't run Ebookmaker; write the jobs it would run, with "
+                  "estimated times, to FILE as JSON records")
+
+    ap.add_argument(
+        "--plan-in",
+        metavar = "FILE",
+        dest    = "plan_in",
+        default = None,
+        action  = "store",
+        help    = "run the jobs planned in FILE (by --plan-out) instead of "
+                  "planning; --range and --shard pick from them")
+
+    ap.add_argument(
+        "--queue",
+        metavar = "NAME",
+        dest    = "queue",
+        default = None,
+        action  = "store",
+        help    = "convert the ebooks in the database work queue NAME until it is empty")
+
+    ap.add_argument(
+        "--enqueue",
+        dest    = "enqueue",
+        action  = "store_true",
+        help    = "add the selected ebooks to the --queue and exit")
+
+    ap.add_argument(
+        "--priority",
+        metavar = "N",
+        dest    = "priority",
+        type    = int,
+        default = 0,
+        action  = "store",
+        help    = "with --enqueue, the priority of the requests; higher goes first "
+                  "(default: 0)")
+
+    ap.add_argument(
+        "--reason",
+        metavar = "TEXT",
+        dest    = "reason",
+        default = "ebookconverter",
+        action  = "store",
+        help    = "with --enqueue, why the ebooks need rebuilding")
+
+    ap.add_argument(
+        "--install-queue",
+        dest    = "install_queue",
+        action  = "store_true",
+        help    = "create or upgrade the table of the database work queues, and exit")
+
+    ap.add_argument(
+        "--shard",
+        metavar = "I/N",
+        dest    = "shard",
+        default = None,
+        action  = "store",
+        help    = "convert only the selected ebooks whose number modulo N is I "
+                  "(for splitting a run over N hosts without a queue)")
 
     ap.add_argument(
         "--fk-filetype",
@@ -554,11 +1559,17 @@ def config():
             'proxies' : None,
             'logfile': None,
             'pgvpncmd': None,
-            'ebookmaker': 'ebookmaker',
+            'ebookmaker': None,
             'timestamp': datetime.datetime.today().isoformat()[:19],
         }
     )))
 
+    if options.config.EBOOKMAKER:
+        try:
+            EbookWorker.check_ebookmaker(options.config.EBOOKMAKER)
+        except ValueError as what:
+            raise configparser.Error(str(what))
+
 def grouper(iterable, n, fillvalue = None):
     """ Itertools recipe: Collect data into fixed-length chunks or blocks """
     # grouper('ABCDEFG', 3, 'x') --> ABC DEF Gxx"
@@ -566,14 +1577,190 @@ def grouper(iterable, n, fillvalue = None):
     return itertools.zip_longest(*args, fillvalue = fillvalue)
 
 
-def main():
-    """ Main program. """
+class StopConversion(Exception):
+    """ Raised to stop a run on the first error (--stop). """
 
-    try:
-        config()
-    except configparser.Error as what:
-        error("Error in configuration file: %s", str(what))
-        return 1
+
+stop_requested = threading.Event()
+start_time = time.monotonic()
+journal = None
+locks = None
+build_plan = None
+
+def request_stop(signum, dummy_frame):
+    """ Signal handler: finish the groups in progress, then stop.
+
+    A second signal stops at once.
+
+    """
+
+    if stop_requested.is_set():
+        raise KeyboardInterrupt
+    stop_requested.set()
+    warning("Got signal %d: stopping after the groups in progress." % signum)
+
+
+def out_of_time():
+    """ True if the run should not start another group. """
+
+    if stop_requested.is_set():
+        return True
+    if options.time_budget and time.monotonic() - start_time > options.time_budget * 60:
+        info("Time budget of %d minutes used up." % options.time_budget)
+        return True
+    return False
+
+
+def finish_group(group):
+    """ Called when all jobs of a group are done. """
+
+    registry.flush()
+    if journal:
+        journal.record(group.ebooks)
+    if locks:
+        for ebook in group.ebooks:
+            locks.release(ebook)
+    Metrics.inc('books_processed_total', len(group.ebooks))
+
+
+def new_group(progress):
+    """ An empty group of ebooks to convert together. """
+
+    group = Struct()
+    group.first = group.last = 0
+    group.progress = progress
+    group.ebooks = []
+    group.job_queue = []
+    group.cost = 0
+    return group
+
+
+def plan_groups(done_books, book_index):
+    """ Make the job queue for each group of ebooks in the range.
+
+    Ebooks are packed into groups of at most options.jobs ebooks whose
+    estimated cost (see Maker.estimate_cost) stays within
+    options.group_budget.  An ebook over budget gets a group of its own.
+
+    Yields a Struct per group with first, last, progress, ebooks (the
+    ebooks planned), job_queue and cost.  Planned ebooks are appended
+    to done_books.  Stops early if out_of_time().
+
+    """
+
+    cf = Candidates.Candidates()
+    budget = options.group_budget * 1024 * 1024
+    group = None
+
+    for window in grouper(options.range, options.jobs):
+        window = [ebook for ebook in window if ebook is not None]
+        try:
+            candidates = cf.read_many(window)
+        except sqlalchemy.exc.DBAPIError as what:
+            exception(what)
+            if options.stop_on_errors:
+                raise StopConversion() from what
+            candidates = {}
+
+        for ebook in window:
+            if group is None:
+                if out_of_time():
+                    return
+                group = new_group(len(done_books) * 100 // len(options.range))
+                info("Progress: %d%% done", group.progress)
+
+            Logger.ebook = ebook
+
+            if ebook not in book_index.existing:
+                info("No ebook #%d in database.", ebook)
+                continue
+
+            if locks and not locks.acquire(ebook):
+                if not options.lock_wait:
+                    info("Skipping #%d: another process is building it." % ebook)
+                    log_conversion(ebook, 'all', 'skipped', reason='locked')
+                    continue
+                info("Waiting for another process to finish #%d ..." % ebook)
+                if not locks.acquire(ebook, options.lock_wait):
+                    warning("Skipping #%d: still locked after %d seconds." %
+                            (ebook, options.lock_wait))
+                    log_conversion(ebook, 'all', 'skipped', reason='locked')
+                    continue
+                # the other process may have changed its files
+                try:
+                    candidates[ebook] = cf.read_many([ebook]).get(ebook, [])
+                except sqlalchemy.exc.DBAPIError as what:
+                    exception(what)
+
+            maker = Maker(ebook, book_index)
+
+            try:
+                job_queue = maker.mk_job_queue(candidates.get(ebook))
+            except Exception as what:
+                # report errors, but keep going
+                exception(what)
+                if options.stop_on_errors:
+                    raise StopConversion() from what
+                job_queue = []
+
+            if group.ebooks and (len(group.ebooks) >= options.jobs or
+                                 budget and group.cost + maker.cost > budget):
+                yield group
+                if out_of_time():
+                    if locks:
+                        locks.release(ebook)
+                    return
+                group = new_group(len(done_books) * 100 // len(options.range))
+                info("Progress: %d%% done", group.progress)
+
+            if not group.ebooks:
+                group.first = ebook
+            group.last = ebook
+            group.ebooks.append(ebook)
+            group.job_queue += job_queue
+            group.cost += maker.cost
+            done_books.append(ebook)
+
+    if group and group.ebooks:
+        yield group
+
+
+def replay_groups(done_books):
+    """ Like plan_groups, but yield the groups of the saved build_plan.
+
+    Only the ebooks in options.range are run.
+
+    """
+
+    wanted = set(options.range)
+    planned = collections.OrderedDict() # group -> jobs
+    for group_no, job in build_plan:
+        if job.ebook in wanted:
+            planned.setdefault(group_no, []).append(job)
+
+    for jobs in planned.values():
+        if out_of_time():
+            return
+        group = new_group(len(done_books) * 100 // len(options.range))
+        info("Progress: %d%% done", group.progress)
+        for ebook in dict.fromkeys(job.ebook for job in jobs):
+            if locks and not locks.acquire(ebook, options.lock_wait):
+                info("Skipping #%d: another process is building it." % ebook)
+                log_conversion(ebook, 'all', 'skipped', reason='locked')
+                continue
+            group.ebooks.append(ebook)
+        if not group.ebooks:
+            continue
+        group.first = group.ebooks[0]
+        group.last = group.ebooks[-1]
+        group.job_queue = [job for job in jobs if job.ebook in group.ebooks]
+        group.cost = sum(getattr(job, 'cost', None) or 0 for job in group.job_queue)
+        done_books.extend(group.ebooks)
+        yield group
+
+
+def setup_logging():
+    """ Set up logging as configured. """
 
     Logger.base_logfile = options.config.LOGFILE
     Logger.notifier = CommonCode.queue_notifications
@@ -587,13 +1774,270 @@ def main():
 
     debug("Using config file: %s" % options.config_file)
 
-    # write pidfile
+
+def write_pidfile():
+    """ Create the pid file.  Return False if it exists. """
+
     try:
         fd = os.open(options.pidfile, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
         debug("Writing pid file")
         os.write(fd, ("%d\n" %  os.getpid()).encode('us-ascii'))
         os.close(fd)
     except OSError:
+        return False
+    return True
+
+
+def expand_types(make, build):
+    """ Return the types to make and the types to build for --make and --build.
+
+    The types built are made too.  Building 'metadata' makes all
+    types: those out of date are converted, the others are refreshed
+    (see Maker.refresh).
+
+    """
+
+    make = list(make) + list(build)
+    if 'metadata' in build:
+        make.append('all')
+    return (CommonCode.add_dependencies(make,  DEPENDENCIES, BUILD_ORDER),
+            CommonCode.add_dependencies(build, DEPENDENCIES, BUILD_ORDER))
+
+
+def resolve_types():
+    """ Add the types needed by options.make and options.build. """
+
+    options.make, options.build = expand_types(options.make, options.build)
+
+    info("Making:   %s" % " ".join(options.make))
+    info("Building: %s" % " ".join(options.build))
+
+
+rebuild_queue = None
+
+def claim_requests():
+    """ Take over the pending rebuild requests that this run's build satisfies.
+
+    Returns the ebooks claimed.  The rebuild queue is a help, not a
+    must: without a database there are none, database errors are
+    logged and ignored.
+
+    """
+
+    global rebuild_queue
+    if not options.build or options.dry_run or options.shadow:
+        return []
+    try:
+        if rebuild_queue is None:
+            rebuild_queue = WorkQueue.WorkQueue(WorkQueue.REBUILD_QUEUE)
+        types = list(options.build)
+        if set(expand_types([], ['all'])[1]) <= set(types):
+            # a full build refreshes the metadata too
+            types.append('metadata')
+        claimed = rebuild_queue.claim_ebooks(options.range, types)
+    except WorkQueue.NoDatabase:
+        return []
+    except sqlalchemy.exc.DBAPIError as what:
+        exception(what)
+        return []
+    if claimed:
+        info("Taking over rebuild requests for %s" % pretty_print_list(claimed))
+    return claimed
+
+
+def convert(book_index, absorb=True):
+    """ Convert the ebooks in options.range.
+
+    With absorb, pending requests in the rebuild queue that this build
+    satisfies are done with it.
+
+    Returns the list of ebooks done.  Raises StopConversion.
+
+    """
+
+    done_books  = []
+    absorbed = claim_requests() if absorb else []
+    finished = False
+
+    global locks
+    if not options.dry_run and locks is None:
+        locks = EbookLocks.EbookLocks(options.config.CACHEDIR)
+
+    if build_plan is not None:
+        groups = replay_groups(done_books)
+    else:
+        groups = plan_groups(done_books, book_index)
+    try:
+        if plan_writer:
+            for group in groups:
+                info("Planned #%d - #%d (%d jobs)" %
+                     (group.first, group.last, len(group.job_queue)))
+                plan_writer.group(group)
+        elif options.dry_run:
+            for group in groups:
+                info("Job list for #%d - #%d (%d jobs)" %
+                     (group.first, group.last, len(group.job_queue)))
+                print('*' * 80)
+                for job in group.job_queue:
+                    print(job)
+                    print('*' * 80)
+        elif options.workers > 1:
+            run_job_queues_parallel(groups)
+        else:
+            for group in groups:
+                info("Calling ebookmaker for #%d - #%d (%d jobs, estimated cost %d MB)" %
+                     (group.first, group.last, len(group.job_queue), group.cost >> 20))
+                setproctitle.setproctitle(
+                    "Converting Project Gutenberg #%d - #%d (%d%%)" %
+                    (group.first, group.last, group.progress)
+                )
+                run_job_queue(group.job_queue, group_deadline())
+                finish_group(group)
+        finished = not out_of_time()
+    finally:
+        groups.close()
+        registry.flush()
+        if locks:
+            locks.release_all()
+        if absorbed:
+            done = [ebook for ebook in absorbed if finished and ebook in done_books]
+            rebuild_queue.complete(done)
+            rebuild_queue.release(sorted(set(absorbed) - set(done)))
+
+    Notifier.send_notifications(done_books if options.notify else [])
+    return done_books
+
+
+def convert_claimed(work_queue, batch, book_index):
+    """ Convert the claimed ebooks in batch, then complete or release them.
+
+    Ebooks not reached are given back to the queue.  Ebooks skipped
+    (not in the database, locked by another process) count as done.
+
+    """
+
+    options.range = batch
+    done_books = []
+    try:
+        done_books = convert(book_index, absorb=False)
+    except BaseException:
+        work_queue.release(batch)
+        raise
+    if out_of_time():
+        work_queue.complete(done_books)
+        work_queue.release(sorted(set(batch) - set(done_books)))
+    else:
+        work_queue.complete(batch)
+
+
+def run_work_queue(work_queue, book_index):
+    """ Claim batches of ebooks from work_queue and convert them.
+
+    Each ebook gets the types its request asked for, or options.build
+    if it asked for none.  Returns when the queue is empty or
+    out_of_time().
+
+    """
+
+    make, build = options.make, options.build
+    work_queue.start_heartbeat()
+    try:
+        while not out_of_time():
+            batch = work_queue.claim(options.jobs * options.workers)
+            if not batch:
+                info("Queue %s is empty." % work_queue.name)
+                break
+            by_types = collections.OrderedDict()
+            for ebook in batch:
+                types = work_queue.requests.get(ebook, ((), ()))[0]
+                by_types.setdefault(types, []).append(ebook)
+            for types, ebooks in by_types.items():
+                if types:
+                    options.make, options.build = expand_types([], types)
+                else:
+                    options.make, options.build = make, build
+                convert_claimed(work_queue, ebooks, book_index)
+    finally:
+        options.make, options.build = make, build
+        work_queue.stop_heartbeat()
+
+
+def retry_timeouts(timeouts, book_index):
+    """ Build again the jobs in timeouts (see RunJournal.read_timeouts).
+
+    Each ebook in options.range gets the types that timed out, besides
+    options.make and options.build.  Ebooks with the same types are
+    converted together.  Returns True if all of them were reached.
+
+    """
+
+    make, build, ebooks = options.make, options.build, options.range
+    by_types = collections.OrderedDict()
+    for ebook in ebooks:
+        by_types.setdefault(tuple(sorted(timeouts[ebook])), []).append(ebook)
+    try:
+        for types, group in by_types.items():
+            if out_of_time():
+                break
+            options.range = group
+            options.make, options.build = expand_types(make, build + list(types))
+            convert(book_index)
+    finally:
+        options.make, options.build, options.range = make, build, ebooks
+    return not out_of_time()
+
+
+@Metrics.instrument('ebookconverter')
+def main():
+    """ Main program. """
+
+    try:
+        config()
+    except configparser.Error as what:
+        error("Error in configuration file: %s", str(what))
+        return 1
+
+    setup_logging()
+
+    if options.metrics_job:
+        try:
+            Metrics.set_job('ebookconverter_' + options.metrics_job)
+        except ValueError as what:
+            error(str(what))
+            return 1
+
+    global journal, start_time, build_plan, plan_writer
+    start_time = time.monotonic()
+    if options.resume and not options.run_id:
+        error("--resume needs a --run-id")
+        return 1
+    if options.enqueue and not options.queue:
+        error("--enqueue needs a --queue")
+        return 1
+    if options.install_queue:
+        try:
+            WorkQueue.install()
+        except (WorkQueue.NoDatabase, sqlalchemy.exc.DBAPIError) as what:
+            error("Cannot install the work queue: %s" % what)
+            return 1
+        info("Installed table %s" % WorkQueue.TABLE_NAME)
+        return 0
+    if options.plan_in:
+        try:
+            build_plan = BuildPlan.read_plan(options.plan_in)
+        except (OSError, ValueError, KeyError) as what:
+            error("Cannot read plan %s: %s" % (options.plan_in, what))
+            return 1
+    if options.plan_out:
+        options.dry_run = True
+    if options.run_id:
+        try:
+            journal = RunJournal.RunJournal(options.run_id)
+        except ValueError as what:
+            error(str(what))
+            return 1
+
+    if not write_pidfile():
         info("Not running: pidfile exists.")
         sys.exit(2)
 
@@ -624,67 +2068,108 @@ def main():
         pks = pks.intersection(options.range)
         options.range = sorted(pks)
 
-    info("Processing %d ebooks" % len(options.range))
-    info("Processing ebooks: %s" % pretty_print_list(options.range))
+    timeouts = None
+    if options.retry_timeouts:
+        timeouts, timeouts_size = RunJournal.read_timeouts()
+        if options.range or options.goback or options.top or options.fk_filetype:
+            options.range = sorted(set(timeouts).intersection(options.range))
+        else:
+            options.range = sorted(timeouts)
+        options.jobs = 1
+        info("Retrying timed out jobs of %d ebooks" % len(options.range))
+
+    if build_plan is not None:
+        planned = {job.ebook for dummy_group, job in build_plan}
+        if options.range:
+            planned.intersection_update(options.range)
+        options.range = sorted(planned)
+        info("Running plan %s" % options.plan_in)
+
+    if options.shard:
+        try:
+            i, n = WorkQueue.parse_shard(options.shard)
+        except ValueError as what:
+            error(str(what))
+            os.remove(options.pidfile)
+            return 1
+        options.range = WorkQueue.shard_range(options.range, i, n)
+        info("Shard %d of %d" % (i, n))
+
+    book_index = BookIndex.BookIndex()
+    if options.stale:
+        try:
+            stale = find_stale(options.range, book_index)
+        except sqlalchemy.exc.DBAPIError as e:
+            error(f"A database error occurred: {e}")
+            os.remove(options.pidfile)
+            return 1
+        reasons = collections.Counter()
+        for ebook, types in sorted(stale.items()):
+            debug("Stale #%d: %s" % (ebook, ', '.join(
+                '%s (%s)' % item for item in sorted(types.items()))))
+            reasons.update(types.values())
+        info("Stale outputs in %d of %d ebooks: %s" % (
+            len(stale), len(options.range),
+            ', '.join('%d %s' % (n, reason) for reason, n in sorted(reasons.items())) or 'none'))
+        options.range = [ebook for ebook in options.range if ebook in stale]
+
+    resolve_types()
+
+    work_queue = None
+    if options.queue:
+        try:
+            work_queue = WorkQueue.WorkQueue(options.queue)
+        except WorkQueue.NoDatabase as what:
+            error("Cannot use queue %s: %s" % (options.queue, what))
+            os.remove(options.pidfile)
+            return 1
+        if options.enqueue:
+            added = work_queue.enqueue(options.range, options.priority,
+                                       options.build, options.reason)
+            info("Added %d of %d ebooks to queue %s (%d queued)" %
+                 (added, len(options.range), options.queue, work_queue.pending()))
+            os.remove(options.pidfile)
+            return 0
+        options.range = []
+        info("Processing ebooks from queue %s (%d queued)" %
+             (options.queue, work_queue.pending()))
+    else:
+        info("Processing %d ebooks" % len(options.range))
+        info("Processing ebooks: %s" % pretty_print_list(options.range))
 
     if options.goback:
         # make sure the books just posted get done first
         options.range.sort(reverse=True)
 
-    options.make += options.build
+    if journal and options.resume:
+        done = journal.done()
+        options.range = [ebook for ebook in options.range if ebook not in done]
+        info("Resuming run %s: %d ebooks left" % (options.run_id, len(options.range)))
 
-    options.make  = CommonCode.add_dependencies(options.make,  DEPENDENCIES, BUILD_ORDER)
-    options.build = CommonCode.add_dependencies(options.build, DEPENDENCIES, BUILD_ORDER)
+    global conversion_log
+    if not options.dry_run:
+        conversion_log = ConversionLog.ConversionLog(
+            options.records or ConversionLog.default_path(options.run_id))
+        info("Writing conversion records to %s" % conversion_log.path)
 
-    info("Making:   %s" % " ".join(options.make))
-    info("Building: %s" % " ".join(options.build))
+    if options.plan_out:
+        plan_writer = BuildPlan.PlanWriter(
+            options.plan_out, BuildPlan.timings(ConversionLog.recent_paths()))
 
-    done_books  = []
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
 
     try:
-        for group in grouper(options.range, options.jobs):
-            job_queue = []
-            last = 0
-            progress = len(done_books) * 100 // len(options.range)
-            info("Progress: %d%% done", progress)
-
-            for ebook in group:
-                if ebook is None:
-                    break
-                Logger.ebook = last = ebook
-
-                if not DBUtils.ebook_exists(ebook):
-                    continue
-
-                maker = Maker(ebook)
-
-                try:
-                    job_queue += maker.mk_job_queue()
-                except Exception as what:
-                    # report errors, but keep going
-                    exception(what)
-                    if options.stop_on_errors:
-                        return 1
-
-                done_books.append(ebook)
-
-            # send up group
-            if options.dry_run:
-                info("Job list for #%d - #%d (%d jobs)" % (group[0], last, len(job_queue)))
-                print('*' * 80)
-                for job in job_queue:
-                    print(job)
-                    print('*' * 80)
-            else:
-                info("Calling ebookmaker for #%d - #%d (%d jobs)" %
-                     (group[0], last, len(job_queue)))
-                setproctitle.setproctitle(
-                    "Converting Project Gutenberg #%d - #%d (%d%%)" %
-                    (group[0], last, progress)
-                )
-                run_job_queue(job_queue)
+        if work_queue:
+            run_work_queue(work_queue, book_index)
+        elif timeouts is not None:
+            if retry_timeouts(timeouts, book_index) and not options.dry_run:
+                RunJournal.drop_timeouts(timeouts_size, options.range)
+        else:
+            convert(book_index)
 
-        Notifier.send_notifications(done_books if options.notify else [])
+    except StopConversion:
+        return 1
 
     except KeyboardInterrupt as what:
         # also triggered by: kill -INT(or: kill -2)
@@ -692,6 +2177,15 @@ def main():
         return 1
 
     finally:
+        for worker in persistent_workers:
+            worker.close()
+        if conversion_log:
+            conversion_log.close()
+        if plan_writer:
+            plan_writer.close()
+            info("Wrote plan %s: %d groups, %d jobs, estimated %.1f hours" %
+                 (options.plan_out, plan_writer.groups, plan_writer.jobs,
+                  plan_writer.seconds / 3600))
         os.remove(options.pidfile)
 
     setproctitle.setproctitle("Cleaning Up")
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: UTF8 -*-
+
+"""
+EbookLocks.py
+
+Copyright 2026 by Project Gutenberg
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+Per-ebook locks, so that several converter processes can work on the
+same cache without two of them building the same ebook at once.
+
+A lock is an flock() on a lock file in the ebook's cache directory.
+The kernel drops it when the process dies, so there are no stale locks
+to clean up.
+
+"""
+
+import fcntl
+import os
+import time
+
+from libgutenberg.Logger import debug
+
+LOCK_FILENAME = '.ebookconverter.lock'
+
+
+class EbookLocks():
+    """ The per-ebook locks held by this process. """
+
+    def __init__(self, cachedir):
+        self.cachedir = cachedir
+        self.held = {} # ebook -> fd
+
+
+    def path(self, ebook):
+        """ The lock file of ebook. """
+        return os.path.join(self.cachedir, str(ebook), LOCK_FILENAME)
+
+
+    def acquire(self, ebook, wait=0):
+        """ Lock ebook.
+
+        Wait up to wait seconds for another process to let go.  Returns
+        False if the lock could not be had.
+
+        """
+
+        if ebook in self.held:
+            return True
+        path = self.path(ebook)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o664)
+        deadline = time.monotonic() + wait
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    os.close(fd)
+                    return False
+                time.sleep(min(1.0, remaining))
+
+        self.held[ebook] = fd
+        debug("Locked #%d" % ebook)
+        return True
+
+
+    def release(self, ebook):
+        """ Unlock ebook. """
+
+        fd = self.held.pop(ebook, None)
+        if fd is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+
+    def release_all(self):
+        """ Unlock all ebooks. """
+
+        for ebook in list(self.held):
+            self.release(ebook)
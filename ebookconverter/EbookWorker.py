@@ -0,0 +1,443 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: UTF8 -*-
+
+"""
+EbookWorker.py
+
+Copyright 2026 by Project Gutenberg
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+A long-lived Ebookmaker process.  Ebookmaker, its parsers, its writers
+and our writer extensions are loaded once; pickled CommonCode.Job
+objects are then read from stdin and built one by one, and a status
+record is written back to stdout as soon as each job is done.
+
+Started by EbookConverter as:
+
+  python -m ebookconverter.EbookWorker [ebookmaker options] --jobs no_such_url
+
+Every message is a 4 byte big-endian length followed by a pickle.  The
+parent sends one frame per job and a None frame at the end of a batch;
+the child answers one status frame per job and a None frame when the
+batch is done.  Anything the child logs goes to stderr and is relayed
+by the parent line by line.
+
+"""
+
+import os
+import queue
+import resource
+import shutil
+import signal
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+from six.moves import cPickle
+
+from libgutenberg import Logger
+from libgutenberg.Logger import critical, debug, info, error, exception
+
+FRAME_HEADER = struct.Struct('>I')
+
+# Ebookmaker builds these types from the output of another type in the same batch
+DERIVED_FROM = {
+    'kindle.images':   'epub.images',
+    'kindle.noimages': 'epub.noimages',
+    'kf8.images':      'epub3.images',
+    'pdf.images':      'html.images',
+}
+
+
+def write_frame(fp, obj):
+    """ Write one object to a binary stream. """
+
+    data = cPickle.dumps(obj)
+    fp.write(FRAME_HEADER.pack(len(data)) + data)
+    fp.flush()
+
+
+def read_frame(fp):
+    """ Read one object from a binary stream. Raise EOFError at end of stream. """
+
+    header = fp.read(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        raise EOFError('end of stream')
+    size = FRAME_HEADER.unpack(header)[0]
+    data = fp.read(size)
+    if len(data) < size:
+        raise EOFError('truncated frame')
+    return cPickle.loads(data)
+
+
+def job_status(job, status, seconds=0.0, peak_rss=0, cpu=0.0):
+    """ The record returned for each job.
+
+    seconds: wall time, cpu: cpu time of the worker and the converters it ran
+
+    """
+
+    return {'ebook': job.ebook, 'type': job.type, 'status': status, 'seconds': seconds,
+            'cpu': cpu, 'peak_rss': peak_rss}
+
+
+def cpu_time():
+    """ Cpu seconds used by this process and its finished children. """
+
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def reset_peak_rss():
+    """ Start measuring the peak RSS of this process anew (Linux only). """
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as fp:
+            fp.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """ Peak RSS of this process in bytes since the last reset_peak_rss(). """
+
+    try:
+        with open('/proc/self/status', 'r') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    # the peak over the life of the process
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def children_usage():
+    """ (peak RSS in bytes, cpu seconds) of the finished children of this process. """
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_maxrss * 1024, usage.ru_utime + usage.ru_stime
+
+
+def job_peak_rss(children_before):
+    """ Peak RSS of a job: this process's since reset_peak_rss(), plus
+    the biggest converter (kindlegen, xelatex, ...) the job ran.
+
+    children_before: children_usage() when the job started
+
+    The kernel keeps the peak of the biggest child ever, not per job: if
+    the job ran a child, it was at most that big.  The converter runs
+    while this process waits, so the sum is an upper bound.
+
+    """
+
+    child_peak, child_cpu = children_usage()
+    if child_cpu == children_before[1]:
+        # ran no converter
+        child_peak = 0
+    return peak_rss() + child_peak
+
+
+#
+# child side
+#
+
+def run_job(job, output_files):
+    """ Build one job the same way EbookMaker.main does. """
+
+    from ebookmaker import EbookMaker
+
+    start_time = time.time()
+    start_cpu = cpu_time()
+    start_children = children_usage()
+    reset_peak_rss()
+    try:
+        debug('Job starting for type %s from %s', job.type, job.url)
+        Logger.ebook = job.ebook
+        dc = EbookMaker.get_dc(job) # this is when doc at job.url gets parsed!
+        job.dc = dc
+        job.last_updated()
+        job.outputfile = job.outputfile or EbookMaker.make_output_filename(job.type, dc)
+        output_files[job.type] = job.outputfile
+
+        derived_from = DERIVED_FROM.get(job.type)
+        if derived_from in output_files:
+            job.url = os.path.join(os.path.abspath(job.outputdir), output_files[derived_from])
+        elif getattr(job, 'derived_url', None):
+            # built from the output of an earlier run, see Maker.refresh
+            job.url = job.derived_url
+
+        EbookMaker.options.outputdir = job.outputdir
+        EbookMaker.do_job(job)
+        if dc and hasattr(dc, 'session') and dc.session:
+            dc.session.close()
+            dc.session = None
+    except Exception as what:
+        Logger.ebook = job.ebook or EbookMaker.id_from_filename(job.url)
+        critical(f'Job #{Logger.ebook} failed for type {job.type} from {job.url}')
+        exception(what)
+        return job_status(job, 'failed', time.time() - start_time,
+                          job_peak_rss(start_children), cpu_time() - start_cpu)
+
+    return job_status(job, 'done', time.time() - start_time,
+                      job_peak_rss(start_children), cpu_time() - start_cpu)
+
+
+def serve():
+    """ Child main loop. Runs until stdin is closed. """
+
+    from ebookmaker import EbookMaker, ParserFactory, WriterFactory
+    from ebookmaker.packagers import PackagerFactory
+
+    # on ^C the parent finishes the groups in progress; so must we
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    EbookMaker.config()
+    Logger.set_log_level(EbookMaker.options.verbose)
+
+    ParserFactory.load_parsers()
+    WriterFactory.load_writers()
+    PackagerFactory.load_packagers()
+
+    # keep our own copy of stdout for the protocol and send anything
+    # printed by ebookmaker or the writers to stderr
+    proto_in = sys.stdin.buffer
+    proto_out = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    output_files = {}
+    while True:
+        try:
+            job = read_frame(proto_in)
+        except EOFError:
+            break
+
+        if job is None:
+            # end of batch: don't let the caches grow over the life of the worker
+            output_files = {}
+            ParserFactory.ParserFactory.parsers = {}
+            ParserFactory.ParserFactory.sources = {}
+            write_frame(proto_out, None)
+            continue
+
+        write_frame(proto_out, run_job(job, output_files.setdefault(job.ebook, {})))
+
+    return 0
+
+
+#
+# parent side
+#
+
+def check_ebookmaker(ebookmaker):
+    """ Raise ValueError unless the ebookmaker command is ours.
+
+    The worker runs the ebookmaker installed with ebookconverter, in
+    sys.executable, and the build manifests record its version.  An
+    ebookmaker command (EBOOKMAKER in the configuration) is allowed only
+    if it runs the same one: installed next to sys.executable, or a
+    script for it.
+
+    """
+
+    path = shutil.which(ebookmaker)
+    if path is None:
+        raise ValueError("EBOOKMAKER %s not found" % ebookmaker)
+    if os.path.dirname(os.path.abspath(path)) == os.path.dirname(sys.executable):
+        return
+    try:
+        with open(path, 'rb') as fp:
+            shebang = fp.readline().decode('utf-8', 'replace')
+    except OSError as what:
+        raise ValueError("EBOOKMAKER %s: %s" % (ebookmaker, what))
+    interpreter = shebang[2:].split() if shebang.startswith('#!') else []
+    if interpreter[:1] == ['/usr/bin/env']:
+        interpreter = [shutil.which(name) or name for name in interpreter[1:2]]
+    if interpreter and os.path.abspath(interpreter[0]) == sys.executable:
+        return
+    raise ValueError(
+        "EBOOKMAKER %s is not the ebookmaker of %s, which ebookconverter runs: "
+        "install ebookconverter with that ebookmaker, or unset EBOOKMAKER" %
+        (path, sys.executable))
+
+
+class WorkerProcess():
+    """ Parent side of an EbookWorker child.
+
+    The child is started on first use and started again after it dies,
+    after it was killed for taking too long, or after it has done
+    max_jobs jobs (0: never recycle).
+
+    """
+
+    def __init__(self, params, max_jobs=0):
+        self.command = [sys.executable, '-m', 'ebookconverter.EbookWorker']
+        self.params = params
+        self.max_jobs = max_jobs
+        self.child = None
+        self.frames = None
+        self.jobs_done = 0
+        self.returncode = None
+
+
+    def start(self):
+        """ Start the child. """
+
+        self.child = subprocess.Popen(
+            self.command + self.params,
+            stdin  = subprocess.PIPE,
+            stdout = subprocess.PIPE,
+            stderr = subprocess.PIPE,
+            # so that kill() also gets the converters ebookmaker runs
+            start_new_session = True
+        )
+        self.jobs_done = 0
+        # read in a thread of its own, so that run() can time out
+        self.frames = queue.Queue()
+        threading.Thread(target=receive_frames, args=(self.child.stdout, self.frames),
+                         daemon=True).start()
+        threading.Thread(target=relay_log, args=(self.child.stderr,), daemon=True).start()
+        info("Started EbookWorker pid %d" % self.child.pid)
+
+
+    def alive(self):
+        """ True if the child is running, busy or idle. """
+
+        return self.child is not None and self.child.poll() is None
+
+
+    def next_frame(self, timeout):
+        """ Return the next frame from the child.
+
+        Raise queue.Empty after timeout seconds (None: wait forever) and
+        whatever receive_frames got if the stream broke.
+
+        """
+
+        frame = self.frames.get(timeout=timeout)
+        if isinstance(frame, Exception):
+            raise frame
+        return frame
+
+
+    def run(self, job_queue, on_result=None, job_timeout=0, deadline=None):
+        """ Stream a batch of jobs to the child.
+
+        on_result(job, status) is called as soon as each job is done.
+
+        job_timeout: seconds a job may take (0: no limit)
+        deadline: time.monotonic() by which the batch must be done
+
+        If a job takes too long, the child is killed and the job gets
+        status 'timeout'.  Returns the list of statuses, one for each
+        job done or timed out.  It is shorter than job_queue if the child
+        died or was killed.
+
+        """
+
+        if self.child is None or self.child.poll() is not None:
+            self.start()
+
+        sender = threading.Thread(
+            target=send_batch, args=(self.child.stdin, job_queue), daemon=True)
+        sender.start()
+
+        statuses = []
+        try:
+            for job in job_queue:
+                job_start = time.monotonic()
+                timeouts = []
+                if job_timeout:
+                    timeouts.append(job_timeout)
+                if deadline is not None:
+                    timeouts.append(max(deadline - job_start, 0))
+                try:
+                    status = self.next_frame(min(timeouts) if timeouts else None)
+                except queue.Empty:
+                    error("EbookWorker pid %d timed out on %s of #%d" %
+                          (self.child.pid, job.type, job.ebook))
+                    self.kill()
+                    status = job_status(job, 'timeout', time.monotonic() - job_start)
+                    statuses.append(status)
+                    if on_result:
+                        on_result(job, status)
+                    return statuses
+                statuses.append(status)
+                if on_result:
+                    on_result(job, status)
+            self.next_frame(None) # end of batch
+        except (OSError, EOFError, cPickle.UnpicklingError) as what:
+            error("EbookWorker pid %d died: %s" % (self.child.pid, what))
+            self.kill()
+            return statuses
+        except Exception:
+            # the child is now out of step with us
+            self.kill()
+            raise
+        finally:
+            sender.join()
+
+        self.jobs_done += len(job_queue)
+        if self.max_jobs and self.jobs_done >= self.max_jobs:
+            info("Recycling EbookWorker pid %d after %d jobs" %
+                 (self.child.pid, self.jobs_done))
+            self.close()
+        return statuses
+
+
+    def kill(self):
+        """ Kill the child. """
+
+        if self.child:
+            try:
+                os.killpg(self.child.pid, signal.SIGKILL)
+            except OSError:
+                self.child.kill()
+            self.returncode = self.child.wait()
+            self.child = None
+            info("EbookWorker returned code: %d." % self.returncode)
+
+
+    def close(self):
+        """ Let the child finish and exit. """
+
+        if self.child:
+            self.child.stdin.close()
+            self.returncode = self.child.wait()
+            self.child = None
+
+
+def send_batch(stream, job_queue):
+    """ Write a batch of jobs to the child. """
+
+    try:
+        for job in job_queue + [None]:
+            write_frame(stream, job)
+    except (OSError, ValueError):
+        # the child died; WorkerProcess.run notices
+        pass
+
+
+def receive_frames(stream, frames):
+    """ Put the child's frames into a queue, then the exception that ended the stream. """
+
+    while True:
+        try:
+            frames.put(read_frame(stream))
+        except (OSError, EOFError, cPickle.UnpicklingError) as what:
+            frames.put(what)
+            return
+
+
+def relay_log(stream):
+    """ Log the child's stderr line by line. """
+
+    for line in stream:
+        debug(line.decode('utf-8', 'replace').rstrip())
+
+
+if __name__ == '__main__':
+    sys.exit(serve())
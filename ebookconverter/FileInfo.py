@@ -43,6 +43,7 @@ from libgutenberg.Logger import error
 
 from ebookmaker.CommonCode import find_candidates
 
+from . import Metrics
 from .AutoDelete import check_book
 from .Notifier import ADDRESS_BOOK
 PRIVATE = os.getenv ('PRIVATE') or ''
@@ -297,13 +298,16 @@ def scan_directory(ebook_num):
                 header_found = scan_file(filename, ebook_num)
 
         store_file_in_database(ebook_num, filename, None)
+    Metrics.inc('books_processed_total')
 
-def scan_dopush_log():
+def scan_dopush_log(scanned=None):
     """ Scan the dopush log directory for new files.
 
     Files in this directory are placeholders only. The real files are
     in FILES.
 
+    scanned: if a list, the ebooks scanned are appended to it
+
     """
 
     retcode = 1
@@ -322,12 +326,16 @@ def scan_dopush_log():
             Logger.ebook = ebook_num
             if scan_directory(ebook_num):
                 error(f'No directory for {ebook_num}')
+            elif scanned is not None:
+                scanned.append(ebook_num)
         shutil.move(os.path.join(DOPUSH_LOG_DIR, filename),
                      os.path.join(DOPUSH_LOG_DIR, 'backup', filename))
         retcode = 0
 
     return retcode
 
+# exit code 1: nothing to do
+@Metrics.instrument('fileinfo', ok_codes=(0, 1, None))
 def main():
     Logger.setup(Logger.LOGFORMAT, 'fileinfo.log')
     Logger.set_log_level(2)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: UTF8 -*-
+
+"""
+FileRegistry.py
+
+Copyright 2026 by Project Gutenberg
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+Collects the files built by a job group and registers them in the
+files table all at once: one upsert in one transaction, instead of a
+query and a commit per file as GutenbergFiles.store_file_in_database
+does.  The rows are the same that store_file_in_database writes.
+
+"""
+
+import datetime
+import os
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+
+from libgutenberg import DBUtils
+from libgutenberg.GutenbergFiles import (
+    get_compression, get_diskstatus, get_filetypes, get_obsoleted, guess_filetype,
+    parse_filename, store_file_in_database)
+from libgutenberg.Logger import debug, error, warning
+from libgutenberg.Models import File
+
+# the columns an upsert overwrites
+UPDATE_COLUMNS = ('fk_books', 'filesize', 'filemtime', 'fk_filetypes', 'fk_encodings',
+                  'fk_compressions', 'diskstatus', 'obsoleted')
+
+
+def file_row(ebook, filename, filetype, encoding=None):
+    """ The files table row of filename, or None if it cannot be stored. """
+
+    filedir, filename_nopath, archive_path = parse_filename(filename)
+
+    if filetype == 'txt' and encoding is None:
+        filetype = 'txt.utf-8'
+        encoding = 'utf-8'
+        check_type = False
+    else:
+        guess_type, guess_enc = guess_filetype(filename)
+        filetype, check_type = (filetype, True) if filetype else (guess_type, False)
+        encoding = encoding if encoding else guess_enc
+
+    try:
+        statinfo = os.stat(filename)
+    except OSError:
+        error("Cannot stat %s", filename)
+        return None
+
+    if check_type and filetype not in get_filetypes():
+        warning("%s is not a valid filetype, didn't store %s", filetype, filename)
+        return None
+
+    return {
+        'fk_books': ebook,
+        'filename': archive_path,
+        'filesize': statinfo.st_size,
+        'filemtime': datetime.datetime.fromtimestamp(statinfo.st_mtime),
+        'fk_filetypes': filetype,
+        'fk_encodings': encoding,
+        'fk_compressions': get_compression(filename_nopath),
+        'diskstatus': get_diskstatus(ebook, filedir, filetype),
+        'obsoleted': get_obsoleted(filedir),
+    }
+
+
+class FileRegistry():
+    """ Files waiting to be registered. """
+
+    def __init__(self):
+        self.pending = {} # filename -> (ebook, filetype)
+
+
+    def __len__(self):
+        return len(self.pending)
+
+
+    def add(self, ebook, filename, filetype):
+        """ Register filename at the next flush(). """
+
+        self.pending[filename] = (ebook, filetype)
+
+
+    def flush(self):
+        """ Register the pending files.  Returns how many were stored. """
+
+        if not self.pending:
+            return 0
+        pending, self.pending = self.pending, {}
+        if DBUtils.OB is None:
+            warning("No database: did not store %d files." % len(pending))
+            return 0
+
+        rows = {}
+        for filename, (ebook, filetype) in pending.items():
+            row = file_row(ebook, filename, filetype)
+            if row:
+                rows[row['filename']] = row
+        if not rows:
+            return 0
+
+        table = File.__table__
+        stmt = insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.filename],
+            set_={name: stmt.excluded[name] for name in UPDATE_COLUMNS})
+        try:
+            with DBUtils.OB.engine.begin() as conn:
+                conn.execute(stmt, list(rows.values()))
+        except IntegrityError:
+            # a book not in the database: let store_file_in_database sort it out
+            error("Could not store %d files at once, storing them one by one." % len(rows))
+            for filename, (ebook, filetype) in pending.items():
+                store_file_in_database(ebook, filename, filetype)
+            return len(pending)
+
+        debug("Stored %d files in database." % len(rows))
+        return len(rows)
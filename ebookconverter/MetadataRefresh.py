@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: UTF8 -*-
+
+"""
+MetadataRefresh.py
+
+Copyright 2026 by Project Gutenberg
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+Writes a changed title or changed authors into outputs that are
+otherwise up to date, instead of converting the ebook again.
+
+In the HTML: the <head> metadata and the parts of the pg-header and
+pg-footer that show the title or the authors.  In the EPUBs: the same
+in the content documents, and the OPF and NCX metadata.  Only the
+archive members that change are rewritten.
+
+The other outputs that show the title or the authors (Kindle, plain
+text, generated RST and PDF) cannot be patched this way: they are
+built again, the Kindle files from the patched EPUBs (see
+EbookConverter.Maker.refresh).
+
+"""
+
+import copy
+import os
+import re
+import zipfile
+
+import lxml.html
+from lxml import etree
+
+from libgutenberg.DublinCoreMapping import DublinCoreObject
+from libgutenberg.Logger import debug
+import libgutenberg.GutenbergGlobals as gg
+
+from ebookmaker.writers import HtmlTemplates, remove_cr
+
+# the types whose output can be patched
+PATCHABLE = ('html.images', 'html.noimages', 'epub.images', 'epub.noimages', 'epub3.images')
+
+# the types whose output shows the title or the authors but cannot be
+# patched: TxtWriter and the RST templates write the pg-header too
+REBUILT = ('kindle.images', 'kindle.noimages', 'kf8.images',
+           'txt.utf-8', 'txt.iso-8859-1', 'txt.us-ascii', 'rst.gen',
+           'pdf.images', 'pdf.noimages')
+
+NS_CONTAINER = 'urn:oasis:names:tc:opendocument:xmlns:container'
+NS_OPF = 'http://www.idpf.org/2007/opf'
+NS_DC = 'http://purl.org/dc/elements/1.1/'
+NS_NCX = 'http://www.daisy.org/z3986/2005/ncx/'
+
+# the parts of the pg-header and pg-footer that show the title or the authors
+BOILERPLATE_IDS = ('pg-header-heading', 'pg-header-authlist',
+                   'pg-start-separator', 'pg-end-separator')
+
+# content documents without these need no patching
+MARKERS = (b'pg-header', b'pg-footer', b'dc.title', b'og:title')
+
+HTML_SUFFIXES = ('.htm', '.html', '.xhtml')
+
+
+def load_dc(ebook):
+    """ The metadata of ebook as it is now in the database. """
+
+    dc = DublinCoreObject()
+    dc.load_from_database(ebook, load_files=False)
+    return dc
+
+
+def local_name(elem):
+    """ The tag of elem without its namespace. """
+
+    return etree.QName(elem).localname
+
+
+def qualify(elem, namespace):
+    """ Put elem and its descendants into namespace (None: no namespace). """
+
+    for e in elem.iter(etree.Element):
+        name = local_name(e)
+        e.tag = '{%s}%s' % (namespace, name) if namespace else name
+    return elem
+
+
+def by_id(elem, id_):
+    """ The element with id id_ in elem, or None. """
+
+    found = elem.xpath('descendant-or-self::*[@id=$id]', id=id_)
+    return found[0] if found else None
+
+
+def replace(old, new):
+    """ Put new in the place of old. """
+
+    new.tail = old.tail
+    old.getparent().replace(old, new)
+
+
+def remove(elem):
+    """ Remove elem, keeping its tail unless it is whitespace. """
+
+    parent = elem.getparent()
+    if elem.tail and elem.tail.strip():
+        previous = elem.getprevious()
+        if previous is not None:
+            previous.tail = (previous.tail or '') + elem.tail
+        else:
+            parent.text = (parent.text or '') + elem.tail
+    parent.remove(elem)
+
+
+def is_creator_meta(elem):
+    """ True if elem is a <meta> with the title or an author. """
+
+    name = elem.get('name') or ''
+    return (local_name(elem) == 'meta' and
+            (name in ('dc.title', 'dc.creator') or name.startswith('marcrel.')))
+
+
+def patch_head(root, dc):
+    """ Update the title and the authors in the <head> of root. """
+
+    heads = root.xpath('//*[local-name()="head"]')
+    if not heads:
+        return
+    head = heads[0]
+    namespace = etree.QName(head).namespace
+
+    old = [e for e in head if isinstance(e.tag, str) and is_creator_meta(e)]
+    if old:
+        index = head.index(old[0])
+        tail = old[0].tail
+        for e in old:
+            remove(e)
+        fresh = [e for e in dc.to_html() if is_creator_meta(e)]
+        for e in reversed(fresh):
+            e.tail = tail
+            head.insert(index, qualify(e, namespace))
+
+    for meta in head.xpath('*[local-name()="meta"][@property="og:title"]'):
+        meta.set('content', remove_cr(dc.title))
+    for title in head.xpath('*[local-name()="title"]'):
+        # a title made by ebookmaker (see HTMLWriter.add_moremeta)
+        if (title.text or '').endswith(' | Project Gutenberg'):
+            title.text = f'{dc.title} | Project Gutenberg'
+
+
+def patch_boilerplate(root, dc):
+    """ Update the title and the authors in the pg-header and pg-footer of root. """
+
+    namespace = etree.QName(root).namespace
+    header = qualify(HtmlTemplates.pgheader(dc), namespace)
+    footer = qualify(HtmlTemplates.pgfooter(dc), namespace)
+
+    # the title paragraphs come before the author list
+    old_list = by_id(root, 'pg-header-authlist')
+    if old_list is not None:
+        for p in list(old_list.itersiblings('{*}p', 'p', preceding=True)):
+            remove(p)
+        new_list = by_id(header, 'pg-header-authlist')
+        for p in reversed(list(new_list.itersiblings('{*}p', 'p', preceding=True))):
+            old_list.addprevious(p)
+
+    for id_ in BOILERPLATE_IDS:
+        old = by_id(root, id_)
+        new = by_id(header, id_)
+        if new is None:
+            new = by_id(footer, id_)
+        if old is not None and new is not None:
+            replace(old, new)
+
+
+def serialize(root):
+    """ Serialize an HTML document the way ebookmaker's HTMLWriter does. """
+
+    htmlbytes = etree.tostring(root, method='html', doctype=gg.HTML5_DOCTYPE,
+                               encoding='utf-8', pretty_print=False)
+    # lxml refuses to omit close tags for these elements
+    for newtag in [b'</wbr>', b'</source>']:
+        htmlbytes = htmlbytes.replace(newtag, b'')
+    return htmlbytes
+
+
+def patch_html(path, dc):
+    """ Patch the HTML file at path.  Returns the new contents. """
+
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    root = lxml.html.document_fromstring(data, parser=lxml.html.HTMLParser(encoding='utf-8'))
+    patch_head(root, dc)
+    patch_boilerplate(root, dc)
+    etree.cleanup_namespaces(root)
+    data = serialize(root)
+
+    with open(path + '.tmp', 'wb') as fp:
+        fp.write(data)
+    os.replace(path + '.tmp', path)
+    debug('Refreshed metadata in %s' % path)
+    return data
+
+
+def patch_xhtml(data, dc):
+    """ Patch an EPUB content document.  Returns the new contents. """
+
+    root = etree.fromstring(data)
+    patch_head(root, dc)
+    patch_boilerplate(root, dc)
+    return etree.tostring(root.getroottree(), encoding='utf-8', xml_declaration=True)
+
+
+def opf_authors(metadata, dc, epub3):
+    """ Make the OPF elements of the authors, the way ebookmaker does. """
+
+    elems = []
+    for count, author in enumerate(dc.authors):
+        pretty_name = dc.make_pretty_name(author.name)
+        tag = 'creator' if author.marcrel in ('aut', 'cre') else 'contributor'
+        if epub3:
+            elem = etree.SubElement(metadata, '{%s}%s' % (NS_DC, tag), id=f'author_{count}')
+            elem.text = pretty_name
+            elems.append(elem)
+            elem = etree.SubElement(metadata, '{%s}meta' % NS_OPF,
+                                    property='file-as', refines=f'#author_{count}')
+            elem.text = author.name
+            elems.append(elem)
+            elem = etree.SubElement(metadata, '{%s}meta' % NS_OPF, property='role',
+                                    refines=f'#author_{count}', scheme='marc:relators')
+            elem.text = author.marcrel
+            elems.append(elem)
+        else:
+            attrib = {'{%s}file-as' % NS_OPF: author.name}
+            if tag == 'contributor':
+                attrib['{%s}role' % NS_OPF] = author.marcrel
+            elem = etree.SubElement(metadata, '{%s}%s' % (NS_DC, tag), attrib)
+            elem.text = pretty_name
+            elems.append(elem)
+    return elems
+
+
+def patch_opf(data, dc):
+    """ Patch the title and the authors in content.opf.  Returns the new contents. """
+
+    root = etree.fromstring(data)
+    epub3 = (root.get('version') or '').startswith('3')
+    metadata = root.find('{%s}metadata' % NS_OPF)
+
+    old = [e for e in metadata if e.tag in (
+        '{%s}creator' % NS_DC, '{%s}contributor' % NS_DC, '{%s}title' % NS_DC)]
+    ids = {'#' + e.get('id') for e in old if e.get('id')}
+    old += [e for e in metadata if e.tag == '{%s}meta' % NS_OPF and e.get('refines') in ids]
+    index = metadata.index(old[0]) if old else len(metadata)
+    tail = old[0].tail if old else None
+    for e in old:
+        remove(e)
+
+    fresh = opf_authors(metadata, dc, epub3)
+    title = etree.SubElement(metadata, '{%s}title' % NS_DC)
+    # replace newlines with /
+    title.text = re.sub(r'\s*[\r\n]+\s*', ' / ', dc.title)
+    fresh.append(title)
+    for e in reversed(fresh):
+        e.tail = tail
+        metadata.insert(index, e)
+
+    return etree.tostring(root.getroottree(), encoding='utf-8', xml_declaration=True)
+
+
+def patch_ncx(data, dc):
+    """ Patch the title in toc.ncx.  Returns the new contents. """
+
+    root = etree.fromstring(data)
+    for text in root.iterfind('{%s}docTitle/{%s}text' % (NS_NCX, NS_NCX)):
+        text.text = dc.title
+    return etree.tostring(root.getroottree(), encoding='utf-8', xml_declaration=True)
+
+
+def rewrite_members(path, members):
+    """ Replace members of the zip archive at path.
+
+    members: a dict name -> new contents.  The other members are
+    copied unchanged, in the same order and with the same compression.
+
+    """
+
+    with zipfile.ZipFile(path) as zin, \
+         zipfile.ZipFile(path + '.tmp', 'w') as zout:
+        for info in zin.infolist():
+            data = members.get(info.filename)
+            if data is None:
+                data = zin.read(info)
+            zout.writestr(copy.copy(info), data)
+    os.replace(path + '.tmp', path)
+
+
+def patch_epub(path, dc):
+    """ Patch the EPUB at path.  Returns the names of the members changed. """
+
+    members = {}
+    with zipfile.ZipFile(path) as zin:
+        container = etree.fromstring(zin.read('META-INF/container.xml'))
+        for rootfile in container.iterfind('.//{%s}rootfile' % NS_CONTAINER):
+            name = rootfile.get('full-path')
+            members[name] = patch_opf(zin.read(name), dc)
+
+        for name in zin.namelist():
+            if name.endswith('.ncx'):
+                members[name] = patch_ncx(zin.read(name), dc)
+            elif name.lower().endswith(HTML_SUFFIXES):
+                data = zin.read(name)
+                if any(marker in data for marker in MARKERS):
+                    members[name] = patch_xhtml(data, dc)
+
+    rewrite_members(path, members)
+    debug('Refreshed metadata in %s: %s' % (path, ' '.join(sorted(members))))
+    return sorted(members)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: UTF8 -*-
+
+"""
+Metrics.py
+
+Copyright 2026 by Project Gutenberg
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+Writes the metrics of a cron job run in the node_exporter textfile
+format, to $METRICS_DIR/pg_<job>.prom (default: $PRIVATE/metrics).
+Point node_exporter's --collector.textfile.directory there.  Nothing
+is written if neither is set, or if the run did nothing (--help, a
+bad option): it counted nothing and raised no exception.
+
+Wrap an entry point in instrument() and count things with inc():
+
+  @Metrics.instrument('fileinfo')
+  def main():
+      ...
+      Metrics.inc('books_processed_total')
+
+An entry point run by several cron jobs at once calls set_job() to
+write a file of its own for each.
+
+Every file has the run's duration, its database queries, whether it
+succeeded, and the time of the last run and the last successful run.
+
+"""
+
+import collections
+import functools
+import os
+import re
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from libgutenberg.Logger import debug, warning
+
+PRIVATE = os.getenv('PRIVATE') or ''
+METRICS_DIR = os.getenv('METRICS_DIR') or (os.path.join(PRIVATE, 'metrics') if PRIVATE else None)
+PREFIX = 'pg_'
+
+HELP = {
+    'books_processed_total':  'Ebooks processed by the last run.',
+    'jobs_total':             'Jobs of the last run by type and outcome.',
+    'job_seconds_total':      'Wall time of the jobs of the last run by type.',
+    'db_queries_total':       'Database queries made by the last run.',
+    'run_duration_seconds':   'Wall time of the last run.',
+    'run_success':            '1 if the last run succeeded.',
+    'last_run_timestamp_seconds':     'When the last run ended.',
+    'last_success_timestamp_seconds': 'When the last successful run ended.',
+}
+
+current = None
+
+
+class Metrics():
+    """ The metrics of one run of job. """
+
+    def __init__(self, job):
+        self.job = job
+        self.values = collections.Counter() # (name, sorted labels) -> value
+        self.start_time = time.time()
+
+
+    def inc(self, name, amount=1, **labels):
+        """ Add amount to a counter. """
+        self.values[name, tuple(sorted(labels.items()))] += amount
+
+
+    def set(self, name, value, **labels):
+        """ Set a gauge. """
+        self.values[name, tuple(sorted(labels.items()))] = value
+
+
+    def did_work(self):
+        """ True if anything was counted. """
+        return any(self.values.values())
+
+
+    def path(self):
+        """ The textfile of this job. """
+        return os.path.join(METRICS_DIR, '%s%s.prom' % (PREFIX, self.job))
+
+
+    def last_success(self):
+        """ The last success time written by an earlier run, or 0. """
+
+        pattern = re.compile(r'^%slast_success_timestamp_seconds\{.*\} (\S+)$' % PREFIX)
+        try:
+            with open(self.path(), 'r') as fp:
+                for line in fp:
+                    match = pattern.match(line)
+                    if match:
+                        return float(match.group(1))
+        except (OSError, ValueError):
+            pass
+        return 0
+
+
+    def render(self):
+        """ Return the metrics in textfile format. """
+
+        lines = []
+        names = sorted({name for name, dummy_labels in self.values})
+        for name in names:
+            metric = PREFIX + name
+            lines.append('# HELP %s %s' % (metric, HELP.get(name, name)))
+            lines.append('# TYPE %s %s' % (metric, 'counter' if name.endswith('_total') else 'gauge'))
+            for (other, labels), value in sorted(self.values.items()):
+                if other != name:
+                    continue
+                labels = (('job', self.job),) + labels
+                lines.append('%s{%s} %s' % (
+                    metric,
+                    ','.join('%s="%s"' % (key, escape(label)) for key, label in labels),
+                    format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+    def write(self, success):
+        """ Finish the run and write the textfile. """
+
+        if not METRICS_DIR:
+            return
+        now = time.time()
+        self.set('run_duration_seconds', now - self.start_time)
+        self.set('run_success', 1 if success else 0)
+        self.set('last_run_timestamp_seconds', now)
+        self.set('last_success_timestamp_seconds', now if success else self.last_success())
+
+        try:
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            fn = self.path()
+            # node_exporter must never see half a file
+            with open(fn + '.tmp', 'w') as fp:
+                fp.write(self.render())
+            os.replace(fn + '.tmp', fn)
+        except OSError as what:
+            warning("Could not write metrics: %s" % what)
+
+
+def escape(value):
+    """ Escape a label value. """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    """ Format a sample value. """
+    if isinstance(value, float) and not value.is_integer():
+        return '%.3f' % value
+    return '%d' % value
+
+
+def inc(name, amount=1, **labels):
+    """ Add amount to a counter of the current run, if any. """
+    if current:
+        current.inc(name, amount, **labels)
+
+
+def set_job(job):
+    """ Rename the job of the current run, if any.
+
+    For entry points run by several cron jobs at once, which learn
+    from their options which one they are.
+
+    """
+
+    if not re.match(r'^[\w.-]+$', job):
+        raise ValueError('bad metrics job name: %s' % job)
+    if current:
+        current.job = job
+
+
+def count_query(*dummy_args):
+    """ sqlalchemy before_cursor_execute listener. """
+    inc('db_queries_total')
+
+
+def instrument(job, ok_codes=(0, None)):
+    """ Decorate an entry point to write the metrics of each run.
+
+    The run failed if the entry point raised, or returned or exited
+    with a code not in ok_codes.
+
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            global current
+            current = Metrics(job)
+            current.inc('db_queries_total', 0)
+            event.listen(Engine, 'before_cursor_execute', count_query)
+            success = crashed = False
+            try:
+                result = func(*args, **kwargs)
+                success = result in ok_codes
+                return result
+            except SystemExit as what:
+                success = what.code in ok_codes
+                raise
+            except BaseException:
+                crashed = True
+                raise
+            finally:
+                event.remove(Engine, 'before_cursor_execute', count_query)
+                if crashed or current.did_work():
+                    current.write(success)
+                else:
+                    debug("Nothing done: no metrics written for %s" % current.job)
+                current = None
+        return wrapper
+    return decorator
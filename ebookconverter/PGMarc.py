@@ -29,6 +29,8 @@ from libgutenberg import GutenbergDatabase
 from libgutenberg.DublinCoreMapping import DublinCoreObject
 from libgutenberg.Models import Book
 
+from ebookconverter import Metrics
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
@@ -509,6 +511,7 @@ def book_record(dc):
 
 MAXBOOKNUM = 99998 # 99999 is a dummy record
 
+@Metrics.instrument('pgmarc')
 def main():
     try:
         if len(sys.argv) == 1:
@@ -558,6 +561,7 @@ def main():
             # Check if the record is a valid pymarc.Record object
             if isinstance(record, Record):
                 records.append(record)
+                Metrics.inc('books_processed_total')
             else:
                 warning(f"Skipping invalid record for book number {booknum.pk}")
             if booknum.pk > MAXBOOKNUM:
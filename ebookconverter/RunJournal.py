@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: UTF8 -*-
+
+"""
+RunJournal.py
+
+Copyright 2026 by Project Gutenberg
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+Remembers which ebooks a long conversion run has finished, so that a
+run that was stopped or killed can be resumed with the same run id.
+
+The journal is a text file with one ebook number per line.
+
+Also keeps the list of jobs that were killed for taking too long, so
+that they can be retried one ebook at a time.
+
+"""
+
+import collections
+import datetime
+import json
+import os
+import re
+
+from libgutenberg.Logger import info
+
+PRIVATE = os.getenv('PRIVATE') or ''
+JOURNAL_DIR = os.path.join(PRIVATE, 'logs', 'journal')
+TIMEOUTS_FILE = 'timeouts.jsonl'
+
+
+class RunJournal():
+    """ The journal of one run id. """
+
+    def __init__(self, run_id):
+        if not re.match(r'^[\w.-]+$', run_id):
+            raise ValueError('bad run id: %s' % run_id)
+        self.run_id = run_id
+        self.path = os.path.join(JOURNAL_DIR, run_id + '.journal')
+
+
+    def done(self):
+        """ Return the set of ebooks finished by this run. """
+
+        done = set()
+        try:
+            with open(self.path, 'r') as fp:
+                for line in fp:
+                    # a line cut short when we were killed has no newline
+                    if line.endswith('\n'):
+                        done.add(int(line))
+        except FileNotFoundError:
+            pass
+        info("Run %s has finished %d ebooks" % (self.run_id, len(done)))
+        return done
+
+
+    def record(self, ebooks):
+        """ Record ebooks as finished. """
+
+        if not ebooks:
+            return
+        os.makedirs(JOURNAL_DIR, exist_ok=True)
+        with open(self.path, 'a+b') as fp:
+            # drop a line cut short when we were killed, lest the next
+            # ebook be appended to it
+            size = fp.seek(0, os.SEEK_END)
+            tail = max(0, size - 64)
+            fp.seek(tail)
+            last = fp.read()
+            if last and not last.endswith(b'\n'):
+                fp.truncate(tail + last.rfind(b'\n') + 1)
+            fp.write(''.join('%d\n' % ebook for ebook in ebooks).encode('ascii'))
+            fp.flush()
+            os.fsync(fp.fileno())
+
+
+def record_timeout(job, seconds):
+    """ Remember a job that was killed after seconds. """
+
+    os.makedirs(JOURNAL_DIR, exist_ok=True)
+    with open(os.path.join(JOURNAL_DIR, TIMEOUTS_FILE), 'a') as fp:
+        fp.write(json.dumps({
+            'ebook': job.ebook,
+            'type': job.type,
+            'seconds': round(seconds, 1),
+            'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        }) + '\n')
+
+
+def read_timeouts():
+    """ Return the jobs that timed out as a dict ebook -> set of types,
+    and the number of bytes of the list read (see drop_timeouts). """
+
+    path = os.path.join(JOURNAL_DIR, TIMEOUTS_FILE)
+    timeouts = collections.defaultdict(set)
+    size = 0
+    try:
+        with open(path, 'rb') as fp:
+            for line in fp:
+                # a line cut short when we were killed has no newline
+                if not line.endswith(b'\n'):
+                    break
+                size += len(line)
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                timeouts[record['ebook']].add(record['type'])
+    except FileNotFoundError:
+        pass
+    return timeouts, size
+
+
+def drop_timeouts(size, ebooks):
+    """ Remove the jobs of ebooks from the first size bytes of the list
+    of jobs that timed out: the jobs retried.  Jobs that timed out since
+    are kept.  The jobs removed are kept in a file of their own until
+    the next time. """
+
+    path = os.path.join(JOURNAL_DIR, TIMEOUTS_FILE)
+    if not size:
+        return
+    ebooks = set(ebooks)
+    retried = []
+    kept = []
+    with open(path, 'rb') as fp:
+        for line in fp.read(size).splitlines(keepends=True):
+            try:
+                ebook = json.loads(line)['ebook']
+            except (ValueError, KeyError):
+                ebook = None
+            (retried if ebook in ebooks else kept).append(line)
+        kept.append(fp.read())
+    with open(path + '.old', 'wb') as fp:
+        fp.write(b''.join(retried))
+    with open(path + '.tmp', 'wb') as fp:
+        fp.write(b''.join(kept))
+    os.replace(path + '.tmp', path)
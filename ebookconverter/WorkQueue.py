@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: UTF8 -*-
+
+"""
+WorkQueue.py
+
+Copyright 2026 by Project Gutenberg
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+A queue of ebooks to convert, kept in the database, so that converter
+processes on several machines sharing the cache can split a big run.
+
+One process seeds a named queue (ebookconverter --queue NAME --enqueue
+--range ...), then any number of processes drain it (ebookconverter
+--queue NAME).  A process claims a batch of ebooks with SELECT ... FOR
+UPDATE SKIP LOCKED, so no two claim the same ebook, and keeps the
+heartbeat of its claims fresh while it works on them.  Ebooks done are
+deleted from the queue.  The claims of a process that died go stale
+and are taken over by the next process that asks for work.
+
+A queued ebook is a rebuild request: the types to build (none: what
+the converter is told to build), a priority and the reasons it was
+asked for.  Requests for an ebook already queued are merged into one;
+a request without types asks for everything, so it absorbs the types
+of the requests it is merged with.  A request is dropped if a pending
+request of the same or higher priority already asks for all its types.  A request for an ebook that
+is being built is kept for another build, as the build may have
+started before the change that asked for it.
+
+The producers (dopush, AutoRebuild, fixup scripts, --enqueue) share
+REBUILD_QUEUE.  A converter run that builds ebooks directly takes over
+the pending requests its build satisfies (see claim_ebooks).
+
+The table is created, or upgraded, once with ebookconverter
+--install-queue (see install).
+
+"""
+
+import datetime
+import os
+import socket
+import threading
+
+from sqlalchemy import (Column, DateTime, Integer, MetaData, Table, Text,
+                        and_, func, inspect, or_, select, text, update, delete)
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+
+from libgutenberg import DBUtils
+from libgutenberg.Logger import debug, exception
+
+TABLE_NAME = 'ebookconverter_queue'
+REBUILD_QUEUE = 'rebuild'
+# a claim whose heartbeat is older than this is up for grabs
+STALE = 600
+HEARTBEAT = 60
+
+metadata = MetaData()
+
+queue_table = Table(
+    TABLE_NAME, metadata,
+    Column('queue',      Text,    primary_key=True),
+    Column('ebook',      Integer, primary_key=True),
+    Column('priority',   Integer, nullable=False, server_default='0'),
+    Column('enqueued',   DateTime(timezone=True), nullable=False, server_default=func.now()),
+    Column('claimed_by', Text),
+    Column('heartbeat',  DateTime(timezone=True)),
+    Column('attempts',   Integer, nullable=False, server_default='0'),
+    Column('types',      ARRAY(Text), nullable=False, server_default='{}'),
+    Column('reasons',    ARRAY(Text), nullable=False, server_default='{}'),
+    Column('claimed',    DateTime(timezone=True)),
+)
+
+# columns added since the table was first created
+UPGRADE_COLUMNS = {
+    'types':   "text[] not null default '{}'",
+    'reasons': "text[] not null default '{}'",
+    'claimed': "timestamp with time zone",
+}
+
+def merge_arrays(column):
+    """ SQL for the sorted union of column and the new request's column. """
+    return text('array(select distinct unnest(%s.%s || excluded.%s) order by 1)' %
+                (TABLE_NAME, column, column))
+
+
+def merge_types():
+    """ SQL for the types of a merged request: none (everything) if
+    either request asks for everything, else the union. """
+    return text("case when cardinality(%s.types) = 0 or cardinality(excluded.types) = 0 "
+                "then '{}'::text[] else %s end" % (TABLE_NAME, merge_arrays('types').text))
+
+
+class NoDatabase(Exception):
+    """ Raised when there is no database to keep a queue in. """
+
+
+def get_engine(engine=None):
+    """ engine, or the engine of the configured database. """
+
+    if engine is not None:
+        return engine
+    if DBUtils.OB is None:
+        raise NoDatabase('no database configured')
+    return DBUtils.OB.engine
+
+
+def install(engine=None):
+    """ Create the queue table, or add the columns a table made by an
+    older version lacks. """
+
+    engine = get_engine(engine)
+    metadata.create_all(engine, checkfirst=True)
+    have = {column['name'] for column in inspect(engine).get_columns(TABLE_NAME)}
+    missing = [name for name in UPGRADE_COLUMNS if name not in have]
+    if missing:
+        with engine.begin() as conn:
+            conn.execute(text('alter table %s %s' % (TABLE_NAME, ', '.join(
+                'add column if not exists %s %s' % (name, UPGRADE_COLUMNS[name])
+                for name in missing))))
+
+
+def worker_id():
+    """ Name this process in claims. """
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+class WorkQueue():
+    """ A named queue of ebooks in the database. """
+
+    def __init__(self, name, engine=None, stale=STALE):
+        self.name = name
+        self.engine = get_engine(engine)
+        self.stale = datetime.timedelta(seconds=stale)
+        self.worker = worker_id()
+        self.claimed = set()
+        self.requests = {} # claimed ebook -> (types, reasons)
+        self.heartbeat_stop = None
+
+
+    def enqueue(self, ebooks, priority=0, types=(), reason=None):
+        """ Request a rebuild of ebooks.
+
+        Returns how many requests were added or merged, ie. not dropped.
+
+        """
+
+        ebooks = sorted(set(ebooks))
+        if not ebooks:
+            return 0
+        q = queue_table.c
+        stmt = insert(queue_table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[q.queue, q.ebook],
+            set_={
+                'priority': func.greatest(q.priority, stmt.excluded.priority),
+                'types': merge_types(),
+                'reasons': merge_arrays('reasons'),
+                'enqueued': func.now(),
+            },
+            where=or_(q.claimed_by.isnot(None),
+                      q.priority < stmt.excluded.priority,
+                      # a pending request for everything covers any types
+                      and_(func.cardinality(q.types) > 0,
+                           or_(func.cardinality(stmt.excluded.types) == 0,
+                               ~q.types.contains(stmt.excluded.types)))),
+        ).returning(q.ebook)
+        types = sorted(set(types))
+        reasons = [reason] if reason else []
+        with self.engine.begin() as conn:
+            added = conn.execute(stmt, [
+                {'queue': self.name, 'ebook': ebook, 'priority': priority,
+                 'types': types, 'reasons': reasons}
+                for ebook in ebooks
+            ]).all()
+        debug("Queued %d of %d ebooks in %s" % (len(added), len(ebooks), self.name))
+        return len(added)
+
+
+    def claim(self, n):
+        """ Claim up to n ebooks, highest priority first.
+
+        Ebooks claimed by other processes are skipped, unless their
+        claim went stale.  Returns the sorted list of ebooks claimed.
+
+        """
+
+        q = queue_table.c
+        claimable = (
+            select(q.ebook)
+            .where(q.queue == self.name)
+            .where(or_(q.claimed_by.is_(None), q.heartbeat < func.now() - self.stale))
+            .order_by(q.priority.desc(), q.ebook)
+            .limit(n)
+            .with_for_update(skip_locked=True)
+        )
+        return self.claim_where(q.ebook.in_(claimable))
+
+
+    def claim_ebooks(self, ebooks, types):
+        """ Claim the pending requests for ebooks that a build of types satisfies. """
+
+        q = queue_table.c
+        ebooks = sorted(set(ebooks))
+        if not ebooks:
+            return []
+        return self.claim_where(
+            q.ebook == func.any(ebooks),
+            or_(q.claimed_by.is_(None), q.heartbeat < func.now() - self.stale),
+            q.types.contained_by(sorted(set(types))),
+            func.cardinality(q.types) > 0)
+
+
+    def claim_where(self, *criteria):
+        """ Claim the requests matching criteria.  Returns the sorted list of ebooks. """
+
+        q = queue_table.c
+        stmt = (
+            update(queue_table)
+            .where(q.queue == self.name, *criteria)
+            .values(claimed_by=self.worker, heartbeat=func.now(), claimed=func.now(),
+                    attempts=q.attempts + 1)
+            .returning(q.ebook, q.types, q.reasons)
+        )
+        with self.engine.begin() as conn:
+            rows = conn.execute(stmt).all()
+        for ebook, types, reasons in rows:
+            self.requests[ebook] = (tuple(types), tuple(reasons))
+        ebooks = sorted(ebook for ebook, dummy_types, dummy_reasons in rows)
+        self.claimed.update(ebooks)
+        debug("Claimed %d ebooks from queue %s" % (len(ebooks), self.name))
+        return ebooks
+
+
+    def heartbeat(self):
+        """ Tell other processes our claims are still being worked on. """
+
+        q = queue_table.c
+        with self.engine.begin() as conn:
+            conn.execute(
+                update(queue_table)
+                .where(q.queue == self.name)
+                .where(q.claimed_by == self.worker)
+                .values(heartbeat=func.now())
+            )
+
+
+    def complete(self, ebooks):
+        """ Remove ebooks done from the queue.
+
+        Requests merged while an ebook was being built stay queued.
+
+        """
+
+        ebooks = list(ebooks)
+        if not ebooks:
+            return
+        q = queue_table.c
+        with self.engine.begin() as conn:
+            conn.execute(
+                delete(queue_table)
+                .where(q.queue == self.name)
+                .where(q.claimed_by == self.worker)
+                .where(q.ebook.in_(ebooks))
+                .where(q.enqueued <= q.claimed)
+            )
+        self.release(ebooks)
+
+
+    def release(self, ebooks):
+        """ Give back ebooks we did not get to. """
+
+        ebooks = list(ebooks)
+        if not ebooks:
+            return
+        q = queue_table.c
+        with self.engine.begin() as conn:
+            conn.execute(
+                update(queue_table)
+                .where(q.queue == self.name)
+                .where(q.claimed_by == self.worker)
+                .where(q.ebook.in_(ebooks))
+                .values(claimed_by=None, heartbeat=None)
+            )
+        self.claimed.difference_update(ebooks)
+        for ebook in ebooks:
+            self.requests.pop(ebook, None)
+
+
+    def pending(self):
+        """ The number of ebooks in the queue, claimed or not. """
+
+        q = queue_table.c
+        with self.engine.connect() as conn:
+            return conn.execute(
+                select(func.count()).select_from(queue_table).where(q.queue == self.name)
+            ).scalar()
+
+
+    def start_heartbeat(self, interval=HEARTBEAT):
+        """ Beat in a thread until stop_heartbeat(). """
+
+        self.heartbeat_stop = threading.Event()
+
+        def beat(stop):
+            while not stop.wait(interval):
+                try:
+                    self.heartbeat()
+                except Exception as what:
+                    # the next beat may get through
+                    exception(what)
+
+        threading.Thread(target=beat, args=(self.heartbeat_stop,), daemon=True).start()
+
+
+    def stop_heartbeat(self):
+        """ Stop beating. """
+
+        if self.heartbeat_stop:
+            self.heartbeat_stop.set()
+            self.heartbeat_stop = None
+
+
+def parse_shard(shard):
+    """ Parse 'i/n' into (i, n), with 0 <= i < n. """
+
+    try:
+        i, n = (int(x) for x in shard.split('/'))
+    except ValueError:
+        raise ValueError("--shard must look like i/n: %s" % shard)
+    if not 0 <= i < n:
+        raise ValueError("--shard i/n needs 0 <= i < n: %s" % shard)
+    return i, n
+
+
+def shard_range(ebooks, i, n):
+    """ The ebooks of shard i of n. """
+
+    return [ebook for ebook in ebooks if ebook % n == i]
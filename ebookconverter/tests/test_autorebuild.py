@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import datetime
+import os
+import tempfile
+import unittest
+
+from .. import AutoRebuild
+
+class TestAutoRebuild(unittest.TestCase):
+    def test_check_sql(self):
+        self.assertEqual(AutoRebuild.check_sql(
+            'update mn_books_authors set fk_roles = \'aut\' where fk_books = 4554 and fk_authors = 7'),
+            ('book', 4554))
+        self.assertEqual(AutoRebuild.check_sql(
+            'insert into mn_books_authors (fk_books, fk_authors, fk_roles) values (4554, 7, \'aut\')'),
+            ('book', 4554))
+        self.assertEqual(AutoRebuild.check_sql(
+            'update attributes set  "fk_attriblist" = 245, "text" = \'Title\' where pk = 123456'),
+            ('attrib', 123456))
+        self.assertIsNone(AutoRebuild.check_sql('update books set downloads = 3 where pk = 4554'))
+
+    def test_watermark(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'logs', 'autorebuild.watermark')
+            self.assertEqual(AutoRebuild.read_watermark(path), (None, set()))
+            time = datetime.datetime(2026, 1, 2, 3, 4, 5, 678)
+            AutoRebuild.write_watermark(time, {'a', 'b'}, path)
+            self.assertEqual(AutoRebuild.read_watermark(path), (time, {'a', 'b'}))
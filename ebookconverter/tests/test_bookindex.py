@@ -0,0 +1,24 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import unittest
+
+from .. import BookIndex
+
+class TestBitmap(unittest.TestCase):
+    def test_bitmap(self):
+        bitmap = BookIndex.Bitmap([1, 8, 4554, 77000])
+        for n in (1, 8, 4554, 77000):
+            self.assertIn(n, bitmap)
+        for n in (0, 2, 7, 9, 4553, 76999, 77001, 1000000, -1):
+            self.assertNotIn(n, bitmap)
+        self.assertEqual(len(bitmap), 4)
+        bitmap.add(2)
+        self.assertIn(2, bitmap)
+        self.assertEqual(len(bitmap), 5)
+
+
+class TestBookIndex(unittest.TestCase):
+    def test_book_index(self):
+        book_index = BookIndex.BookIndex()
+        self.assertIn(4554, book_index.existing)
+        self.assertNotIn(4554, book_index.not_text)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+import unittest
+
+from ebookmaker import CommonCode
+from libgutenberg.GutenbergGlobals import Struct
+
+from .. import BuildPlan, ConversionLog
+
+class TestBuildPlan(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_timings(self):
+        path = os.path.join(self.tempdir.name, 'run.jsonl')
+        log = ConversionLog.ConversionLog(path)
+        log.record(1, 'epub.images', 'done', seconds=10.0, input_size=1000)
+        log.record(2, 'epub.images', 'done', seconds=30.0, input_size=3000)
+        log.record(3, 'epub.images', 'timeout', seconds=600.0, input_size=1000)
+        log.record(1, 'rdf', 'done', seconds=1.0)
+        log.close()
+
+        timing = BuildPlan.timings([path])
+        self.assertEqual(timing['epub.images'], (0.01, 10.0))
+        self.assertEqual(BuildPlan.estimate_seconds(timing, 'epub.images', 5000), 50.0)
+        self.assertEqual(BuildPlan.estimate_seconds(timing, 'rdf', None), 1.0)
+        self.assertEqual(BuildPlan.estimate_seconds(timing, 'pdf.images', 5000), 0.0)
+
+    def test_round_trip(self):
+        jobs = []
+        for ebook, type_ in ((1, 'html.images'), (1, 'epub.images'), (2, 'rdf')):
+            job = CommonCode.Job(type_)
+            job.ebook = ebook
+            job.url = 'file:///files/%d/%d-h.htm' % (ebook, ebook)
+            job.outputdir = '/cache/%d' % ebook
+            job.include = ['file:///files/%d/*' % ebook]
+            job.memory = 300 * 1024 * 1024
+            jobs.append(job)
+        # see Maker.refresh
+        jobs[1].derived_url = '/cache/1/pg1-images.epub'
+
+        path = os.path.join(self.tempdir.name, 'plan.jsonl')
+        writer = BuildPlan.PlanWriter(path)
+        group = Struct()
+        group.job_queue = jobs[:2]
+        writer.group(group)
+        writer.skipped(1, 'pdf.images', reason='source too big', input_size=10)
+        group.job_queue = jobs[2:]
+        writer.group(group)
+        writer.close()
+        self.assertEqual((writer.groups, writer.jobs), (2, 3))
+
+        plan = BuildPlan.read_plan(path)
+        self.assertEqual([(group_no, job.ebook, job.type) for group_no, job in plan],
+                         [(1, 1, 'html.images'), (1, 1, 'epub.images'), (2, 2, 'rdf')])
+        job = plan[0][1]
+        self.assertEqual(job.maintype, 'html')
+        self.assertEqual(job.include, jobs[0].include)
+        self.assertEqual(job.memory, jobs[0].memory)
+        self.assertFalse(hasattr(job, 'old_mtime'))
+        self.assertEqual(plan[1][1].derived_url, jobs[1].derived_url)
@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import fnmatch
 import unittest
 
+from libgutenberg.GutenbergGlobals import Struct
 
 from .. import Candidates
 from ebookconverter.EbookConverter import PREFERRED_INPUT_FORMATS
@@ -22,3 +24,65 @@ class TestCandidates(unittest.TestCase):
         files = candidates.read_from_database(self.ebook2)
         cf = Candidates.Candidates.filter_sort(typeglob_list, files, lambda x: x.format)
         self.assertEqual(cf[0].archive_path, 'files/9846/9846-h/9846-h.htm')
+
+    def test_read_many(self):
+        candidates = Candidates.Candidates()
+        result = candidates.read_many([self.ebook, self.ebook2])
+        self.assertEqual(set(result), {self.ebook, self.ebook2})
+        single = candidates.read_from_database(self.ebook2)
+        self.assertEqual([c.archive_path for c in result[self.ebook2]],
+                         [c.archive_path for c in single])
+
+
+def candidate(archive_path, format_, generated=False):
+    result = Struct()
+    result.archive_path = archive_path
+    result.format = format_
+    result.generated = generated
+    return result
+
+
+class TestCandidateIndex(unittest.TestCase):
+    def setUp(self):
+        self.files = []
+        for archive_path, format_ in (
+                ('files/1/1-0.txt', 'txt/utf-8'),
+                ('files/1/1-h/1-h.htm', 'html/iso-8859-1'),
+                ('files/1/1.txt', 'txt/us-ascii'),
+                ('files/1/1-8.txt', 'txt/iso-8859-1'),
+                ('files/1/1-h/1-h.html', 'html/utf-8')):
+            self.files.append(candidate(archive_path, format_))
+
+    def test_same_order_as_fnmatch(self):
+        def fnmatch_filter_sort(typeglob_list, candidates):
+            result = []
+            for typeglob in typeglob_list:
+                for candidate in candidates:
+                    if fnmatch.fnmatch(candidate.format, typeglob) and candidate not in result:
+                        result.append(candidate)
+            return result
+
+        index = Candidates.CandidateIndex(self.files, lambda x: x.format)
+        for type_, typeglob_list in PREFERRED_INPUT_FORMATS.items():
+            self.assertEqual(index.filter_sort(typeglob_list),
+                             fnmatch_filter_sort(typeglob_list, self.files), type_)
+
+    def test_insert(self):
+        index = Candidates.CandidateIndex(self.files, lambda x: x.format)
+        self.assertEqual(index.filter_sort(('html/*',))[0].archive_path, 'files/1/1-h/1-h.htm')
+        index.insert(candidate('pg1.html', 'html/utf-8', generated=True))
+        self.assertEqual(index.filter_sort(('html/*',))[0].archive_path, 'pg1.html')
+        self.assertEqual(index.filter_sort(('html/utf-8',))[0].archive_path, 'pg1.html')
+
+    def test_insert_keeps_other_results(self):
+        index = Candidates.CandidateIndex(self.files, lambda x: x.format)
+        txt = index.filter_sort(('txt/*',))
+        index.filter_sort(('html/*',))
+        index.insert(candidate('pg1-images.epub', 'epub.images/unknown', generated=True))
+        self.assertEqual(set(index.memo), {('txt/*',), ('html/*',)})
+        index.insert(candidate('pg1.txt', 'txt.utf-8/unknown', generated=True))
+        self.assertEqual(set(index.memo), {('txt/*',), ('html/*',)})
+        index.insert(candidate('pg1.html', 'html/utf-8', generated=True))
+        self.assertEqual(set(index.memo), {('txt/*',)})
+        self.assertEqual(index.filter_sort(('txt/*',)), txt)
+        self.assertEqual(index.filter_sort(('html/*',))[0].archive_path, 'pg1.html')
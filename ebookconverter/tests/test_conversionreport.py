@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import io
+import os
+import tempfile
+import unittest
+
+from .. import ConversionLog, ConversionReport
+
+class TestConversionReport(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, 'conversions', 'test.jsonl')
+        log = ConversionLog.ConversionLog(self.path)
+        for ebook, seconds in ((1, 10.0), (2, 20.0), (3, 30.0), (4, 40.0)):
+            log.record(ebook, 'epub.images', 'done', seconds=seconds, cpu=seconds / 2,
+                       peak_rss=seconds * 1024 * 1024)
+        log.record(5, 'epub.images', 'timeout', seconds=600.0)
+        log.record(1, 'kindle.images', 'skipped', reason='built from unchanged source')
+        log.close()
+        with open(self.path, 'a') as fp:
+            fp.write('{"ebook": 6, "ty') # cut short
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(ConversionReport.percentile(values, 50), 50)
+        self.assertEqual(ConversionReport.percentile(values, 95), 95)
+        self.assertEqual(ConversionReport.percentile([7], 95), 7)
+        self.assertEqual(ConversionReport.percentile([], 95), 0.0)
+
+    def test_summarize(self):
+        summary = ConversionReport.summarize(ConversionLog.read_records([self.path]))
+        self.assertEqual(summary['status']['epub.images', 'done'], 4)
+        self.assertEqual(summary['skipped']['kindle.images', 'built from unchanged source'], 1)
+        self.assertEqual(summary['ebook_seconds'].most_common(1), [(5, 600.0)])
+        self.assertEqual([record['ebook'] for record in summary['failures']], [5])
+
+        out = io.StringIO()
+        ConversionReport.report(summary, top=2, fp=out)
+        self.assertIn('epub.images', out.getvalue())
+        self.assertIn('Failures:', out.getvalue())
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+import unittest
+
+from libgutenberg.GutenbergGlobals import Struct
+
+from .. import DopushDaemon, EbookConverter, FileInfo, WorkQueue
+
+class TestDopush(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.saved = {name: getattr(EbookConverter.options, name, None)
+                      for name in ('build', 'range', 'records', 'time_budget')}
+        self.saved_scan = FileInfo.scan_dopush_log
+        self.saved_convert = EbookConverter.convert
+        self.saved_queue = WorkQueue.WorkQueue
+        FileInfo.scan_dopush_log = lambda scanned: scanned.extend([3, 5])
+        EbookConverter.options.build = ['epub.images']
+        EbookConverter.options.records = os.path.join(self.tempdir.name, 'records.jsonl')
+        EbookConverter.options.time_budget = 0
+        self.queued = []
+        test = self
+
+        class Queue():
+            def __init__(self, name):
+                self.name = name
+            def enqueue(self, ebooks, priority=0, types=(), reason=None):
+                test.queued.append((self.name, ebooks, priority, types, reason))
+
+        WorkQueue.WorkQueue = Queue
+        self.book_index = Struct()
+        self.book_index.refresh = lambda: None
+
+    def tearDown(self):
+        FileInfo.scan_dopush_log = self.saved_scan
+        EbookConverter.convert = self.saved_convert
+        WorkQueue.WorkQueue = self.saved_queue
+        EbookConverter.stop_requested.clear()
+        for name, value in self.saved.items():
+            setattr(EbookConverter.options, name, value)
+        self.tempdir.cleanup()
+
+    def dopush(self):
+        # without writing metrics
+        return DopushDaemon.dopush.__wrapped__(self.book_index)
+
+    def test_done(self):
+        EbookConverter.convert = lambda book_index: [3, 5]
+        self.assertEqual(self.dopush(), 0)
+        self.assertEqual(self.queued, [])
+        self.assertIsNone(EbookConverter.conversion_log)
+
+    def test_stopped(self):
+        def convert(book_index):
+            EbookConverter.stop_requested.set()
+            return [3]
+        EbookConverter.convert = convert
+        self.dopush()
+        self.assertEqual(self.queued, [('rebuild', [5], 10, ['epub.images'], 'dopush')])
+
+    def test_error(self):
+        def convert(book_index):
+            raise RuntimeError('worker died')
+        EbookConverter.convert = convert
+        self.assertRaises(RuntimeError, self.dopush)
+        self.assertEqual(self.queued, [('rebuild', [3, 5], 10, ['epub.images'], 'dopush')])
+        self.assertIsNone(EbookConverter.conversion_log)
@@ -0,0 +1,510 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import datetime
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from libgutenberg.GutenbergGlobals import Struct
+from ebookmaker import CommonCode
+
+from .. import EbookConverter
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.outputdir = tempfile.mkdtemp()
+        self.test_file = os.path.join(os.path.dirname(__file__), '4554-h.htm')
+        self.saved = {name: getattr(EbookConverter.options, name, None)
+                      for name in ('shadow', 'upgrade')}
+        EbookConverter.options.shadow = False
+        EbookConverter.options.upgrade = False
+
+    def test_file_digest(self):
+        with open(self.test_file, 'rb') as fp:
+            data = fp.read()
+        size, sha256 = EbookConverter.file_digest(self.test_file)
+        self.assertEqual(size, len(data))
+        self.assertEqual(sha256, hashlib.sha256(data).hexdigest())
+
+    def test_update_manifest(self):
+        self.assertEqual(EbookConverter.read_manifest(self.outputdir, 4554), {})
+        job = CommonCode.Job('epub.images')
+        job.ebook = 4554
+        job.outputdir = self.outputdir
+        job.build_inputs = {'source': 'files/4554/4554-h/4554-h.htm', 'size': 1, 'sha256': 'x'}
+        EbookConverter.update_manifest(job)
+        manifest = EbookConverter.read_manifest(self.outputdir, 4554)
+        self.assertEqual(manifest['epub.images'], job.build_inputs)
+
+        EbookConverter.update_manifest(job, rebuilt=False, peak_rss=300000000)
+        manifest = EbookConverter.read_manifest(self.outputdir, 4554)
+        self.assertEqual(manifest['epub.images'], job.build_inputs)
+        self.assertEqual(manifest['peak_rss'], {'epub.images': 300000000})
+
+    def test_update_manifest_shadow(self):
+        EbookConverter.options.shadow = True
+        job = CommonCode.Job('epub.images')
+        job.ebook = 4554
+        job.outputdir = self.outputdir
+        job.build_inputs = {'source': 'files/4554/4554-h/4554-h.htm', 'size': 1, 'sha256': 'x'}
+        EbookConverter.update_manifest(job)
+        self.assertEqual(os.listdir(self.outputdir), [])
+
+    def test_same_inputs(self):
+        built_from = {'source': 'files/4554/4554-h/4554-h.htm', 'size': 1, 'sha256': 'x',
+                      'ebookmaker': '0.1', 'ebookconverter': '0.1'}
+        inputs = dict(built_from, ebookmaker='0.2')
+        self.assertTrue(EbookConverter.same_inputs(built_from, inputs))
+        self.assertFalse(EbookConverter.same_inputs(built_from, dict(inputs, sha256='y')))
+        self.assertFalse(EbookConverter.same_inputs(built_from, None))
+        EbookConverter.options.upgrade = True
+        self.assertFalse(EbookConverter.same_inputs(built_from, inputs))
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(EbookConverter.options, name, value)
+        shutil.rmtree(self.outputdir)
+
+
+class TestSplitJobQueue(unittest.TestCase):
+    def mk_jobs(self, ebook, types):
+        jobs = []
+        for type_ in types:
+            job = CommonCode.Job(type_)
+            job.ebook = ebook
+            jobs.append(job)
+        return jobs
+
+    def test_split_job_queue(self):
+        types = EbookConverter.CommonCode.add_dependencies(
+            ['all'], EbookConverter.DEPENDENCIES, EbookConverter.BUILD_ORDER)
+        job_queue = self.mk_jobs(1, types) + self.mk_jobs(2, ['epub.images', 'rdf'])
+        batches = [[job.type for job in batch]
+                   for batch in EbookConverter.split_job_queue(job_queue)]
+
+        self.assertEqual(sum(len(batch) for batch in batches), len(job_queue))
+        self.assertIn(['picsdir.images', 'rst.gen', 'html.images'], batches)
+        self.assertIn(['epub.images', 'kindle.images'], batches)
+        self.assertIn(['epub3.images', 'kf8.images'], batches)
+        self.assertIn(['qrcode'], batches)
+        self.assertEqual(batches[-2:], [['epub.images'], ['rdf']])
+
+    def test_requires(self):
+        self.assertTrue(EbookConverter.requires('kindle.images', 'epub.images'))
+        self.assertTrue(EbookConverter.requires('html.images', 'picsdir.images'))
+        self.assertFalse(EbookConverter.requires('epub.images', 'kindle.images'))
+        self.assertFalse(EbookConverter.requires('rdf', 'epub.images'))
+
+
+class TestEstimateCost(unittest.TestCase):
+    def setUp(self):
+        self.filesdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.filesdir, '4554', '4554-h', 'images'))
+        for name, size in (('cover.jpg', 3000), ('i001.png', 1000), ('notes.txt', 500)):
+            with open(os.path.join(self.filesdir, '4554', '4554-h', 'images', name), 'wb') as fp:
+                fp.write(bytes(size))
+        self.saved_config = getattr(EbookConverter.options, 'config', None)
+        EbookConverter.options.config = Struct()
+        EbookConverter.options.config.FILESDIR = 'file://' + self.filesdir + '/'
+
+    def candidate(self, archive_path, extent, generated=False):
+        candidate = Struct()
+        candidate.archive_path = archive_path
+        candidate.extent = extent
+        candidate.generated = generated
+        return candidate
+
+    def test_image_stats(self):
+        bookdir = os.path.join(self.filesdir, '4554')
+        self.assertEqual(EbookConverter.image_stats(bookdir), (2, 4000))
+        self.assertEqual(EbookConverter.image_stats(bookdir, max_depth=2), (0, 0))
+
+    def test_estimate_cost(self):
+        maker = EbookConverter.Maker(4554)
+        html = self.candidate('4554/4554-h/4554-h.htm', 10000)
+        self.assertEqual(maker.estimate_cost(CommonCode.Job('html.noimages'), html),
+                         EbookConverter.JOB_COST + 3 * 10000)
+        self.assertEqual(maker.estimate_cost(CommonCode.Job('html.images'), html),
+                         EbookConverter.JOB_COST
+                         + 3 * (10000 + 4000 + 2 * EbookConverter.IMAGE_COST))
+        epub = self.candidate('cache/4554/pg4554-images.epub', 0, generated=True)
+        self.assertEqual(maker.estimate_cost(CommonCode.Job('kindle.images'), epub),
+                         EbookConverter.JOB_COST + 4 * 10000)
+        self.assertEqual(maker.estimate_cost(CommonCode.Job('qrcode'), None),
+                         EbookConverter.JOB_COST)
+
+    def tearDown(self):
+        EbookConverter.options.config = self.saved_config
+        shutil.rmtree(self.filesdir)
+
+
+class TestMakerFiles(unittest.TestCase):
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.cachedir, '4554'))
+        for name in ('pg4554-images.epub', 'pg4554-images.epub.gz', 'pg4554.rdf'):
+            with open(os.path.join(self.cachedir, '4554', name), 'w') as fp:
+                fp.write('x')
+        self.saved_config = getattr(EbookConverter.options, 'config', None)
+        self.saved_shadow = getattr(EbookConverter.options, 'shadow', False)
+        self.saved_dry_run = getattr(EbookConverter.options, 'dry_run', False)
+        EbookConverter.options.config = Struct()
+        EbookConverter.options.config.CACHEDIR = self.cachedir
+        EbookConverter.options.config.CACHELOC = 'cache/epub'
+        EbookConverter.options.shadow = True
+        EbookConverter.options.dry_run = False
+
+    def test_lookup(self):
+        maker = EbookConverter.Maker(4554)
+        bookdir = maker.get_cache_dir()
+        self.assertTrue(maker.lookup(os.path.join(bookdir, 'pg4554.rdf')).is_file())
+        self.assertIsNone(maker.lookup(os.path.join(bookdir, 'pg4554.pdf')))
+        # read once
+        os.remove(os.path.join(bookdir, 'pg4554.rdf'))
+        self.assertIsNotNone(maker.lookup(os.path.join(bookdir, 'pg4554.rdf')))
+        self.assertEqual(list(maker.dirs), [bookdir])
+
+    def test_remove_type(self):
+        maker = EbookConverter.Maker(4554)
+        maker.remove_type('epub.images')
+        self.assertEqual(os.listdir(maker.get_cache_dir()), ['pg4554.rdf'])
+
+    def test_refresh(self):
+        maker = EbookConverter.Maker(4554)
+        maker.dc = Struct()
+        job = CommonCode.Job('epub.images')
+        job.outputdir = maker.get_cache_dir()
+        job.outputfile = 'pg4554-images.epub'
+        # no output to patch
+        self.assertFalse(maker.refresh(job))
+        # not an epub: convert it
+        job.old_mtime = 0
+        self.assertTrue(maker.refresh(job))
+        self.assertEqual(job.build_reason, 'metadata patch failed')
+
+        maker.patched.add('epub.images')
+        job = CommonCode.Job('kindle.images')
+        job.outputdir = maker.get_cache_dir()
+        job.outputfile = 'pg4554-images.mobi'
+        job.old_mtime = 0
+        self.assertTrue(maker.refresh(job))
+        self.assertEqual(job.derived_url,
+                         os.path.join(maker.get_cache_dir(), 'pg4554-images.epub'))
+
+        # the text file has the pg-header too
+        job = CommonCode.Job('txt.utf-8')
+        job.outputdir = maker.get_cache_dir()
+        job.outputfile = 'pg4554.txt'
+        job.old_mtime = 0
+        self.assertTrue(maker.refresh(job))
+        self.assertFalse(hasattr(job, 'derived_url'))
+        # no metadata in it
+        job = CommonCode.Job('qrcode')
+        job.old_mtime = 0
+        self.assertFalse(maker.refresh(job))
+
+    def tearDown(self):
+        EbookConverter.options.config = self.saved_config
+        EbookConverter.options.shadow = self.saved_shadow
+        EbookConverter.options.dry_run = self.saved_dry_run
+        shutil.rmtree(self.cachedir)
+
+
+class TestExpandTypes(unittest.TestCase):
+    def test_expand_types(self):
+        make, build = EbookConverter.expand_types([], ['metadata'])
+        self.assertEqual(build, ['metadata', 'cover.small', 'cover.medium', 'rdf'])
+        self.assertIn('epub.images', make)
+        self.assertIn('kf8.images', make)
+        make, build = EbookConverter.expand_types(['rdf'], ['epub.images'])
+        self.assertEqual((make, build), (['epub.images', 'rdf'], ['epub.images']))
+
+
+class TestFindStale(unittest.TestCase):
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.filesdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.cachedir, '4554'))
+        for name in ('pg4554-images.epub', 'pg4554.rdf'):
+            with open(os.path.join(self.cachedir, '4554', name), 'w') as fp:
+                fp.write('x')
+        os.makedirs(os.path.join(self.filesdir, 'files', '4554'))
+        self.source = os.path.join(self.filesdir, 'files', '4554', '4554-h.htm')
+        with open(self.source, 'w') as fp:
+            fp.write('<html/>')
+        self.saved = {name: getattr(EbookConverter.options, name, None)
+                      for name in ('config', 'make', 'build', 'shadow', 'upgrade')}
+        EbookConverter.options.config = Struct()
+        EbookConverter.options.config.CACHEDIR = self.cachedir
+        EbookConverter.options.config.FILESDIR = 'file://' + self.filesdir
+        EbookConverter.options.shadow = False
+        EbookConverter.options.upgrade = False
+        EbookConverter.options.make = ['epub.images', 'rdf', 'qrcode', 'pdf.images']
+        EbookConverter.options.build = []
+        self.book_index = Struct()
+        self.book_index.existing = {4554, 4555}
+        self.book_index.not_text = {4555}
+
+    def write_manifest(self, **changes):
+        size, sha256 = EbookConverter.file_digest(self.source)
+        job = CommonCode.Job('epub.images')
+        job.ebook = 4554
+        job.outputdir = os.path.join(self.cachedir, '4554')
+        job.build_inputs = dict({
+            'source': 'files/4554/4554-h.htm', 'size': size, 'sha256': sha256,
+            'ebookmaker': EbookConverter.EBOOKMAKER_VERSION,
+            'ebookconverter': EbookConverter.VERSION}, **changes)
+        EbookConverter.update_manifest(job)
+
+    def test_find_stale(self):
+        now = datetime.datetime.now()
+        sources = {4554: {'html/utf-8': (now - datetime.timedelta(days=1),
+                                         'files/4554/4554-h.htm')},
+                   4555: {'html/utf-8': (now, 'files/4555/4555-h.htm')}}
+        stale = EbookConverter.find_stale([4554, 4555, 4556], self.book_index, sources)
+        # pdf.images needs rst
+        self.assertEqual(stale, {4554: {'qrcode': 'missing'}, 4555: {'qrcode': 'missing',
+                                                                   'rdf': 'missing'}})
+
+        # no manifest: by modification time
+        sources[4554]['html/utf-8'] = (now + datetime.timedelta(days=1), 'files/4554/4554-h.htm')
+        stale = EbookConverter.find_stale([4554], self.book_index, sources)
+        self.assertEqual(stale[4554]['epub.images'], 'source newer')
+        self.assertNotIn('rdf', stale[4554])
+
+    def test_find_stale_manifest(self):
+        now = datetime.datetime.now()
+        sources = {4554: {'html/utf-8': (now + datetime.timedelta(days=1),
+                                         'files/4554/4554-h.htm')}}
+
+        # touched, but the same as when built
+        self.write_manifest()
+        stale = EbookConverter.find_stale([4554], self.book_index, sources)
+        self.assertNotIn('epub.images', stale[4554])
+
+        self.write_manifest(sha256='0' * 64)
+        stale = EbookConverter.find_stale([4554], self.book_index, sources)
+        self.assertEqual(stale[4554]['epub.images'], 'source changed')
+
+        # not touched: not hashed
+        sources[4554]['html/utf-8'] = (now - datetime.timedelta(days=1), 'files/4554/4554-h.htm')
+        stale = EbookConverter.find_stale([4554], self.book_index, sources)
+        self.assertNotIn('epub.images', stale[4554])
+
+        self.write_manifest(source='files/4554/4554-0.txt')
+        stale = EbookConverter.find_stale([4554], self.book_index, sources)
+        self.assertEqual(stale[4554]['epub.images'], 'other source')
+
+        self.write_manifest(ebookmaker='0.1')
+        stale = EbookConverter.find_stale([4554], self.book_index, sources)
+        self.assertNotIn('epub.images', stale[4554])
+        EbookConverter.options.upgrade = True
+        stale = EbookConverter.find_stale([4554], self.book_index, sources)
+        self.assertEqual(stale[4554]['epub.images'], 'new version')
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(EbookConverter.options, name, value)
+        shutil.rmtree(self.cachedir)
+        shutil.rmtree(self.filesdir)
+
+
+class TestMemoryBudget(unittest.TestCase):
+    def test_admission(self):
+        budget = EbookConverter.MemoryBudget(1000)
+        budget.acquire(600)
+        budget.acquire(400)
+        admitted = threading.Event()
+
+        def big():
+            budget.acquire(5000) # over the limit, but runs once alone
+            admitted.set()
+
+        thread = threading.Thread(target=big)
+        thread.start()
+        budget.release(600)
+        self.assertFalse(admitted.wait(0.1))
+        budget.release(400)
+        self.assertTrue(admitted.wait(5))
+        thread.join()
+        self.assertEqual(budget.in_use, 5000)
+
+    def test_resident_workers(self):
+        budget = EbookConverter.MemoryBudget(1000, idle=200, resident=2)
+        self.assertEqual(budget.in_use, 400)
+        budget.acquire(700, resident=True) # 500 more than idle
+        self.assertEqual(budget.in_use, 900)
+        admitted = threading.Event()
+
+        def other():
+            budget.acquire(300)
+            admitted.set()
+
+        thread = threading.Thread(target=other)
+        thread.start()
+        self.assertFalse(admitted.wait(0.1))
+        budget.release(700, resident=True)
+        self.assertTrue(admitted.wait(5))
+        thread.join()
+        self.assertEqual(budget.in_use, 700)
+
+    def test_batch_memory(self):
+        jobs = [CommonCode.Job('epub.images'), CommonCode.Job('kindle.images')]
+        jobs[0].memory = 300
+        jobs[1].memory = 700
+        self.assertEqual(EbookConverter.batch_memory(jobs), 700)
+
+
+class TestRetryTimeouts(unittest.TestCase):
+    def setUp(self):
+        self.saved = {name: getattr(EbookConverter.options, name, None)
+                      for name in ('make', 'build', 'range', 'time_budget')}
+        self.saved_convert = EbookConverter.convert
+        self.calls = []
+        EbookConverter.convert = lambda book_index: self.calls.append(
+            (EbookConverter.options.range, EbookConverter.options.build))
+        EbookConverter.options.time_budget = 0
+
+    def tearDown(self):
+        EbookConverter.convert = self.saved_convert
+        for name, value in self.saved.items():
+            setattr(EbookConverter.options, name, value)
+
+    def test_retry_timeouts(self):
+        EbookConverter.options.make, EbookConverter.options.build = ['rdf'], []
+        EbookConverter.options.range = [3, 5, 7]
+        timeouts = {3: {'epub.images'}, 5: {'pdf.images', 'epub.images'},
+                    7: {'epub.images'}, 9: {'kf8.images'}}
+        self.assertTrue(EbookConverter.retry_timeouts(timeouts, None))
+        self.assertEqual(self.calls, [([3, 7], ['epub.images']),
+                                      ([5], ['picsdir.images', 'epub.images', 'pdf.images'])])
+        self.assertEqual(EbookConverter.options.range, [3, 5, 7])
+        self.assertEqual(EbookConverter.options.build, [])
+
+
+class TestConvert(unittest.TestCase):
+    """ A run without --plan-out or a conversion log. """
+
+    def setUp(self):
+        self.saved = {name: getattr(EbookConverter.options, name, None)
+                      for name in ('build', 'dry_run', 'notify', 'range', 'time_budget')}
+        self.saved_plan_groups = EbookConverter.plan_groups
+        self.saved_notify = EbookConverter.Notifier.send_notifications
+        EbookConverter.plan_groups = self.plan_groups
+        EbookConverter.Notifier.send_notifications = lambda ebooks: None
+        EbookConverter.options.build = []
+        EbookConverter.options.dry_run = True
+        EbookConverter.options.notify = False
+        EbookConverter.options.time_budget = 0
+
+    def tearDown(self):
+        EbookConverter.plan_groups = self.saved_plan_groups
+        EbookConverter.Notifier.send_notifications = self.saved_notify
+        for name, value in self.saved.items():
+            setattr(EbookConverter.options, name, value)
+
+    @staticmethod
+    def plan_groups(done_books, book_index):
+        for ebook in EbookConverter.options.range:
+            done_books.append(ebook)
+            group = Struct()
+            group.first = group.last = ebook
+            group.job_queue = []
+            yield group
+
+    def test_convert(self):
+        self.assertIsNone(EbookConverter.conversion_log)
+        self.assertIsNone(EbookConverter.plan_writer)
+        EbookConverter.options.range = [3, 5]
+        self.assertEqual(EbookConverter.convert(None), [3, 5])
+        EbookConverter.log_conversion(3, 'epub.images', 'skipped', reason='up to date')
+
+
+class FakeWorker():
+    """ An EbookWorker that times out on epub.images, and dies on crash
+    unless it is run alone. """
+
+    returncode = -9
+
+    def __init__(self, crash=None):
+        self.crash = crash
+        self.batches = []
+
+    def run(self, job_queue, on_result, job_timeout, deadline):
+        self.batches.append([job.type for job in job_queue])
+        statuses = []
+        for job in job_queue:
+            if job.type == self.crash and len(job_queue) > 1:
+                break
+            if job.type == 'epub.images':
+                time.sleep(0.1)
+                status = EbookConverter.EbookWorker.job_status(job, 'timeout', 0.1)
+            else:
+                status = EbookConverter.EbookWorker.job_status(job, 'done')
+            statuses.append(status)
+            on_result(job, status)
+            if status['status'] == 'timeout':
+                break
+        return statuses
+
+
+class TestRunEbookmaker(unittest.TestCase):
+    """ Jobs not run for want of time are recorded. """
+
+    def setUp(self):
+        self.outputdir = tempfile.mkdtemp()
+        self.saved = {name: getattr(EbookConverter.options, name, None)
+                      for name in ('job_timeout', 'persistent_worker')}
+        EbookConverter.options.job_timeout = 30
+        EbookConverter.options.persistent_worker = True
+        self.worker = FakeWorker()
+        self.saved_get_worker = EbookConverter.get_worker
+        EbookConverter.get_worker = lambda: self.worker
+        self.results = []
+        self.jobs = []
+        for type_ in ('html.images', 'epub.images', 'kindle.images', 'pdf.images'):
+            job = CommonCode.Job(type_)
+            job.ebook = 4554
+            job.outputdir = self.outputdir
+            self.jobs.append(job)
+
+    def tearDown(self):
+        EbookConverter.get_worker = self.saved_get_worker
+        for name, value in self.saved.items():
+            setattr(EbookConverter.options, name, value)
+        shutil.rmtree(self.outputdir)
+
+    def on_result(self, job, status):
+        self.results.append((job.type, status['status']))
+
+    def test_job_timeout(self):
+        self.assertFalse(EbookConverter.run_ebookmaker(self.jobs, self.on_result))
+        self.assertEqual(self.worker.batches, [
+            ['html.images', 'epub.images', 'kindle.images', 'pdf.images'], ['pdf.images']])
+        self.assertEqual(self.results, [('html.images', 'done'), ('epub.images', 'timeout'),
+                                        ('kindle.images', 'dropped'), ('pdf.images', 'done')])
+
+    def test_group_timeout(self):
+        self.assertFalse(EbookConverter.run_ebookmaker(
+            self.jobs, self.on_result, deadline=time.monotonic() + 0.05))
+        self.assertEqual(len(self.worker.batches), 1)
+        self.assertEqual(self.results, [('html.images', 'done'), ('epub.images', 'timeout'),
+                                        ('kindle.images', 'dropped'), ('pdf.images', 'dropped')])
+
+    def test_crash(self):
+        self.worker.crash = 'rdf'
+        html, pdf = self.jobs[0], self.jobs[3]
+        html.outputfile = 'pg4554-images.html'
+        rdf = CommonCode.Job('rdf')
+        rdf.ebook = 4554
+        rdf.outputdir = self.outputdir
+        self.assertTrue(EbookConverter.run_ebookmaker([html, rdf, pdf], self.on_result))
+        self.assertEqual(self.worker.batches, [['html.images', 'rdf', 'pdf.images'],
+                                               ['rdf'], ['pdf.images']])
+        # the new worker builds it from the html the old one built
+        self.assertEqual(pdf.derived_url, os.path.join(self.outputdir, 'pg4554-images.html'))
+        self.assertFalse(hasattr(rdf, 'derived_url'))
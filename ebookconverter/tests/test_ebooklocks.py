@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import tempfile
+import threading
+import unittest
+
+from .. import EbookLocks
+
+class TestEbookLocks(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        # two holders stand for two processes: flock() locks are per open file
+        self.ours = EbookLocks.EbookLocks(self.tempdir.name)
+        self.theirs = EbookLocks.EbookLocks(self.tempdir.name)
+
+    def tearDown(self):
+        self.ours.release_all()
+        self.theirs.release_all()
+        self.tempdir.cleanup()
+
+    def test_exclusive(self):
+        self.assertTrue(self.ours.acquire(4554))
+        self.assertTrue(self.ours.acquire(4554))
+        self.assertFalse(self.theirs.acquire(4554))
+        self.assertTrue(self.theirs.acquire(99999))
+        self.ours.release(4554)
+        self.assertTrue(self.theirs.acquire(4554))
+
+    def test_wait(self):
+        self.assertTrue(self.theirs.acquire(4554))
+        threading.Timer(0.5, self.theirs.release, (4554,)).start()
+        self.assertTrue(self.ours.acquire(4554, wait=5))
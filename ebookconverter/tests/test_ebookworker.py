@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from ebookmaker import CommonCode
+
+from .. import EbookWorker
+
+class TestEbookWorker(unittest.TestCase):
+    def setUp(self):
+        self.job = CommonCode.Job('epub.images')
+        self.job.ebook = 4554
+        self.job.outputfile = 'pg4554-images.epub'
+
+    def test_frames(self):
+        stream = io.BytesIO()
+        EbookWorker.write_frame(stream, self.job)
+        EbookWorker.write_frame(stream, None)
+        stream.seek(0)
+        job = EbookWorker.read_frame(stream)
+        self.assertEqual(job.outputfile, self.job.outputfile)
+        self.assertIsNone(EbookWorker.read_frame(stream))
+        self.assertRaises(EOFError, EbookWorker.read_frame, stream)
+
+    def test_truncated_frame(self):
+        stream = io.BytesIO()
+        EbookWorker.write_frame(stream, self.job)
+        stream = io.BytesIO(stream.getvalue()[:-1])
+        self.assertRaises(EOFError, EbookWorker.read_frame, stream)
+
+
+# a child that does every job at once, except that it hangs on pdf jobs
+FAKE_WORKER = '''
+import sys, time
+from ebookconverter import EbookWorker
+while True:
+    try:
+        job = EbookWorker.read_frame(sys.stdin.buffer)
+    except EOFError:
+        break
+    if job is not None and job.type.startswith('pdf'):
+        time.sleep(60)
+    EbookWorker.write_frame(sys.stdout.buffer,
+                            job and EbookWorker.job_status(job, 'done'))
+'''
+
+class TestWorkerProcess(unittest.TestCase):
+    def setUp(self):
+        self.worker = EbookWorker.WorkerProcess([])
+        self.worker.command = [sys.executable, '-c', FAKE_WORKER]
+        self.saved_path = os.environ.get('PYTHONPATH')
+        os.environ['PYTHONPATH'] = os.path.dirname(os.path.dirname(
+            os.path.dirname(os.path.abspath(__file__))))
+
+    def mk_jobs(self, types):
+        jobs = []
+        for type_ in types:
+            job = CommonCode.Job(type_)
+            job.ebook = 4554
+            jobs.append(job)
+        return jobs
+
+    def test_run(self):
+        results = []
+        statuses = self.worker.run(self.mk_jobs(['epub.images', 'kindle.images']),
+                                   lambda job, status: results.append(job.type))
+        self.assertEqual([status['status'] for status in statuses], ['done', 'done'])
+        self.assertEqual(results, ['epub.images', 'kindle.images'])
+
+    def test_timeout(self):
+        statuses = self.worker.run(self.mk_jobs(['html.images', 'pdf.images', 'txt.utf-8']),
+                                   job_timeout=1)
+        self.assertEqual([status['status'] for status in statuses], ['done', 'timeout'])
+        self.assertIsNone(self.worker.child)
+        # a new child takes over
+        statuses = self.worker.run(self.mk_jobs(['txt.utf-8']))
+        self.assertEqual([status['status'] for status in statuses], ['done'])
+
+    def tearDown(self):
+        self.worker.close()
+        if self.saved_path is None:
+            del os.environ['PYTHONPATH']
+        else:
+            os.environ['PYTHONPATH'] = self.saved_path
+
+
+class TestPeakRss(unittest.TestCase):
+    def test_job_peak_rss(self):
+        before = EbookWorker.children_usage()
+        self.assertLessEqual(EbookWorker.job_peak_rss(before), EbookWorker.peak_rss())
+        # a converter run by the job
+        subprocess.run([sys.executable, '-c', 'x = b"x" * (100 * 1024 * 1024)'], check=True)
+        self.assertGreater(EbookWorker.job_peak_rss(before) - EbookWorker.peak_rss(),
+                           90 * 1024 * 1024)
+
+
+class TestCheckEbookmaker(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def script(self, shebang):
+        path = os.path.join(self.tempdir.name, 'ebookmaker')
+        with open(path, 'w') as fp:
+            fp.write(shebang + '\nfrom ebookmaker.EbookMaker import main\n')
+        os.chmod(path, 0o755)
+        return path
+
+    def test_check_ebookmaker(self):
+        EbookWorker.check_ebookmaker(self.script('#!' + sys.executable))
+        self.assertRaises(ValueError, EbookWorker.check_ebookmaker,
+                          self.script('#!/opt/other/bin/python3'))
+        self.assertRaises(ValueError, EbookWorker.check_ebookmaker,
+                          os.path.join(self.tempdir.name, 'no-such-ebookmaker'))
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import unittest
+
+from libgutenberg.DBUtils import check_session
+from libgutenberg.GutenbergFiles import parse_filename, remove_file_from_database
+from libgutenberg.Models import File
+
+from .. import FileRegistry
+
+class TestFileRegistry(unittest.TestCase):
+    def setUp(self):
+        self.test_file = os.path.join(os.path.dirname(__file__), '4554-h.htm')
+        self.test_file2 = os.path.join(os.path.dirname(__file__), '4554-0.txt')
+
+    def test_add(self):
+        registry = FileRegistry.FileRegistry()
+        registry.add(4554, self.test_file, 'html')
+        registry.add(4554, self.test_file, 'html')
+        self.assertEqual(len(registry), 1)
+
+    def test_no_database(self):
+        saved, FileRegistry.DBUtils.OB = FileRegistry.DBUtils.OB, None
+        try:
+            registry = FileRegistry.FileRegistry()
+            registry.add(4554, self.test_file, 'html')
+            self.assertEqual(registry.flush(), 0)
+            self.assertEqual(len(registry), 0)
+        finally:
+            FileRegistry.DBUtils.OB = saved
+
+    def test_flush(self):
+        """ Needs the database. """
+        registry = FileRegistry.FileRegistry()
+        registry.add(4554, self.test_file, 'html')
+        registry.add(4554, self.test_file2, 'txt')
+        self.assertEqual(registry.flush(), 2)
+        self.assertEqual(len(registry), 0)
+        # again: the rows are updated
+        registry.add(4554, self.test_file, 'html')
+        self.assertEqual(registry.flush(), 1)
+
+        session = check_session(None)
+        archive_path = parse_filename(self.test_file)[2]
+        files = session.query(File).filter_by(archive_path=archive_path).all()
+        self.assertEqual(len(files), 1)
+        self.assertEqual(files[0].extent, os.path.getsize(self.test_file))
+        self.assertEqual(files[0].fk_filetypes, 'html')
+        for filename in (self.test_file, self.test_file2):
+            remove_file_from_database(filename)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+import unittest
+import zipfile
+
+from lxml import etree
+
+from libgutenberg import DublinCore
+from ebookmaker.writers import HtmlTemplates
+
+from .. import MetadataRefresh
+
+OPF = """<?xml version='1.0' encoding='utf-8'?>
+<package xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf"
+ xmlns="http://www.idpf.org/2007/opf" version="%s" unique-identifier="id">
+  <metadata>
+    <dc:identifier id="id">http://www.gutenberg.org/4554</dc:identifier>
+    %s
+    <dc:title>Old Title</dc:title>
+    <dc:language>en</dc:language>
+  </metadata>
+  <manifest/>
+</package>"""
+
+CREATORS = {
+    '2.0': '<dc:creator opf:file-as="Nobody, Old">Old Nobody</dc:creator>',
+    '3.0': '<dc:creator id="author_0">Old Nobody</dc:creator>'
+           '<meta property="file-as" refines="#author_0">Nobody, Old</meta>'
+           '<meta property="role" refines="#author_0" scheme="marc:relators">aut</meta>',
+}
+
+CONTAINER = """<?xml version='1.0' encoding='utf-8'?>
+<container xmlns="urn:oasis:names:tc:opendocument:xmlns:container" version="1.0">
+  <rootfiles><rootfile full-path="content.opf" media-type="application/oebps-package+xml"/></rootfiles>
+</container>"""
+
+NCX = """<?xml version='1.0' encoding='utf-8'?>
+<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">
+  <docTitle><text>Old Title</text></docTitle>
+</ncx>"""
+
+XHTML = """<?xml version='1.0' encoding='utf-8'?>
+<html xmlns="http://www.w3.org/1999/xhtml"><head><title>Old Title | Project Gutenberg</title>
+<meta name="dc.title" content="Old Title"/>
+<meta name="dc.creator" content="Nobody, Old"/>
+</head><body>%s<p>Chapter 1</p>%s</body></html>"""
+
+
+def mk_dc(title, authors):
+    dc = DublinCore.GutenbergDublinCore()
+    dc.title = title
+    dc.project_gutenberg_id = 4554
+    dc.rights = 'Public domain in the USA.'
+    dc.add_lang_id('en')
+    for name, marcrel in authors:
+        dc.add_author(name, marcrel)
+    return dc
+
+
+class TestMetadataRefresh(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        old = mk_dc('Old Title', [('Nobody, Old', 'aut')])
+        self.xhtml = XHTML % (etree.tostring(HtmlTemplates.pgheader(old)).decode(),
+                              etree.tostring(HtmlTemplates.pgfooter(old)).decode())
+        self.dc = mk_dc('New Title', [('Twain, Mark', 'aut'), ('Doe, Jane', 'ill')])
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def mk_epub(self, version):
+        path = os.path.join(self.tempdir.name, 'pg4554-images.epub')
+        with zipfile.ZipFile(path, 'w') as zout:
+            zout.writestr('mimetype', 'application/epub+zip', zipfile.ZIP_STORED)
+            zout.writestr('META-INF/container.xml', CONTAINER, zipfile.ZIP_DEFLATED)
+            zout.writestr('content.opf', OPF % (version, CREATORS[version]),
+                          zipfile.ZIP_DEFLATED)
+            zout.writestr('toc.ncx', NCX, zipfile.ZIP_DEFLATED)
+            zout.writestr('4554-h-0.htm.html', self.xhtml, zipfile.ZIP_DEFLATED)
+            zout.writestr('4554-h-1.htm.html', '<html xmlns="http://www.w3.org/1999/xhtml">'
+                          '<body><p>Chapter 2</p></body></html>', zipfile.ZIP_DEFLATED)
+            zout.writestr('images/cover.jpg', b'\xff\xd8 not really', zipfile.ZIP_STORED)
+        return path
+
+    def test_patch_epub(self):
+        path = self.mk_epub('2.0')
+        with zipfile.ZipFile(path) as zin:
+            before = {info.filename: (info.compress_type, zin.read(info))
+                      for info in zin.infolist()}
+
+        changed = MetadataRefresh.patch_epub(path, self.dc)
+        self.assertEqual(changed, ['4554-h-0.htm.html', 'content.opf', 'toc.ncx'])
+
+        with zipfile.ZipFile(path) as zin:
+            self.assertEqual(zin.namelist(), list(before))
+            for info in zin.infolist():
+                self.assertEqual(info.compress_type, before[info.filename][0])
+                if info.filename not in changed:
+                    self.assertEqual(zin.read(info), before[info.filename][1])
+            opf = zin.read('content.opf').decode()
+            page = zin.read('4554-h-0.htm.html').decode()
+            ncx = zin.read('toc.ncx').decode()
+
+        self.assertIn('<dc:creator opf:file-as="Twain, Mark">Mark Twain</dc:creator>', opf)
+        self.assertIn('<dc:contributor opf:file-as="Doe, Jane" opf:role="ill">Jane Doe'
+                      '</dc:contributor>', opf)
+        self.assertIn('<dc:title>New Title</dc:title>', opf)
+        self.assertNotIn('Old', opf)
+        self.assertIn('<text>New Title</text>', ncx)
+        self.assertIn('<title>New Title | Project Gutenberg</title>', page)
+        self.assertIn('<meta name="marcrel.ill" content="Doe, Jane"/>', page)
+        self.assertIn('EBOOK NEW TITLE ***', page)
+        self.assertIn('<strong>Illustrator</strong>: Jane Doe', page)
+        self.assertNotIn('Old', page)
+        self.assertIn('<p>Chapter 1</p>', page)
+
+    def test_patch_epub3(self):
+        path = self.mk_epub('3.0')
+        MetadataRefresh.patch_epub(path, self.dc)
+        with zipfile.ZipFile(path) as zin:
+            opf = zin.read('content.opf').decode()
+        self.assertIn('<dc:contributor id="author_1">Jane Doe</dc:contributor>', opf)
+        self.assertIn('<meta property="file-as" refines="#author_0">Twain, Mark</meta>', opf)
+        self.assertEqual(opf.count('refines='), 4)
+
+    def test_patch_html(self):
+        path = os.path.join(self.tempdir.name, 'pg4554-images.html')
+        with open(path, 'w') as fp:
+            fp.write('<!DOCTYPE html>\n' + self.xhtml.split('\n', 1)[1])
+        data = MetadataRefresh.patch_html(path, self.dc)
+        with open(path, 'rb') as fp:
+            self.assertEqual(fp.read(), data)
+        html = data.decode()
+        self.assertTrue(html.startswith('<!DOCTYPE html>'))
+        self.assertIn('<meta name="dc.creator" content="Twain, Mark">', html)
+        self.assertIn('eBook of <span lang="en" xml:lang="en" id="pg-title-no-subtitle">'
+                      'New Title</span>', html)
+        self.assertNotIn('Old', html)
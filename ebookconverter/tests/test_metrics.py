@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine, text
+
+from .. import Metrics
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.saved_dir = Metrics.METRICS_DIR
+        Metrics.METRICS_DIR = self.tempdir.name
+        self.path = os.path.join(self.tempdir.name, 'pg_test.prom')
+
+    def tearDown(self):
+        Metrics.METRICS_DIR = self.saved_dir
+        self.tempdir.cleanup()
+
+    def read(self):
+        samples = {}
+        with open(self.path) as fp:
+            for line in fp:
+                if not line.startswith('#'):
+                    key, value = line.rsplit(' ', 1)
+                    samples[key] = float(value)
+        return samples
+
+    def test_run(self):
+        engine = create_engine('sqlite://')
+
+        @Metrics.instrument('test')
+        def main(code):
+            with engine.connect() as conn:
+                conn.execute(text('select 1'))
+                conn.execute(text('select 2'))
+            Metrics.inc('books_processed_total', 3)
+            Metrics.inc('jobs_total', type='epub.images', outcome='done')
+            return code
+
+        main(0)
+        samples = self.read()
+        self.assertEqual(samples['pg_books_processed_total{job="test"}'], 3)
+        self.assertEqual(
+            samples['pg_jobs_total{job="test",outcome="done",type="epub.images"}'], 1)
+        self.assertEqual(samples['pg_db_queries_total{job="test"}'], 2)
+        self.assertEqual(samples['pg_run_success{job="test"}'], 1)
+        last_success = samples['pg_last_success_timestamp_seconds{job="test"}']
+
+        # a failed run keeps the time of the last success
+        main(1)
+        samples = self.read()
+        self.assertEqual(samples['pg_run_success{job="test"}'], 0)
+        self.assertEqual(samples['pg_last_success_timestamp_seconds{job="test"}'], last_success)
+
+    def test_exception(self):
+        @Metrics.instrument('test')
+        def main():
+            raise ValueError
+
+        self.assertRaises(ValueError, main)
+        self.assertEqual(self.read()['pg_run_success{job="test"}'], 0)
+        self.assertIsNone(Metrics.current)
+
+    def test_set_job(self):
+        @Metrics.instrument('ebookconverter')
+        def main():
+            Metrics.set_job('test')
+            Metrics.inc('books_processed_total')
+
+        main()
+        self.assertEqual(self.read()['pg_run_success{job="test"}'], 1)
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir.name,
+                                                     'pg_ebookconverter.prom')))
+        self.assertRaises(ValueError, Metrics.set_job, '../test')
+
+    def test_no_work(self):
+        @Metrics.instrument('test')
+        def main():
+            raise SystemExit(0) # like --help
+
+        self.assertRaises(SystemExit, main)
+        self.assertFalse(os.path.exists(self.path))
+
+        Metrics.METRICS_DIR = None
+
+        @Metrics.instrument('test')
+        def main():
+            Metrics.inc('books_processed_total')
+
+        main()
+        self.assertEqual(os.listdir(self.tempdir.name), [])
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+import unittest
+
+from libgutenberg.GutenbergGlobals import Struct
+
+from .. import RunJournal
+
+class TestRunJournal(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.saved_dir = RunJournal.JOURNAL_DIR
+        RunJournal.JOURNAL_DIR = os.path.join(self.tempdir.name, 'journal')
+
+    def tearDown(self):
+        RunJournal.JOURNAL_DIR = self.saved_dir
+        self.tempdir.cleanup()
+
+    def test_record_and_resume(self):
+        journal = RunJournal.RunJournal('rebuild-2026-10')
+        self.assertEqual(journal.done(), set())
+        journal.record([1, 2, 3])
+        journal.record([])
+        journal.record([5])
+        with open(journal.path, 'a') as fp:
+            fp.write('6') # cut short, as if 67 was being written
+        journal = RunJournal.RunJournal('rebuild-2026-10')
+        self.assertEqual(journal.done(), {1, 2, 3, 5})
+        journal.record([7])
+        self.assertEqual(journal.done(), {1, 2, 3, 5, 7})
+
+    def test_bad_run_id(self):
+        self.assertRaises(ValueError, RunJournal.RunJournal, '../etc')
+
+    def test_timeouts(self):
+        job = Struct()
+        job.ebook = 4554
+        job.type = 'epub.images'
+        RunJournal.record_timeout(job, 600)
+        job.type = 'kindle.images'
+        RunJournal.record_timeout(job, 600)
+        timeouts, size = RunJournal.read_timeouts()
+        self.assertEqual(timeouts, {4554: {'epub.images', 'kindle.images'}})
+
+        job.ebook = 6
+        RunJournal.record_timeout(job, 600)
+        timeouts, size = RunJournal.read_timeouts()
+
+        # timed out again while retrying 4554
+        job.ebook = 5
+        RunJournal.record_timeout(job, 600)
+        RunJournal.drop_timeouts(size, [4554])
+        self.assertEqual(RunJournal.read_timeouts()[0], {5: {'kindle.images'},
+                                                         6: {'kindle.images'}})
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import unittest
+
+from .. import WorkQueue
+
+
+class TestShard(unittest.TestCase):
+    def test_parse_shard(self):
+        self.assertEqual(WorkQueue.parse_shard('0/3'), (0, 3))
+        self.assertEqual(WorkQueue.parse_shard('2/3'), (2, 3))
+        for bad in ('3/3', '-1/3', '1', '1/0', 'a/b'):
+            with self.assertRaises(ValueError):
+                WorkQueue.parse_shard(bad)
+
+    def test_shard_range(self):
+        ebooks = list(range(1, 11))
+        shards = [WorkQueue.shard_range(ebooks, i, 3) for i in range(3)]
+        self.assertEqual(shards[1], [1, 4, 7, 10])
+        self.assertEqual(sorted(sum(shards, [])), ebooks)
+
+
+class TestNoDatabase(unittest.TestCase):
+    def test_no_database(self):
+        saved, WorkQueue.DBUtils.OB = WorkQueue.DBUtils.OB, None
+        try:
+            self.assertRaises(WorkQueue.NoDatabase, WorkQueue.WorkQueue, 'test')
+            self.assertRaises(WorkQueue.NoDatabase, WorkQueue.install)
+        finally:
+            WorkQueue.DBUtils.OB = saved
+
+
+class TestWorkQueue(unittest.TestCase):
+    """ Needs the database. """
+
+    @classmethod
+    def setUpClass(cls):
+        WorkQueue.install()
+
+    def setUp(self):
+        self.queue = WorkQueue.WorkQueue('test-%s' % WorkQueue.worker_id())
+        self.other = WorkQueue.WorkQueue(self.queue.name)
+        self.other.worker += ':other'
+
+    def tearDown(self):
+        self.other.complete(range(1, 11))
+        self.queue.claim(100)
+        self.queue.complete(range(1, 11))
+
+    def test_claim(self):
+        self.assertEqual(self.queue.enqueue([1, 2, 3, 4]), 4)
+        self.assertEqual(self.queue.enqueue([4, 5]), 1)
+        self.assertEqual(self.queue.pending(), 5)
+
+        self.assertEqual(self.queue.claim(2), [1, 2])
+        self.assertEqual(self.other.claim(10), [3, 4, 5])
+        self.assertEqual(self.queue.claim(10), [])
+
+        self.queue.complete([1])
+        self.queue.release([2])
+        # only our own claims
+        self.queue.complete([3])
+        self.assertEqual(self.queue.pending(), 4)
+        self.assertEqual(self.queue.claim(10), [2])
+
+    def test_stale_claim(self):
+        self.queue.enqueue([6, 7])
+        self.assertEqual(self.other.claim(10), [6, 7])
+        self.queue.stale = self.queue.stale * 0
+        self.assertEqual(self.queue.claim(10), [6, 7])
+
+    def test_coalesce(self):
+        self.assertEqual(self.queue.enqueue([8], 5, ['epub.images', 'rdf'], 'dopush'), 1)
+        # covered by a pending request of higher priority
+        self.assertEqual(self.queue.enqueue([8], 0, ['rdf'], 'credit'), 0)
+        # merged
+        self.assertEqual(self.queue.enqueue([8], 10, ['qrcode'], 'autorebuild'), 1)
+        self.assertEqual(self.queue.pending(), 1)
+        self.assertEqual(self.queue.claim(10), [8])
+        self.assertEqual(self.queue.requests[8], (('epub.images', 'qrcode', 'rdf'),
+                                                  ('autorebuild', 'dopush')))
+
+        # asked for again while being built: kept for another build
+        self.assertEqual(self.other.enqueue([8], 0, ['rdf'], 'credit'), 1)
+        self.queue.complete([8])
+        self.assertEqual(self.queue.pending(), 1)
+
+    def test_coalesce_everything(self):
+        # a pending request for everything is not narrowed
+        self.queue.enqueue([1], 0, [], 'dopush')
+        self.assertEqual(self.queue.enqueue([1], 0, ['rdf'], 'credit'), 0)
+        self.queue.enqueue([1], 5, ['rdf'], 'credit')
+        # a request for everything is not dropped as covered
+        self.queue.enqueue([2], 0, ['rdf'], 'credit')
+        self.assertEqual(self.queue.enqueue([2], 0, [], 'dopush'), 1)
+        self.assertEqual(self.queue.claim(10), [1, 2])
+        self.assertEqual(self.queue.requests[1], ((), ('credit', 'dopush')))
+        self.assertEqual(self.queue.requests[2], ((), ('credit', 'dopush')))
+
+    def test_claim_ebooks(self):
+        self.queue.enqueue([9], 0, ['rdf'], 'credit')
+        self.queue.enqueue([10], 0, ['epub.images'], 'credit')
+        self.assertEqual(self.other.claim_ebooks([9, 10], ['rdf', 'qrcode']), [9])
@@ -26,11 +26,12 @@ from libgutenberg.GutenbergGlobals import Struct
 from libgutenberg.Logger import critical, info, debug, warning, error, exception
 from libgutenberg.Models import Attribute, Book
 
-from ebookmaker.CommonCode import Options
+from ebookmaker.CommonCode import Options, add_dependencies
 from ebookmaker.ParserFactory import load_parsers, ParserFactory
 
+from ebookconverter import WorkQueue
 from ebookconverter.Candidates import Candidates
-from ebookconverter.EbookConverter import PREFERRED_INPUT_FORMATS
+from ebookconverter.EbookConverter import BUILD_ORDER, DEPENDENCIES, PREFERRED_INPUT_FORMATS
 
 Logger.setup(Logger.LOGFORMAT, 'fileinfo.log')
 
@@ -95,11 +96,19 @@ def main():
     creditless = books.except_(books.filter(
             Attribute.fk_attriblist == 508)).order_by(desc(Book.pk)).all()
     info(f'reparsing {len(creditless)} books without credits')
+    credited = []
     for book in creditless:
         dc = reparse(book)
         if dc and dc.credit:
             dc.add_attribute(book, dc.credit, marc=508)
             session.commit()
             info(f"set credit for {book.pk} to db: {dc.credit}")
+            credited.append(book.pk)
+
+    # the credit shows in the ebooks: have them rebuilt with the other requests
+    if credited:
+        types = add_dependencies(['all'], DEPENDENCIES, BUILD_ORDER)
+        WorkQueue.WorkQueue(WorkQueue.REBUILD_QUEUE).enqueue(credited, 0, types, 'credit')
+        info(f'queued {len(credited)} books for rebuilding')
     
 main()
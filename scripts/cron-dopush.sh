@@ -1,12 +1,14 @@
 #!/bin/bash
 #
 # esh 20200902: removed invocation of the jekyll build so that can have its own cron schedule
-# gbn 20200826: If this file exists, what's below will fail. Check
-# for it first, and squawk if it exists:
-if [ -f /tmp/ebookconverter.pid ] ; then
-    echo "$0: Cannot run, because /tmp/ebookconverter.pid exists"
-    /bin/ls -l /tmp/ebookconverter.pid
-    exit 1
+# No more waiting for /tmp/ebookconverter.pid: ebookconverter now locks each
+# ebook it builds, so we can run alongside the rebuild and the RDF pass.
+
+# dopushd handles the postings as they arrive, if it is running
+if [ -f /tmp/dopushd.pid ] && kill -0 `cat /tmp/dopushd.pid` 2>/dev/null ; then
+    cd /export/sunsite/users/gutenbackend/ebookconverter
+    ~/.local/bin/pipenv run autorebuild
+    exit 0
 fi
 
 # echo "cron-dopush: checking for files ..."
@@ -48,8 +50,9 @@ fi
 # gbn 2020-04-03: "goback-24" runs the last 24 hours. Instead, we
 # will expicitly rebuild every item in the LIST:
 # ~/.local/bin/pipenv run ebookconverter -v --range=1- --goback=24 --build=all
-for i in ${LIST}; do
-    ~/.local/bin/pipenv run ebookconverter -v --range=${i} --build=all --validate --notify
-done
+# One run for all of the LIST keeps ebookmaker loaded between books;
+# each book is still sent to ebookmaker on its own (--jobs defaults to 1).
+RANGE=`echo ${LIST} | tr ' ' ','`
+~/.local/bin/pipenv run ebookconverter -v --range=${RANGE} --build=all --validate --notify --persistent-worker --job-timeout=30 --lock-wait=600 --pidfile=/tmp/dopush.pid --metrics-job=dopush
 
 ~/.local/bin/pipenv run autorebuild
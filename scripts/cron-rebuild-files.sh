@@ -1,17 +1,13 @@
 #!/bin/bash
 #
 
-D=$(date +"%-d")
+# rebuild what is stale anywhere in the catalog: outputs that are
+# missing, built by an older ebookmaker or ebookconverter, or built
+# from a file that changed since.  What is left when the time is up is
+# still stale tomorrow, so a new version is rolled out over some days.
+# Changed titles and authors are handled by autorebuild (cron-dopush.sh).
 
-# will rebuild up to PG 77999 in a 30 day month
-BOOKS_PER_DAY=2600
-
-START=$((($D-1)*$BOOKS_PER_DAY))
-STOP=$(($D*$BOOKS_PER_DAY-1))
-#STOP=$(($START + 300))
-
-echo "Invoking ebookconverter for range $START to $STOP ..."
+echo "Invoking ebookconverter for stale outputs ..."
 
 cd /export/sunsite/users/gutenbackend/ebookconverter
-~/.local/bin/pipenv run ebookconverter -v -v --range=$START-$STOP --build=all --jobs=20 --pidfile=/tmp/pg-cron-rebuild.pid
-
+~/.local/bin/pipenv run ebookconverter -v -v --range=1- --stale --upgrade --time-budget=1380 --job-timeout=30 --make=all --jobs=20 --pidfile=/tmp/pg-cron-rebuild.pid --metrics-job=rebuild
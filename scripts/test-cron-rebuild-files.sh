@@ -11,4 +11,4 @@ STOP=$(($D*$BOOKS_PER_DAY-1))
 echo "Invoking ebookconverter for range $START to $STOP ..."
 
 cd /export/sunsite/users/gutenbackend/ebookconverter
-~/.local/bin/pipenv run ebookconverter -v -v --range=$START-$STOP --build=all --jobs=50 --pidfile=/tmp/test-pg-cron-rebuild.pid --shadow
+~/.local/bin/pipenv run ebookconverter -v -v --range=$START-$STOP --build=all --jobs=50 --pidfile=/tmp/test-pg-cron-rebuild.pid --shadow --metrics-job=test_rebuild
@@ -19,6 +19,7 @@ setup (
     scripts = [
         'scripts/autodelete',
         'scripts/autorebuild',
+        'scripts/conversion-report',
         'scripts/cron-csv-catalog',
         'scripts/cron-dopush-social.sh',
         'scripts/cron-dopush.sh',
@@ -26,6 +27,7 @@ setup (
         'scripts/cron-rebuild-files.sh',
         'scripts/cron-reindex.sh',
         'scripts/dev-jekyll.sh',
+        'scripts/dopushd',
         'scripts/ebookconverter',
         'scripts/cron-latesttitles.sh',
         'scripts/cron-rdf-catalog',
@@ -54,6 +56,10 @@ setup (
         'textstat>=0.7,<0.8',
     ],
     
+    extras_require = {
+        'inotify': ['inotify_simple'],
+    },
+
     package_data = {
     },
 